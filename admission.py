@@ -0,0 +1,159 @@
+"""
+admission.py - التحكم في القبول: حدود تزامن لفئات المسارات الثقيلة ومساراتها، مع انتظار محدود ثم رفض 503
+"""
+import fcntl
+import functools
+import os
+import threading
+import time
+
+
+class Shed(Exception):
+    """رُفض الطلب: الفئة أو المسار مشبع ولم تتوفر خانة خلال مهلة الانتظار"""
+
+    def __init__(self, gate):
+        super().__init__(f'{gate} مشبع')
+        self.gate = gate
+
+
+class Gate:
+    """عدد محدود من الخانات (ملف لكل خانة يُحجز بـ flock)، فيشمل الحد الخيوط والعمال معاً"""
+
+    def __init__(self, name, slots, lock_dir, poll=0.02):
+        self.name = name
+        self.slots = slots
+        self.lock_dir = lock_dir
+        self.poll = poll
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.waiting = 0
+        self.in_flight = 0
+        self.max_wait = 0.0
+
+    def _try_acquire(self):
+        """حجز أول خانة متاحة: ملفها المفتوح (أو None)"""
+        for slot in range(self.slots):
+            slot_file = open(os.path.join(self.lock_dir, f'{self.name}.{slot}.slot'), 'a')
+            try:
+                fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot_file
+            except BlockingIOError:
+                slot_file.close()
+        return None
+
+    def acquire(self, timeout):
+        """خانة خلال timeout ثانية أو Shed"""
+        slot_file = self._try_acquire()
+        if slot_file is None:
+            start = time.monotonic()
+            deadline = start + timeout
+            with self._lock:
+                self.queued += 1
+                self.waiting += 1
+            try:
+                while slot_file is None and time.monotonic() < deadline:
+                    time.sleep(self.poll)
+                    slot_file = self._try_acquire()
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+                    self.max_wait = max(self.max_wait, time.monotonic() - start)
+            if slot_file is None:
+                with self._lock:
+                    self.shed += 1
+                raise Shed(self.name)
+
+        with self._lock:
+            self.admitted += 1
+            self.in_flight += 1
+        return slot_file
+
+    def release(self, slot_file):
+        with self._lock:
+            self.in_flight -= 1
+        slot_file.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'slots': self.slots,
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'shed': self.shed,
+                'max_wait_ms': self.max_wait * 1000
+            }
+
+
+class AdmissionController:
+    """فئات أولوية للمسارات القابلة للرفض (لوحات وتقارير) بحد وخانات لكل فئة ولكل مسار
+
+    المسارات غير المعلَّمة (الإضافة والصرف وتسجيل الدخول) لا تنتظر ولا تُرفض أبداً، وحدود
+    الفئات الأدنى تترك لها بقية خيوط العمال.
+    """
+
+    def __init__(self, classes, lock_dir):
+        os.makedirs(lock_dir, exist_ok=True)
+        self.lock_dir = lock_dir
+        self.classes = classes
+        self._gates = {name: Gate(name, config['slots'], lock_dir) for name, config in classes.items()}
+        self._lock = threading.Lock()
+
+    def _route_gate(self, route, slots):
+        with self._lock:
+            gate = self._gates.get(route)
+            if gate is None:
+                gate = self._gates[route] = Gate(route, slots, self.lock_dir)
+            return gate
+
+    def admit(self, priority, route=None, route_slots=None):
+        """سياق يحجز خانة المسار ثم خانة الفئة، أو Shed"""
+        return _Admission(self, priority, route, route_slots)
+
+    def limit(self, priority, route_slots=None, on_shed=None):
+        """ديكور لمسار: فئته وحد اختياري خاص به، وon_shed(Shed) يُعيد رد الرفض"""
+        def decorator(f):
+            @functools.wraps(f)
+            def decorated_function(*args, **kwargs):
+                try:
+                    with self.admit(priority, f.__name__ if route_slots else None, route_slots):
+                        return f(*args, **kwargs)
+                except Shed as e:
+                    if on_shed is None:
+                        raise
+                    return on_shed(e)
+            return decorated_function
+        return decorator
+
+    def stats(self):
+        """لكل فئة ومسار: المنفذ حالياً والمنتظر والمقبول والمنتظَر ثم المقبول والمرفوض"""
+        with self._lock:
+            gates = dict(self._gates)
+        return {name: gate.stats() for name, gate in gates.items()}
+
+
+class _Admission:
+    def __init__(self, controller, priority, route, route_slots):
+        self.timeout = controller.classes[priority]['timeout']
+        self.gates = [controller._gates[priority]]
+        if route:
+            self.gates.insert(0, controller._route_gate(route, route_slots))
+        self.held = []
+
+    def __enter__(self):
+        deadline = time.monotonic() + self.timeout
+        try:
+            for gate in self.gates:
+                self.held.append((gate, gate.acquire(max(0.0, deadline - time.monotonic()))))
+        except Shed:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        while self.held:
+            gate, slot_file = self.held.pop()
+            gate.release(slot_file)
@@ -0,0 +1,471 @@
+"""
+analytics.py - محرك تحليلات متجهي (NumPy) لعمليات المحروقات
+"""
+import re
+import sys
+import threading
+import time
+
+import numpy as np
+
+from replication import IMPORTS_VERSION
+import time_windows
+
+# الأبعاد المتاحة واسم العمود المقابل في الذاكرة
+DIMENSIONS = {
+    'unit': 'unit_id',
+    'month': 'month',
+    'day': 'day',
+    'dispense_type': 'dispense_type_id',
+    'status': 'status_id',
+    'driver': 'driver',
+    'vehicle': 'vehicle',
+}
+
+# أبعاد زمنية (يُحسب المتوسط المتحرك على آخر بعد زمني في الطلب)
+TIME_DIMENSIONS = ('month', 'day')
+
+# المقاييس: count أو <petrol|diesel|total>_<sum|mean|pNN>
+_MEASURE = re.compile(r'^(petrol|diesel|total)_(sum|mean|p(\d{1,2}))$')
+
+_INT_COLUMNS = ('day', 'month', 'unit_id', 'dispense_type_id', 'status_id', 'driver', 'vehicle')
+_FLOAT_COLUMNS = ('petrol', 'diesel')
+
+# الأعمدة النصية المرمزة بقاموس
+DICTIONARY_COLUMNS = ('driver', 'vehicle')
+
+# أعمدة الصفوف المقروءة من fuel_operations بترتيب to_arrays
+ROW_QUERY = '''
+    SELECT id, operation_day, unit_id, dispense_type_id, receipt_status_id,
+           driver_name, vehicle_type, petrol_quantity, diesel_quantity, updated_at
+    FROM fuel_operations
+'''
+
+# مرشحات التقرير والعمود الذي يقرؤه كل منها
+_FILTER_COLUMNS = {
+    'date_from': 'day',
+    'date_to': 'day',
+    'unit_id': 'unit_id',
+    'dispense_type_id': 'dispense_type_id',
+    'status_id': 'status_id',
+}
+
+
+class AnalyticsEngine:
+    """أعمدة fuel_operations في مصفوفات NumPy، تُحدَّث تدريجياً حسب أعلى id مقروء
+
+    مع أرشيف عمودي (configure) تُقرأ من SQLite الأشهر المفتوحة فقط، والأشهر المغلقة من ملفات
+    أعمدتها المعيَّنة في الذاكرة عند التقرير (الأعمدة التي يحتاجها فقط).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.archive = None
+        self._reset()
+
+    def configure(self, archive=None):
+        """قراءة الأشهر المغلقة من أرشيف عمودي (columnar.ColumnarArchive) بدلاً من SQLite"""
+        with self._lock:
+            self.archive = archive
+            self._reset()
+
+    def _reset(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.columns = {name: np.empty(0, dtype=np.int32) for name in _INT_COLUMNS}
+        self.columns.update({name: np.empty(0, dtype=np.float64) for name in _FLOAT_COLUMNS})
+        self.driver_names = []
+        self.vehicle_names = []
+        self._driver_codes = {}
+        self._vehicle_codes = {}
+        self.high_water = 0
+        self.updated_mark = ''
+        self.data_version = None
+        self.imports_version = None
+        self.archived_months = []
+        self._remaps = {}
+
+    @staticmethod
+    def _encode(value, names, codes):
+        """ترميز نص بالقاموس (نفس النص ← نفس الرمز)"""
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(names)
+            names.append(value)
+        return code
+
+    def to_arrays(self, rows):
+        """تحويل صفوف ROW_QUERY إلى مصفوفات أعمدة (النصوص مرمزة بقواميس هذا المحرك)"""
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        day = np.fromiter((-1 if row[1] is None else row[1] for row in rows), dtype=np.int32, count=len(rows))
+
+        # رقم الشهر منذ 1970-01 (تحويل متجهي من رقم اليوم)
+        month = day.astype('datetime64[D]').astype('datetime64[M]').astype(np.int32)
+        month[day < 0] = -1
+
+        columns = {
+            'day': day,
+            'month': month,
+            'unit_id': np.fromiter((row[2] or 0 for row in rows), dtype=np.int32, count=len(rows)),
+            'dispense_type_id': np.fromiter((row[3] or 0 for row in rows), dtype=np.int32, count=len(rows)),
+            'status_id': np.fromiter((row[4] or 0 for row in rows), dtype=np.int32, count=len(rows)),
+            'driver': np.fromiter(
+                (self._encode(row[5] or '', self.driver_names, self._driver_codes) for row in rows),
+                dtype=np.int32, count=len(rows)),
+            'vehicle': np.fromiter(
+                (self._encode(row[6] or '', self.vehicle_names, self._vehicle_codes) for row in rows),
+                dtype=np.int32, count=len(rows)),
+            'petrol': np.fromiter((row[7] or 0 for row in rows), dtype=np.float64, count=len(rows)),
+            'diesel': np.fromiter((row[8] or 0 for row in rows), dtype=np.float64, count=len(rows)),
+        }
+        return ids, columns
+
+    def _live(self):
+        """شرط الصفوف المقروءة من SQLite: ما بعد آخر شهر مؤرشف"""
+        if not self.archived_months:
+            return '1=1', ()
+        return '(month IS NULL OR month > ?)', (self.archived_months[-1],)
+
+    def _fetch(self, conn, where, params):
+        live, live_params = self._live()
+        return conn.execute(f'''
+            {ROW_QUERY}
+            WHERE {where} AND {live}
+            ORDER BY id
+        ''', params + live_params).fetchall()
+
+    def _archived(self, conn):
+        """الأشهر المغلقة المتصلة من أولها التي لها أعمدة في الأرشيف"""
+        if self.archive is None:
+            return []
+        available = set(self.archive.months())
+        months = []
+        for (month,) in conn.execute('SELECT month FROM closed_months ORDER BY month'):
+            if month not in available:
+                break
+            months.append(month)
+        return months
+
+    def refresh(self, conn):
+        """قراءة الصفوف الجديدة والمعدلة فقط منذ آخر تحديث"""
+        with self._lock:
+            # إغلاق شهر جديد يخرجه من الصفوف الحية: إعادة التحميل الكامل للأشهر المفتوحة
+            archived = self._archived(conn)
+            if archived != self.archived_months:
+                self._reset()
+                self.archived_months = archived
+
+            # لا تغيير منذ آخر تحديث (يزداد الإصدار مع أي كتابة على الجدول)
+            versions = dict(conn.execute(
+                'SELECT name, version FROM data_versions WHERE name IN (?, ?)', ('fuel_operations', IMPORTS_VERSION)
+            ).fetchall())
+            version = versions['fuel_operations']
+            if version == self.data_version:
+                return len(self.ids)
+
+            # استيراد من موقع آخر منذ آخر تحديث: صفوفه المعدلة تحمل updated_at موقعها الأصل
+            # فقد تسبق updated_mark ولا تُقرأ تدريجياً، فيُعاد التحميل الكامل
+            imports = versions.get(IMPORTS_VERSION)
+            if imports != self.imports_version:
+                self._reset()
+                self.archived_months = archived
+                self.imports_version = imports
+
+            ids = self.ids
+            columns = self.columns
+
+            # الصفوف المعدلة (نسخ ثم تعديل حتى لا تتأثر التقارير الجارية)
+            if len(ids) and self.updated_mark:
+                changed = self._fetch(conn, 'id <= ? AND updated_at >= ?', (self.high_water, self.updated_mark))
+                if changed:
+                    changed_ids, changed_columns = self.to_arrays(changed)
+                    positions = np.minimum(np.searchsorted(ids, changed_ids), len(ids) - 1)
+                    found = ids[positions] == changed_ids
+                    columns = {name: array.copy() for name, array in columns.items()}
+                    for name, array in columns.items():
+                        array[positions[found]] = changed_columns[name][found]
+                    self.updated_mark = max(self.updated_mark, max(row[9] or '' for row in changed))
+
+            # الصفوف الجديدة
+            new_rows = self._fetch(conn, 'id > ?', (self.high_water,))
+            if new_rows:
+                new_ids, new_columns = self.to_arrays(new_rows)
+                ids = np.concatenate((ids, new_ids))
+                columns = {name: np.concatenate((columns[name], new_columns[name])) for name in columns}
+                self.high_water = int(new_ids[-1])
+                self.updated_mark = max(self.updated_mark, max(row[9] or '' for row in new_rows))
+
+            # حذف صفوف بين التحديثين: إعادة التحميل الكامل
+            live, live_params = self._live()
+            total, id_sum = conn.execute(
+                f'SELECT COUNT(*), COALESCE(SUM(id), 0) FROM fuel_operations WHERE {live}', live_params
+            ).fetchone()
+            if len(ids) != total or int(ids.sum()) != id_sum:
+                self._reset()
+                self.archived_months = archived
+                rows = self._fetch(conn, '1=1', ())
+                if rows:
+                    ids, columns = self.to_arrays(rows)
+                    self.high_water = int(ids[-1])
+                    self.updated_mark = max(row[9] or '' for row in rows)
+                else:
+                    ids, columns = self.ids, self.columns
+
+            self.ids = ids
+            self.columns = columns
+            self.data_version = version
+            return len(ids)
+
+    def _labels(self, conn):
+        """أسماء الأبعاد المرمزة"""
+        return {
+            'unit': {row[0]: row[1] for row in conn.execute('SELECT id, name FROM units')},
+            'dispense_type': {row[0]: row[1] for row in conn.execute('SELECT id, name FROM dispense_types')},
+            'status': {row[0]: row[1] for row in conn.execute('SELECT id, name FROM receipt_statuses')},
+            'driver': dict(enumerate(self.driver_names)),
+            'vehicle': dict(enumerate(self.vehicle_names)),
+            'month': lambda code: None if code < 0 else f'{1970 + code // 12:04d}-{code % 12 + 1:02d}',
+            'day': lambda code: None if code < 0 else time_windows.day_to_date(int(code)),
+        }
+
+    def _remap(self, month, kind, names):
+        """رموز قاموس شهر مؤرشف ← رموز قاموس المحرك (مصفوفة بحث تُبنى مرة لكل شهر)"""
+        key = (month, kind, names)
+        remap = self._remaps.get(key)
+        if remap is None:
+            if kind == 'driver':
+                engine_names, engine_codes = self.driver_names, self._driver_codes
+            else:
+                engine_names, engine_codes = self.vehicle_names, self._vehicle_codes
+            remap = np.array([self._encode(name, engine_names, engine_codes) for name in names], dtype=np.int32)
+            self._remaps[key] = remap
+        return remap
+
+    def _with_archive(self, columns, archived, needed, date_from, date_to):
+        """الأعمدة المطلوبة من الأشهر المؤرشفة (معيَّنة في الذاكرة) متبوعة بأعمدة الصفوف الحية
+
+        الأشهر خارج مدى التاريخ لا تُقرأ أصلاً.
+        """
+        months = [m for m in archived
+                  if not (date_from and m < date_from[:7]) and not (date_to and m > date_to[:7])]
+        parts = {name: [] for name in needed}
+        for month in months:
+            for name in needed:
+                values = self.archive.column(month, name)
+                if name in DICTIONARY_COLUMNS:
+                    dictionary = self.archive.dictionary(month)[name]
+                    with self._lock:
+                        remap = self._remap(month, name, dictionary)
+                    values = remap[values]
+                parts[name].append(values)
+        return {name: np.concatenate(parts[name] + [columns[name]]) for name in needed}
+
+    def report(self, conn, dimensions, measures, date_from=None, date_to=None, unit_id=None,
+               dispense_type_id=None, status_id=None, window=None):
+        """تقرير مجمّع حسب الأبعاد المطلوبة
+
+        dimensions: قائمة من DIMENSIONS
+        measures: count أو <petrol|diesel|total>_<sum|mean|pNN>
+        window: طول المتوسط المتحرك على آخر بعد زمني (اختياري)
+        """
+        for dimension in dimensions:
+            if dimension not in DIMENSIONS:
+                raise ValueError(f'بعد غير معروف: {dimension}')
+        parsed = []
+        for measure in measures:
+            match = _MEASURE.match(measure)
+            if measure != 'count' and not match:
+                raise ValueError(f'مقياس غير معروف: {measure}')
+            parsed.append((measure, match))
+        time_dimension = next((d for d in reversed(dimensions) if d in TIME_DIMENSIONS), None)
+        if window and not time_dimension:
+            raise ValueError('المتوسط المتحرك يتطلب بعداً زمنياً (month أو day)')
+
+        # الأعمدة التي يقرؤها التقرير فقط (لا تُلمس بقية أعمدة الأرشيف)
+        filters = {'date_from': date_from, 'date_to': date_to, 'unit_id': unit_id,
+                   'dispense_type_id': dispense_type_id, 'status_id': status_id}
+        needed = {DIMENSIONS[d] for d in dimensions}
+        needed |= {_FILTER_COLUMNS[name] for name, value in filters.items() if value}
+        if any(match for _, match in parsed):
+            needed |= set(_FLOAT_COLUMNS)
+        needed = sorted(needed or {'day'})
+
+        self.refresh(conn)
+        with self._lock:
+            columns = self.columns
+            archived = self.archived_months
+        if archived:
+            columns = self._with_archive(columns, archived, needed, date_from, date_to)
+
+        # التصفية
+        mask = np.ones(len(columns[needed[0]]), dtype=bool)
+        if date_from:
+            mask &= columns['day'] >= time_windows.day_number(date_from)
+        if date_to:
+            mask &= (columns['day'] >= 0) & (columns['day'] <= time_windows.day_number(date_to))
+        if unit_id:
+            mask &= columns['unit_id'] == int(unit_id)
+        if dispense_type_id:
+            mask &= columns['dispense_type_id'] == int(dispense_type_id)
+        if status_id:
+            mask &= columns['status_id'] == int(status_id)
+
+        values = {}
+        if 'petrol' in columns:
+            values['petrol'] = columns['petrol'][mask]
+            values['diesel'] = columns['diesel'][mask]
+            values['total'] = values['petrol'] + values['diesel']
+
+        # ترميز المجموعات: مفتاح واحد مركب من جميع الأبعاد
+        dimension_codes = [columns[DIMENSIONS[d]][mask].astype(np.int64) + 1 for d in dimensions]
+        if dimension_codes:
+            shape = tuple(int(codes.max()) + 1 if len(codes) else 1 for codes in dimension_codes)
+            keys = np.ravel_multi_index(dimension_codes, shape)
+            group_keys, inverse = np.unique(keys, return_inverse=True)
+            group_codes = [codes - 1 for codes in np.unravel_index(group_keys, shape)]
+        else:
+            inverse = np.zeros(int(mask.sum()), dtype=np.int64)
+            group_codes = []
+        groups = int(inverse.max()) + 1 if len(inverse) else 0
+
+        counts = np.bincount(inverse, minlength=groups)
+        results = {}
+        for measure, match in parsed:
+            if measure == 'count':
+                results[measure] = counts.astype(np.float64)
+                continue
+            field, aggregate, percentile = match.groups()
+            if aggregate == 'sum':
+                results[measure] = np.bincount(inverse, weights=values[field], minlength=groups)
+            elif aggregate == 'mean':
+                sums = np.bincount(inverse, weights=values[field], minlength=groups)
+                results[measure] = np.divide(sums, counts, out=np.zeros(groups), where=counts > 0)
+            else:
+                results[measure] = _grouped_percentile(values[field], inverse, counts, int(percentile))
+
+        # المتوسط المتحرك على البعد الزمني داخل كل مجموعة من بقية الأبعاد
+        if window and groups:
+            time_index = dimensions.index(time_dimension)
+            partition = [codes for i, codes in enumerate(group_codes) if i != time_index]
+            order = np.lexsort([group_codes[time_index]] + partition[::-1])
+            for measure in list(results):
+                results[f'{measure}_ma'] = _moving_average(results[measure], order, partition, int(window))
+
+        labels = self._labels(conn)
+        rows = []
+        for group in range(groups):
+            row = {}
+            for dimension, codes in zip(dimensions, group_codes):
+                code = int(codes[group])
+                label = labels[dimension]
+                row[dimension] = label(code) if callable(label) else label.get(code, code)
+            for measure, array in results.items():
+                row[measure] = float(array[group])
+            rows.append(row)
+        return rows
+
+
+def _grouped_percentile(values, inverse, counts, percentile):
+    """النسبة المئوية لكل مجموعة (استيفاء خطي) دون حلقة على المجموعات"""
+    groups = len(counts)
+    if not len(values):
+        return np.zeros(groups)
+    order = np.lexsort((values, inverse))
+    sorted_values = values[order]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    position = starts + (percentile / 100) * np.maximum(counts - 1, 0)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(np.ceil(position).astype(np.int64), len(sorted_values) - 1)
+    fraction = position - lower
+    result = sorted_values[lower] * (1 - fraction) + sorted_values[upper] * fraction
+    result[counts == 0] = 0
+    return result
+
+
+def _moving_average(series, order, partition, window):
+    """متوسط متحرك بطول window ضمن كل قسم، بالترتيب الزمني"""
+    ordered = series[order]
+    size = len(ordered)
+    index = np.arange(size)
+
+    # بداية القسم لكل صف (يتغير القسم عند تغير أي بعد غير زمني)
+    boundary = np.zeros(size, dtype=bool)
+    boundary[0] = True
+    for codes in partition:
+        ordered_codes = codes[order]
+        boundary[1:] |= ordered_codes[1:] != ordered_codes[:-1]
+    starts = np.maximum.accumulate(np.where(boundary, index, 0))
+
+    cumulative = np.concatenate(([0.0], np.cumsum(ordered)))
+    lower = np.maximum(index - window + 1, starts)
+    averaged = (cumulative[index + 1] - cumulative[lower]) / (index - lower + 1)
+
+    result = np.empty(size)
+    result[order] = averaged
+    return result
+
+
+engine = AnalyticsEngine()
+
+
+# ============================================
+# قياس الأداء
+# ============================================
+
+def benchmark(rows=200000, months=12):
+    """تقرير المحرك مقابل GROUP BY في SQLite على نفس البيانات: تطابق النتائج والزمن"""
+    import os
+    import sqlite3
+    import tempfile
+
+    from columnar import _benchmark_db
+
+    with tempfile.TemporaryDirectory() as directory:
+        conn = _benchmark_db(os.path.join(directory, 'benchmark.db'), rows, months)
+        conn.executescript('''
+            CREATE TABLE data_versions (name TEXT PRIMARY KEY, version INTEGER);
+            INSERT INTO data_versions VALUES ('fuel_operations', 1);
+            CREATE TABLE units (id INTEGER PRIMARY KEY, name TEXT);
+            CREATE TABLE dispense_types (id INTEGER PRIMARY KEY, name TEXT);
+            CREATE TABLE receipt_statuses (id INTEGER PRIMARY KEY, name TEXT);
+        ''')
+        conn.executemany('INSERT INTO units VALUES (?, ?)', [(i, f'وحدة {i}') for i in range(1, 12)])
+        conn.commit()
+
+        measures = ['count', 'petrol_sum', 'diesel_sum', 'total_mean']
+        analytics = AnalyticsEngine()
+        start = time.perf_counter()
+        analytics.report(conn, ['unit', 'month'], measures)
+        cold_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        report = analytics.report(conn, ['unit', 'month'], measures)
+        warm_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        expected = conn.execute('''
+            SELECT u.name, f.month, COUNT(*),
+                   COALESCE(SUM(f.petrol_quantity), 0),
+                   COALESCE(SUM(f.diesel_quantity), 0),
+                   AVG(COALESCE(f.petrol_quantity, 0) + COALESCE(f.diesel_quantity, 0))
+            FROM fuel_operations f
+            JOIN units u ON f.unit_id = u.id
+            GROUP BY f.unit_id, f.month
+        ''').fetchall()
+        sql_ms = (time.perf_counter() - start) * 1000
+        conn.close()
+
+        groups = {(row['unit'], row['month']): [row[measure] for measure in measures] for row in report}
+        assert len(groups) == len(expected), f'عدد المجموعات: {len(groups)} مقابل {len(expected)}'
+        for unit, month, *values in expected:
+            assert np.allclose(groups[(unit, month)], values), f'اختلاف في {unit} / {month}'
+
+        print(f'📊 {rows} عملية، {len(expected)} مجموعة (وحدة × شهر)، النتائج متطابقة')
+        print(f'🐢 SQLite GROUP BY: {sql_ms:.1f} مللي ثانية')
+        print(f'⚡ المحرك: {warm_ms:.1f} مللي ثانية ({cold_ms:.1f} مع التحميل الأول)')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark':
+        benchmark(*(int(arg) for arg in sys.argv[2:4]))
+    else:
+        print('الاستخدام: python analytics.py --benchmark [rows] [months]')
+        sys.exit(1)
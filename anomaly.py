@@ -0,0 +1,190 @@
+"""
+anomaly.py - كشف الكميات الشاذة لكل سائق ومركبة ووحدة بإحصائيات تراكمية (Welford + EWMA)
+"""
+import json
+import math
+import sys
+import sqlite3
+
+from writer import default_lock_path, locked_transaction
+
+FUELS = ('petrol', 'diesel')
+
+FUEL_NAMES = {'petrol': 'بترول', 'diesel': 'ديزل'}
+DIMENSION_NAMES = {'driver': 'السائق', 'vehicle': 'المركبة', 'unit': 'الوحدة'}
+
+
+def _dimension_keys(operation):
+    """مفاتيح الإحصائيات التي تنتمي لها العملية"""
+    return [
+        ('driver', (operation['driver_name'] or '').strip()),
+        ('vehicle', (operation['vehicle_type'] or '').strip()),
+        ('unit', str(operation['unit_id'] or '')),
+    ]
+
+
+class AnomalyDetector:
+    """إحصائيات متوسط/تباين تراكمية للكميات المنصرفة، تُحدَّث في O(1) لكل عملية"""
+
+    def __init__(self, threshold=3.0, min_samples=5, alpha=0.1):
+        self.threshold = threshold
+        self.min_samples = min_samples
+        self.alpha = alpha
+
+    def _load(self, conn, keys):
+        """قراءة صفوف الإحصائيات للمفاتيح المطلوبة (بحث بالمفتاح الأساسي)"""
+        stats = {}
+        for dimension, key in keys:
+            for row in conn.execute('''
+                SELECT fuel, count, mean, m2, ewma, ewmvar
+                FROM fuel_draw_stats
+                WHERE dimension = ? AND key = ?
+            ''', (dimension, key)).fetchall():
+                stats[(dimension, key, row[0])] = tuple(row[1:])
+        return stats
+
+    def _deviation(self, quantity, count, mean, m2, ewma, ewmvar):
+        """الانحراف بوحدات σ (الأكبر بين المتوسط التراكمي والمتوسط الأسي)"""
+        floor = max(0.1 * mean, 1.0)
+        std = max(math.sqrt(m2 / (count - 1)) if count > 1 else 0.0, floor)
+        ewm_std = max(math.sqrt(ewmvar) if ewmvar > 0 else 0.0, floor)
+        return max((quantity - mean) / std, (quantity - ewma) / ewm_std)
+
+    def score(self, conn, operation, stats=None):
+        """تقييم عملية مقابل تاريخ أبعادها: (أعلى انحراف، قائمة الأسباب)"""
+        keys = [key for key in _dimension_keys(operation) if key[1]]
+        if stats is None:
+            stats = self._load(conn, keys)
+
+        worst = 0.0
+        reasons = []
+        for fuel in FUELS:
+            quantity = float(operation[f'{fuel}_quantity'] or 0)
+            if quantity <= 0:
+                continue
+            for dimension, key in keys:
+                current = stats.get((dimension, key, fuel))
+                if not current or current[0] < self.min_samples:
+                    continue
+                deviation = self._deviation(quantity, *current)
+                worst = max(worst, deviation)
+                if deviation >= self.threshold:
+                    label = DIMENSION_NAMES[dimension] if dimension == 'unit' else f'{DIMENSION_NAMES[dimension]} {key}'
+                    reasons.append(
+                        f'{label}: {FUEL_NAMES[fuel]} {quantity:.1f} لتر '
+                        f'(المتوسط {current[1]:.1f}، انحراف {deviation:.1f}σ)'
+                    )
+        return worst, reasons
+
+    def observe(self, conn, operation):
+        """إضافة كميات عملية منصرفة إلى الإحصائيات (تحديث Welford و EWMA)"""
+        for dimension, key in _dimension_keys(operation):
+            if not key:
+                continue
+            for fuel in FUELS:
+                quantity = float(operation[f'{fuel}_quantity'] or 0)
+                if quantity <= 0:
+                    continue
+                row = conn.execute('''
+                    SELECT count, mean, m2, ewma, ewmvar FROM fuel_draw_stats
+                    WHERE dimension = ? AND key = ? AND fuel = ?
+                ''', (dimension, key, fuel)).fetchone()
+                count, mean, m2, ewma, ewmvar = row if row else (0, 0.0, 0.0, quantity, 0.0)
+
+                count += 1
+                delta = quantity - mean
+                mean += delta / count
+                m2 += delta * (quantity - mean)
+
+                ewm_delta = quantity - ewma
+                ewma += self.alpha * ewm_delta
+                ewmvar = (1 - self.alpha) * (ewmvar + self.alpha * ewm_delta * ewm_delta)
+
+                conn.execute('''
+                    INSERT INTO fuel_draw_stats (dimension, key, fuel, count, mean, m2, ewma, ewmvar)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(dimension, key, fuel) DO UPDATE SET
+                        count = excluded.count, mean = excluded.mean, m2 = excluded.m2,
+                        ewma = excluded.ewma, ewmvar = excluded.ewmvar
+                ''', (dimension, key, fuel, count, mean, m2, ewma, ewmvar))
+
+    def forget(self, conn, operation):
+        """إزالة عملية منصرفة من المتوسط والتباين التراكميين (عند الحذف)"""
+        for dimension, key in _dimension_keys(operation):
+            for fuel in FUELS:
+                quantity = float(operation[f'{fuel}_quantity'] or 0)
+                if not key or quantity <= 0:
+                    continue
+                row = conn.execute('''
+                    SELECT count, mean, m2 FROM fuel_draw_stats
+                    WHERE dimension = ? AND key = ? AND fuel = ?
+                ''', (dimension, key, fuel)).fetchone()
+                if not row or row[0] <= 1:
+                    conn.execute(
+                        'DELETE FROM fuel_draw_stats WHERE dimension = ? AND key = ? AND fuel = ?',
+                        (dimension, key, fuel)
+                    )
+                    continue
+                count, mean, m2 = row
+                count -= 1
+                delta = quantity - mean
+                mean -= delta / count
+                m2 = max(m2 - delta * (quantity - mean), 0.0)
+                conn.execute('''
+                    UPDATE fuel_draw_stats SET count = ?, mean = ?, m2 = ?
+                    WHERE dimension = ? AND key = ? AND fuel = ?
+                ''', (count, mean, m2, dimension, key, fuel))
+
+    def flag(self, conn, operation_id, score, reasons):
+        """حفظ (أو إزالة) علامة الشذوذ لعملية"""
+        if reasons:
+            conn.execute('''
+                INSERT INTO operation_anomalies (operation_id, score, reasons, created_at)
+                VALUES (?, ?, ?, datetime('now', 'localtime'))
+                ON CONFLICT(operation_id) DO UPDATE SET
+                    score = excluded.score, reasons = excluded.reasons, created_at = excluded.created_at
+            ''', (operation_id, score, json.dumps(reasons, ensure_ascii=False)))
+        else:
+            conn.execute('DELETE FROM operation_anomalies WHERE operation_id = ?', (operation_id,))
+
+    def check(self, conn, operation):
+        """تقييم عملية وحفظ علامتها"""
+        score, reasons = self.score(conn, operation)
+        self.flag(conn, operation['id'], score, reasons)
+        return score, reasons
+
+    def rescore_all(self, conn, lock_path=None, retry=None):
+        """إعادة بناء الإحصائيات من العمليات المنصرفة بالترتيب الزمني وإعادة تقييم الكل
+
+        كل عملية منصرفة تُقيّم مقابل ما سبقها فقط، ثم تُقيّم العمليات غير المنصرفة
+        مقابل الإحصائيات النهائية. الكل في معاملة BEGIN IMMEDIATE تحت قفل ملف الكاتب
+        (locked_transaction) حتى لا تُقيَّم عملية جديدة من العمال على إحصائيات نصف مبنية.
+        """
+        flagged = 0
+        with locked_transaction(conn, lock_path or default_lock_path(conn), retry):
+            conn.execute('DELETE FROM fuel_draw_stats')
+            conn.execute('DELETE FROM operation_anomalies')
+
+            operations = conn.execute('''
+                SELECT id, unit_id, driver_name, vehicle_type, petrol_quantity, diesel_quantity, receipt_status_id
+                FROM fuel_operations
+                ORDER BY receipt_status_id != 1, operation_date, created_at, id
+            ''').fetchall()
+            for operation in operations:
+                score, reasons = self.check(conn, operation)
+                flagged += bool(reasons)
+                if operation['receipt_status_id'] == 1:
+                    self.observe(conn, operation)
+
+        return len(operations), flagged
+
+
+if __name__ == '__main__':
+    threshold = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+
+    conn = sqlite3.connect('database.db', isolation_level=None, timeout=0)
+    conn.row_factory = sqlite3.Row
+    total, flagged = AnomalyDetector(threshold=threshold).rescore_all(conn)
+    conn.close()
+
+    print(f"✅ تمت إعادة تقييم {total} عملية، منها {flagged} عملية شاذة")
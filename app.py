@@ -1,18 +1,118 @@
 """
 app.py - التطبيق الرئيسي لنظام إدارة المحروقات
 """
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g, send_file
 from flask_bcrypt import Bcrypt
+from flask.json.provider import DefaultJSONProvider
+from markupsafe import Markup
 import sqlite3
 import os
 from datetime import datetime
 import functools
+import glob
+import itertools
+import json
+
+from admission import AdmissionController
+from analytics import engine as analytics_engine
+from anomaly import AnomalyDetector
+from archive import query_activity_logs
+from columnar import ColumnarArchive
+from dashboard_data import system_manager_dashboard_data
+from database import upgrade_database
+from http_cache import ConditionalGet, ResponseCompressor, release_token
+import counters
+import inventory
+import master_data
+from month_close import MonthArchive, MonthCloseError, close_month, closed_message, is_closed, month_report
+from jobs import JobQueue, job_status
+from presence import PresenceTracker
+import quota
+from receipts import ReceiptCache
+import replication
+import repository
+from receipt_signing import ReceiptSigner, STATUS_MESSAGES, check_receipt, load_signing_key, qr_svg
+from singleflight import flight
+from snapshot import SnapshotStore
+import time_windows
+from template_cache import init_template_cache, fragment_cache
+from writer import BusyRetry, WriteBusy, WriteCoordinator
+
+class RecordJSONProvider(DefaultJSONProvider):
+    """تحويل سجلات المستودع إلى JSON (في jsonify و tojson)"""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, repository.Record):
+            return o._asdict()
+        return DefaultJSONProvider.default(o)
+
 
 # تهيئة التطبيق
 app = Flask(__name__)
+app.json = RecordJSONProvider(app)
 app.secret_key = 'fuel-management-system-secret-key-2024'
 app.config['SESSION_TYPE'] = 'filesystem'
+app.config['ARCHIVE_DIR'] = 'archive'
+# تقارير الأشهر المغلقة المضغوطة
+app.config['MONTH_ARCHIVE_DIR'] = os.path.join('archive', 'months')
+app.config['PRESENCE_FLUSH_SECONDS'] = 60
+app.config['PRESENCE_ONLINE_SECONDS'] = 300
+app.config['ANOMALY_THRESHOLD'] = 3.0
+app.config['ANOMALY_MIN_SAMPLES'] = 5
+# عند تجاوز حصة الوحدة الشهرية: 'warn' (تنبيه) أو 'reject' (رفض)
+app.config['QUOTA_ENFORCEMENT'] = 'warn'
+# تنبيه انخفاض المخزون عندما تقل أيام التغطية عن هذا العدد
+app.config['STOCK_ALERT_DAYS'] = 3
+app.config['RECEIPT_BATCH_LIMIT'] = 200
+# عدد السجلات المنصرفة في كل صفحة من لوحة مناوب العمليات
+app.config['OPERATIONS_PAGE_SIZE'] = 50
+# مفتاح توقيع السندات: من متغير البيئة RECEIPT_SIGNING_KEY أو ملف سري في مجلد instance
+# (لا يُقبل مفتاح الجلسات المكتوب في الشيفرة)
+app.config['RECEIPT_SIGNING_KEY'] = load_signing_key(app.instance_path, committed=app.secret_key)
+# أقصى عدد أوامر كتابة تُودع في معاملة واحدة
+app.config['WRITER_BATCH_SIZE'] = 64
+# أقصى زمن (ثوانٍ) لإعادة محاولة فتح معاملة الكتابة عند انشغال القاعدة، ثم 503
+app.config['WRITE_RETRY_BUDGET'] = 2.0
+app.config['WRITE_RETRY_AFTER'] = 1
+# أقصى عمر (ثوانٍ) لنسخة التقارير قبل تحديثها في الخلفية
+app.config['SNAPSHOT_MAX_AGE'] = 300
+# عدد عمليات تنفيذ مهام الخلفية لكل عامل، ومدة صلاحية نواتجها (ثوانٍ)
+app.config['JOB_WORKERS'] = 2
+app.config['JOB_ARTIFACT_TTL'] = 3600
+# دمج الاستعلامات الثقيلة المتطابقة بين العمال أيضاً (عبر ملفات قفل)، لا داخل العامل فقط
+app.config['SINGLEFLIGHT_SHARED'] = True
+# فئات المسارات القابلة للرفض: عدد الخانات المتزامنة (لكل العمال) ومهلة الانتظار قبل 503
+app.config['ADMISSION_CLASSES'] = {
+    'dashboard': {'slots': 4, 'timeout': 5},
+    'report': {'slots': 2, 'timeout': 10},
+}
+app.config['ADMISSION_RETRY_AFTER'] = 5
+# مزامنة العمل دون اتصال: أقصى عمليات في الدفعة، وأقصى تغييرات في الرد،
+# وهامش رمز المزامنة (ثوانٍ) حتى لا تفوت تغييرات معاملات لم تُودع لحظة القراءة
+app.config['SYNC_BATCH_LIMIT'] = 100
+app.config['SYNC_CHANGES_LIMIT'] = 1000
+app.config['SYNC_TOKEN_MARGIN'] = 60
+# ضغط الردود النصية (gzip، أو brotli إن كانت مكتبته مثبتة) ابتداءً من هذا الحجم بالبايت
+app.config['COMPRESS_MIN_SIZE'] = 1024
 bcrypt = Bcrypt(app)
+init_template_cache(app)
+
+# بصمة نسخة التطبيق (الشيفرة والقوالب): تبطل ETag والسندات المخزنة بعد كل نشر
+release = release_token(glob.glob(os.path.join(app.root_path, '*.py')) + [os.path.join(app.root_path, 'templates')])
+
+# السندات المصيّرة مخزنة دائماً على القرص (تُبطل تلقائياً عند تغير السجل أو نسخة التطبيق)
+receipt_cache = ReceiptCache(
+    app.config.get('RECEIPT_CACHE_DIR') or os.path.join(app.instance_path, 'receipt_cache'),
+    release=release
+)
+
+# توقيع رموز QR على السندات
+receipt_signer = ReceiptSigner(app.config['RECEIPT_SIGNING_KEY'])
+
+# تطبيق تحديثات المخطط على قاعدة البيانات القائمة
+if os.path.exists('database.db'):
+    upgrade_database()
 
 
 # فلتر escapejs مخصص
@@ -35,11 +135,105 @@ def escapejs_filter(value):
 
 # دالة للاتصال بقاعدة البيانات
 def get_db_connection():
-    """الحصول على اتصال بقاعدة البيانات"""
+    """الحصول على اتصال قراءة بقاعدة البيانات (الكتابة عبر db_writer فقط)"""
     conn = sqlite3.connect('database.db')
     conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA query_only = ON')
     return conn
 
+# كاتب واحد لكل عامل (يتسلسل مع العمال الآخرين عبر قفل ملف)
+db_writer = WriteCoordinator(
+    'database.db',
+    batch_size=app.config['WRITER_BATCH_SIZE'],
+    retry=BusyRetry(budget=app.config['WRITE_RETRY_BUDGET'])
+)
+
+# نسخة قراءة فقط للتقارير والتحليلات (لا تنافس الكتابة على الملف الحي)
+snapshot_store = SnapshotStore('database.db', max_age=app.config['SNAPSHOT_MAX_AGE'])
+
+def get_snapshot_connection():
+    """اتصال قراءة بنسخة التقارير (قد تتأخر عن القاعدة حتى SNAPSHOT_MAX_AGE ثانية)"""
+    return snapshot_store.connect()
+
+# تقارير الأشهر المغلقة من ملفاتها (لا يُعاد تجميع شهر مغلق)
+month_archive = MonthArchive(app.config['MONTH_ARCHIVE_DIR'])
+
+# محرك التحليلات يقرأ الأشهر المغلقة من أعمدتها المعيَّنة في الذاكرة والأشهر المفتوحة فقط من SQLite
+columnar_archive = ColumnarArchive(app.config['MONTH_ARCHIVE_DIR'])
+analytics_engine.configure(columnar_archive)
+
+# مهام الخلفية للتقارير والتصدير (مجمع عمليات، نواتج على القرص)
+job_queue = JobQueue(
+    'database.db',
+    db_writer,
+    app.config.get('JOB_ARTIFACT_DIR') or os.path.join(app.instance_path, 'jobs'),
+    workers=app.config['JOB_WORKERS'],
+    ttl=app.config['JOB_ARTIFACT_TTL']
+)
+
+# دمج الاستعلامات الثقيلة المتزامنة (لوحات بداية الوردية)
+if app.config['SINGLEFLIGHT_SHARED']:
+    flight.configure(lock_dir=app.config.get('SINGLEFLIGHT_DIR') or os.path.join(app.instance_path, 'singleflight'))
+
+# التحكم في القبول: اللوحات والتقارير محدودة حتى تبقى خيوط العمال للإضافة والصرف
+admission = AdmissionController(
+    app.config['ADMISSION_CLASSES'],
+    app.config.get('ADMISSION_DIR') or os.path.join(app.instance_path, 'admission')
+)
+
+@app.template_filter('age')
+def age_filter(seconds):
+    """عمر بالثواني كنص مقروء"""
+    if seconds is None:
+        return 'غير متاح'
+    if seconds < 60:
+        return 'الآن'
+    if seconds < 3600:
+        return f'قبل {int(seconds // 60)} دقيقة'
+    return f'قبل {int(seconds // 3600)} ساعة'
+
+# تتبع حضور المستخدمين
+presence = PresenceTracker(
+    db_writer,
+    flush_interval=app.config['PRESENCE_FLUSH_SECONDS'],
+    online_window=app.config['PRESENCE_ONLINE_SECONDS']
+)
+
+# كشف الكميات الشاذة لكل سائق/مركبة/وحدة
+anomaly_detector = AnomalyDetector(
+    threshold=app.config['ANOMALY_THRESHOLD'],
+    min_samples=app.config['ANOMALY_MIN_SAMPLES']
+)
+
+@app.before_request
+def track_presence():
+    """تحديث آخر ظهور للمستخدم المسجل"""
+    if 'user_id' in session and request.endpoint != 'static':
+        presence.touch(session['user_id'])
+
+@app.template_global('data_version')
+def data_version(*tables):
+    """أرقام إصدار بيانات الجداول (تُستخدم كمفتاح لتخزين أجزاء القوالب)"""
+    if '_data_versions' not in g:
+        conn = get_db_connection()
+        g._data_versions = {
+            row['name']: row['version']
+            for row in conn.execute('SELECT name, version FROM data_versions')
+        }
+        conn.close()
+    return tuple(g._data_versions.get(table, 0) for table in tables)
+
+# الطلبات الشرطية: ETag من إصدارات البيانات ونسخة التطبيق، و304 قبل استعلامات المسار
+conditional = ConditionalGet(data_version, release=release)
+
+# الجداول التي تقرؤها لوحة مسؤول النظام (المتصلون الآن يتغيرون مع الوقت أيضاً: نافذة PRESENCE_FLUSH_SECONDS)
+SYSTEM_MANAGER_TABLES = ('fuel_operations', 'users', 'units', 'dispense_types', 'receipt_statuses',
+                         'activity_logs', 'user_presence')
+
+# ضغط الردود (أول after_request مسجلة فتُنفذ أخيراً، بعد اكتمال الرد)
+compressor = ResponseCompressor(min_size=app.config['COMPRESS_MIN_SIZE'])
+app.after_request(compressor)
+
 # ديكورات الصلاحيات
 def login_required(f):
     """تأكد من تسجيل الدخول"""
@@ -73,25 +267,43 @@ def role_required(required_role):
     return decorator
 
 # دوال مساعدة
-def log_activity(user_id, action, table_name=None, record_id=None, details=None):
-    """تسجيل نشاط المستخدم"""
-    try:
-        conn = get_db_connection()
-        ip_address = request.remote_addr if request else '127.0.0.1'
-
-        conn.execute(
-            """
-            INSERT INTO activity_logs 
-            (user_id, action, table_name, record_id, details, ip_address)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (user_id, action, table_name, record_id, details, ip_address)
-        )
+def record_activity(conn, user_id, action, table_name=None, record_id=None, details=None, ip_address=None):
+    """كتابة نشاط ضمن أمر كتابة قائم (في نفس معاملة التغيير)"""
+    conn.execute(
+        """
+        INSERT INTO activity_logs 
+        (user_id, action, table_name, record_id, details, ip_address, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, datetime('now', 'localtime'))
+        """,
+        (user_id, action, table_name, record_id, details, ip_address or '127.0.0.1')
+    )
+
+def write_busy_response():
+    """رد 503 عند انشغال قاعدة البيانات (لم يُنفذ شيء، فإعادة الطلب آمنة)"""
+    response = jsonify({
+        'success': False,
+        'busy': True,
+        'message': 'قاعدة البيانات مشغولة حالياً، يرجى إعادة المحاولة بعد لحظات'
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(app.config['WRITE_RETRY_AFTER'])
+    return response
+
+def shed_response(shed):
+    """رد 503 عند تشبع فئة المسار (لم يُنفذ شيء)"""
+    message = 'النظام مشغول بتقارير أخرى حالياً، يرجى إعادة المحاولة بعد لحظات'
+    if request.path.startswith('/api/'):
+        response = jsonify({'success': False, 'busy': True, 'message': message})
+    else:
+        response = app.make_response(render_template('busy.html', message=message))
+    response.status_code = 503
+    response.headers['Retry-After'] = str(app.config['ADMISSION_RETRY_AFTER'])
+    return response
 
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        print(f"خطأ في تسجيل النشاط: {e}")
+def log_activity(user_id, action, table_name=None, record_id=None, details=None):
+    """تسجيل نشاط المستخدم (عبر الكاتب دون انتظار)"""
+    ip_address = request.remote_addr if request else '127.0.0.1'
+    db_writer.post(record_activity, user_id, action, table_name, record_id, details, ip_address)
 
 def get_dashboard_route():
     """الحصول على مسار لوحة التحكم حسب الدور"""
@@ -149,6 +361,7 @@ def login():
 
             # تسجيل النشاط
             log_activity(user['id'], 'تسجيل دخول', details=f'الدور: {user["role"]}')
+            presence.login(user['id'])
 
             flash(f'مرحباً بك {user["name"]}! تم تسجيل الدخول بنجاح', 'success')
 
@@ -192,6 +405,7 @@ def logout():
     """تسجيل الخروج"""
     if 'user_id' in session:
         log_activity(session['user_id'], 'تسجيل خروج')
+        presence.logout(session['user_id'])
         session.clear()
     flash('تم تسجيل الخروج بنجاح', 'success')
     return redirect(url_for('login'))
@@ -206,30 +420,32 @@ def dashboard():
 # مسارات مدير النظام
 # ============================================
 
+# إحصائيات لوحة مدير النظام في استعلام واحد
+ADMIN_TOTALS_QUERY = '''
+    SELECT
+        (SELECT COUNT(*) FROM users) as total_users,
+        (SELECT COUNT(*) FROM units WHERE is_active = 1) as total_units,
+        COUNT(*) as total_operations,
+        COALESCE(SUM(petrol_quantity), 0) as total_petrol,
+        COALESCE(SUM(diesel_quantity), 0) as total_diesel
+    FROM fuel_operations
+'''
+
 @app.route('/admin/dashboard')
 @login_required
 @role_required('مدير النظام')
+@admission.limit('dashboard', on_shed=shed_response)
 def admin_dashboard():
     """لوحة تحكم مدير النظام"""
-    conn = get_db_connection()
-
-    # الإحصائيات العامة
-    total_users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
-    total_units = conn.execute('SELECT COUNT(*) FROM units WHERE is_active = 1').fetchone()[0]
+    # الإحصائيات العامة (تجميع كامل للجداول من نسخة التقارير، مدموج بين الطلبات المتزامنة)
+    conn = get_snapshot_connection()
+    totals = flight.query(conn, ADMIN_TOTALS_QUERY)[0]
+    conn.close()
 
-    # إحصائيات العمليات
-    total_operations = conn.execute('SELECT COUNT(*) FROM fuel_operations').fetchone()[0]
-    total_petrol = conn.execute('SELECT COALESCE(SUM(petrol_quantity), 0) FROM fuel_operations').fetchone()[0]
-    total_diesel = conn.execute('SELECT COALESCE(SUM(diesel_quantity), 0) FROM fuel_operations').fetchone()[0]
+    conn = get_db_connection()
 
     # العمليات الأخيرة
-    recent_operations = conn.execute('''
-        SELECT f.*, u.name as unit_name, r.name as status_name, r.color_code as status_color
-        FROM fuel_operations f
-        JOIN units u ON f.unit_id = u.id
-        JOIN receipt_statuses r ON f.receipt_status_id = r.id
-        ORDER BY f.created_at DESC LIMIT 10
-    ''').fetchall()
+    recent_operations = repository.recent_operations(conn, 10)
 
     # النشاطات الأخيرة
     recent_activities = conn.execute('''
@@ -242,17 +458,20 @@ def admin_dashboard():
     conn.close()
 
     return render_template('admin/dashboard.html',
-                         total_users=total_users,
-                         total_units=total_units,
-                         total_operations=total_operations,
-                         total_petrol=total_petrol,
-                         total_diesel=total_diesel,
+                         total_users=totals['total_users'],
+                         total_units=totals['total_units'],
+                         total_operations=totals['total_operations'],
+                         total_petrol=totals['total_petrol'],
+                         total_diesel=totals['total_diesel'],
+                         snapshot_age=snapshot_store.age(),
+                         now_year=datetime.now().year,
                          recent_operations=recent_operations,
                          recent_activities=recent_activities)
 
 @app.route('/admin/users')
 @login_required
 @role_required('مدير النظام')
+@conditional.etag('users', 'units')
 def admin_users():
     """إدارة المستخدمين"""
     conn = get_db_connection()
@@ -271,6 +490,7 @@ def admin_users():
 @app.route('/admin/operations')
 @login_required
 @role_required('مدير النظام')
+@admission.limit('report', route_slots=1, on_shed=shed_response)
 def admin_operations():
     """عرض جميع العمليات"""
     conn = get_db_connection()
@@ -281,37 +501,7 @@ def admin_operations():
     status_id = request.args.get('status_id', '')
     month = request.args.get('month', '')
 
-    query = '''
-        SELECT f.*, u.name as unit_name, r.name as status_name, 
-               d.name as dispense_type, us.name as user_name
-        FROM fuel_operations f
-        JOIN units u ON f.unit_id = u.id
-        JOIN receipt_statuses r ON f.receipt_status_id = r.id
-        JOIN dispense_types d ON f.dispense_type_id = d.id
-        JOIN users us ON f.user_id = us.id
-        WHERE 1=1
-    '''
-    params = []
-
-    if search:
-        query += " AND (f.driver_name LIKE ? OR f.vehicle_type LIKE ? OR f.receipt_number LIKE ?)"
-        params.extend([f'%{search}%', f'%{search}%', f'%{search}%'])
-
-    if unit_id:
-        query += " AND f.unit_id = ?"
-        params.append(unit_id)
-
-    if status_id:
-        query += " AND f.receipt_status_id = ?"
-        params.append(status_id)
-
-    if month:
-        query += " AND f.month = ?"
-        params.append(month)
-
-    query += " ORDER BY f.operation_date DESC"
-
-    operations = conn.execute(query, params).fetchall()
+    operations = repository.search_operations(conn, search, unit_id, status_id, month)
     units = conn.execute('SELECT * FROM units WHERE is_active = 1').fetchall()
     statuses = conn.execute('SELECT * FROM receipt_statuses').fetchall()
 
@@ -329,52 +519,201 @@ def admin_operations():
 @app.route('/admin/reports')
 @login_required
 @role_required('مدير النظام')
+@admission.limit('report', on_shed=shed_response)
 def admin_reports():
     """التقارير والإحصائيات"""
-    conn = get_db_connection()
-
-    # استهلاك شهري
-    monthly_consumption = conn.execute('''
+    # الأشهر المغلقة من إجمالياتها وملفاتها المحفوظة (القائمة من القاعدة الحية فلا تتأخر عن الإغلاق)
+    live_conn = get_db_connection()
+    closed_months = month_archive.closed(live_conn)
+    through, closed_totals = month_archive.cumulative(live_conn)
+    through = through or ''
+    live_conn.close()
+
+    # التجميع الحي من نسخة التقارير للأشهر المفتوحة فقط (العمليات بلا شهر لا تُغلق أبداً فتبقى حية)
+    conn = get_snapshot_connection()
+
+    # استهلاك شهري (العمليات بلا شهر لا تقع في أي صف شهري)
+    monthly_consumption = [
+        {'month': row['month'], 'total_petrol': row['petrol'], 'total_diesel': row['diesel']}
+        for row in closed_months
+    ] + [dict(row) for row in conn.execute('''
         SELECT month, 
                COALESCE(SUM(petrol_quantity), 0) as total_petrol,
                COALESCE(SUM(diesel_quantity), 0) as total_diesel
         FROM fuel_operations
-        WHERE month IS NOT NULL
+        WHERE month IS NOT NULL AND month > ?
         GROUP BY month
-        ORDER BY month DESC
-        LIMIT 12
-    ''').fetchall()
+    ''', (through,))]
+    monthly_consumption = sorted(monthly_consumption, key=lambda row: row['month'], reverse=True)[:12]
 
     # استهلاك الوحدات
-    unit_consumption = conn.execute('''
-        SELECT u.name as unit_name,
+    unit_consumption = []
+    for row in conn.execute('''
+        SELECT u.id, u.name as unit_name,
                COALESCE(SUM(f.petrol_quantity), 0) as total_petrol,
                COALESCE(SUM(f.diesel_quantity), 0) as total_diesel
         FROM units u
-        LEFT JOIN fuel_operations f ON u.id = f.unit_id
+        LEFT JOIN fuel_operations f ON u.id = f.unit_id AND (f.month IS NULL OR f.month > ?)
         WHERE u.is_active = 1
         GROUP BY u.id
-        ORDER BY total_petrol + total_diesel DESC
-    ''').fetchall()
+    ''', (through,)):
+        closed = closed_totals['by_unit'].get(row['id'], {})
+        unit_consumption.append({
+            'unit_name': row['unit_name'],
+            'total_petrol': row['total_petrol'] + closed.get('petrol', 0),
+            'total_diesel': row['total_diesel'] + closed.get('diesel', 0)
+        })
+    unit_consumption.sort(key=lambda row: row['total_petrol'] + row['total_diesel'], reverse=True)
 
     # أنواع الصرف
-    dispense_stats = conn.execute('''
-        SELECT d.name as type_name,
+    dispense_stats = []
+    for row in conn.execute('''
+        SELECT d.id, d.name as type_name,
                COUNT(f.id) as operation_count,
                COALESCE(SUM(f.petrol_quantity), 0) as total_petrol,
                COALESCE(SUM(f.diesel_quantity), 0) as total_diesel
         FROM dispense_types d
-        LEFT JOIN fuel_operations f ON d.id = f.dispense_type_id
+        LEFT JOIN fuel_operations f ON d.id = f.dispense_type_id AND (f.month IS NULL OR f.month > ?)
         GROUP BY d.id
-        ORDER BY operation_count DESC
-    ''').fetchall()
+    ''', (through,)):
+        closed = closed_totals['by_dispense_type'].get(row['id'], {})
+        dispense_stats.append({
+            'type_name': row['type_name'],
+            'operation_count': row['operation_count'] + closed.get('operations', 0),
+            'total_petrol': row['total_petrol'] + closed.get('petrol', 0),
+            'total_diesel': row['total_diesel'] + closed.get('diesel', 0)
+        })
+    dispense_stats.sort(key=lambda row: row['operation_count'], reverse=True)
 
     conn.close()
 
     return render_template('admin/reports.html',
                          monthly_consumption=monthly_consumption,
                          unit_consumption=unit_consumption,
-                         dispense_stats=dispense_stats)
+                         dispense_stats=dispense_stats,
+                         snapshot_age=snapshot_store.age())
+
+@app.route('/api/admin/reports/month/<month>')
+@login_required
+@role_required('مدير النظام')
+@admission.limit('report', on_shed=shed_response)
+def admin_month_report_api(month):
+    """تقرير شهر: من ملفه المحفوظ إن كان مغلقاً، وإلا تجميع حي من نسخة التقارير"""
+    try:
+        conn = get_db_connection()
+        closed = conn.execute('SELECT sha256 FROM closed_months WHERE month = ?', (month,)).fetchone()
+        conn.close()
+
+        if closed:
+            report = month_archive.report(month, closed['sha256'])
+        else:
+            conn = get_snapshot_connection()
+            report = month_report(conn, month)
+            conn.close()
+
+        return jsonify({'success': True, 'closed': closed is not None, 'report': report})
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'خطأ في تقرير الشهر: {str(e)}'
+        }), 500
+
+@app.route('/api/admin/months/<month>/close', methods=['POST'])
+@login_required
+@role_required('مدير النظام')
+def admin_close_month_api(month):
+    """إغلاق شهر: تجميد عملياته وكتابة تقريره المضغوط"""
+    try:
+        user_id, ip_address = session['user_id'], request.remote_addr
+
+        def apply(conn):
+            totals = close_month(conn, month, user_id, app.config['MONTH_ARCHIVE_DIR'])
+            record_activity(
+                conn,
+                user_id,
+                'إغلاق شهر',
+                'closed_months',
+                None,
+                f"إغلاق الشهر {month}: {totals['operations']} عملية",
+                ip_address
+            )
+            return totals
+
+        totals = db_writer.execute(apply)
+
+        return jsonify({
+            'success': True,
+            'message': f'تم إغلاق الشهر {month}',
+            'totals': totals
+        })
+
+    except MonthCloseError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except WriteBusy:
+        return write_busy_response()
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'خطأ في إغلاق الشهر: {str(e)}'
+        }), 500
+
+@app.route('/api/admin/analytics')
+@login_required
+@role_required('مدير النظام')
+@admission.limit('report', on_shed=shed_response)
+def admin_analytics_api():
+    """تقارير تحليلية حسب الأبعاد والمقاييس المطلوبة"""
+    try:
+        dimensions = [d for d in request.args.get('dimensions', 'month').split(',') if d]
+        measures = [m for m in request.args.get('measures', 'count,petrol_sum,diesel_sum').split(',') if m]
+
+        # تقرير طويل: مهمة في الخلفية يتابعها المتصفح عبر /api/jobs/<id>
+        if request.args.get('async'):
+            return submit_job('analytics_report', {
+                'dimensions': dimensions,
+                'measures': measures,
+                'from': request.args.get('from') or None,
+                'to': request.args.get('to') or None,
+                'unit_id': request.args.get('unit_id', type=int),
+                'dispense_type_id': request.args.get('dispense_type_id', type=int),
+                'status_id': request.args.get('status_id', type=int),
+                'window': request.args.get('window', type=int)
+            })
+
+        conn = get_snapshot_connection()
+        rows = analytics_engine.report(
+            conn,
+            dimensions,
+            measures,
+            date_from=request.args.get('from') or None,
+            date_to=request.args.get('to') or None,
+            unit_id=request.args.get('unit_id', type=int),
+            dispense_type_id=request.args.get('dispense_type_id', type=int),
+            status_id=request.args.get('status_id', type=int),
+            window=request.args.get('window', type=int)
+        )
+        conn.close()
+
+        return jsonify({
+            'success': True,
+            'dimensions': dimensions,
+            'measures': measures,
+            'rows': rows,
+            'snapshot_age': snapshot_store.age()
+        })
+
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    except WriteBusy:
+        return write_busy_response()
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'خطأ في إعداد التقرير التحليلي: {str(e)}'
+        }), 500
 
 # ============================================
 # مسارات مسؤول النظام
@@ -384,153 +723,97 @@ def admin_reports():
 # API Routes for System Manager
 # ============================================
 
-@app.route('/api/system-manager/stats')
+@app.route('/api/admin/quotas', methods=['GET', 'POST'])
 @login_required
-@role_required('مسؤول النظام')
-def system_manager_stats():
-    """الحصول على إحصائيات لوحة تحكم مسؤول النظام"""
+@role_required('مدير النظام')
+def admin_quotas_api():
+    """عرض وتحديد الحصص الشهرية للوحدات"""
     try:
-        conn = get_db_connection()
+        if request.method == 'GET':
+            month = request.args.get('month') or datetime.now().strftime('%Y-%m')
+            conn = get_db_connection()
+            balances = quota.list_balances(conn, month)
+            conn.close()
 
-        # تاريخ اليوم
-        today = datetime.now().strftime('%Y-%m-%d')
+            return jsonify({
+                'success': True,
+                'month': month,
+                'quotas': balances
+            })
 
-        # إحصائيات اليوم
-        today_stats = conn.execute('''
-            SELECT 
-                COUNT(*) as total_operations,
-                SUM(CASE WHEN receipt_status_id = 1 THEN 1 ELSE 0 END) as dispensed_receipts,
-                SUM(CASE WHEN receipt_status_id != 1 THEN 1 ELSE 0 END) as non_dispensed_receipts,
-                COALESCE(SUM(petrol_quantity), 0) as total_petrol,
-                COALESCE(SUM(diesel_quantity), 0) as total_diesel
-            FROM fuel_operations 
-            WHERE operation_date = ?
-        ''', (today,)).fetchone()
+        data = request.get_json()
+        if not data or not data.get('unit_id') or not data.get('month'):
+            return jsonify({'success': False, 'message': 'الوحدة والشهر مطلوبان'}), 400
+
+        petrol_quota = data.get('petrol_quota')
+        diesel_quota = data.get('diesel_quota')
+        user_id, ip_address = session['user_id'], request.remote_addr
+
+        def apply(conn):
+            quota.set_quota(
+                conn, data['unit_id'], data['month'],
+                None if petrol_quota in (None, '') else float(petrol_quota),
+                None if diesel_quota in (None, '') else float(diesel_quota)
+            )
 
-        # حساب النسب المئوية
-        total_ops = today_stats['total_operations'] or 0
-        dispensed = today_stats['dispensed_receipts'] or 0
-        non_dispensed = today_stats['non_dispensed_receipts'] or 0
-
-        dispensed_percentage = (dispensed / total_ops * 100) if total_ops > 0 else 0
-        non_dispensed_percentage = (non_dispensed / total_ops * 100) if total_ops > 0 else 0
-
-        # المستخدمين النشطين اليوم
-        active_users = conn.execute('''
-            SELECT DISTINCT u.id, u.name 
-            FROM users u
-            JOIN activity_logs a ON u.id = a.user_id
-            WHERE DATE(a.created_at) = DATE('now')
-            AND a.action LIKE '%تسجيل دخول%'
-        ''').fetchall()
-
-        # السندات المنصرفة اليوم
-        today_dispensed_receipts = conn.execute('''
-            SELECT f.*, u.name as unit_name, r.name as status_name, r.color_code
-            FROM fuel_operations f
-            JOIN units u ON f.unit_id = u.id
-            JOIN receipt_statuses r ON f.receipt_status_id = r.id
-            WHERE f.operation_date = ? 
-            AND f.receipt_status_id = 1
-            ORDER BY f.created_at DESC
-        ''', (today,)).fetchall()
-
-        # جميع العمليات مع تفاصيل إضافية
-        operations = conn.execute('''
-            SELECT 
-                f.*,
-                u.name as unit_name,
-                r.name as status_name,
-                r.color_code as status_color,
-                d.name as dispense_name,
-                us.name as user_name,
-                us.role as user_role,
-                (SELECT name FROM users WHERE id = (
-                    SELECT user_id FROM activity_logs 
-                    WHERE table_name = 'fuel_operations' 
-                    AND record_id = f.id 
-                    AND action = 'تعديل عملية'
-                    ORDER BY created_at DESC LIMIT 1
-                )) as last_updated_by
-            FROM fuel_operations f
-            JOIN units u ON f.unit_id = u.id
-            JOIN receipt_statuses r ON f.receipt_status_id = r.id
-            JOIN dispense_types d ON f.dispense_type_id = d.id
-            JOIN users us ON f.user_id = us.id
-            ORDER BY f.created_at DESC
-            LIMIT 100
-        ''').fetchall()
-
-        # بيانات الرسوم البيانية
-        # توزيع العمليات حسب الحالة
-        status_distribution = conn.execute('''
-            SELECT 
-                r.name as status_name,
-                COUNT(f.id) as count,
-                r.color_code
-            FROM receipt_statuses r
-            LEFT JOIN fuel_operations f ON r.id = f.receipt_status_id
-            GROUP BY r.id, r.name, r.color_code
-            ORDER BY r.id
-        ''').fetchall()
-
-        # الاستهلاك اليومي لآخر 7 أيام
-        daily_consumption = conn.execute('''
-            SELECT 
-                operation_date,
-                COALESCE(SUM(petrol_quantity), 0) as total_petrol,
-                COALESCE(SUM(diesel_quantity), 0) as total_diesel
-            FROM fuel_operations
-            WHERE operation_date >= DATE('now', '-7 days')
-            GROUP BY operation_date
-            ORDER BY operation_date
-        ''').fetchall()
+            record_activity(
+                conn,
+                user_id,
+                'تحديد حصة',
+                'unit_quota_ledger',
+                data['unit_id'],
+                f'حصة الوحدة {data["unit_id"]} لشهر {data["month"]}: بترول {petrol_quota}، ديزل {diesel_quota}',
+                ip_address
+            )
+
+            return quota.balance(conn, data['unit_id'], data['month'])
+
+        balance = db_writer.execute(apply)
+
+        return jsonify({
+            'success': True,
+            'message': 'تم تحديد الحصة بنجاح',
+            'quota': balance
+        })
+
+    except WriteBusy:
+        return write_busy_response()
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'خطأ في الحصص: {str(e)}'
+        }), 500
 
-        # النشاطات الأخيرة
-        recent_activity_logs = conn.execute('''
-            SELECT 
-                a.*,
-                u.name as user_name
-            FROM activity_logs a
-            JOIN users u ON a.user_id = u.id
-            WHERE a.table_name = 'fuel_operations'
-            ORDER BY a.created_at DESC
-            LIMIT 20
-        ''').fetchall()
-
-        # جميع المستخدمين
-        all_users = conn.execute('''
-            SELECT id, name, role FROM users WHERE is_active = 1
-        ''').fetchall()
 
+@app.route('/api/system-manager/stats')
+@login_required
+@role_required('مسؤول النظام')
+@conditional.etag(*SYSTEM_MANAGER_TABLES, window=app.config['PRESENCE_FLUSH_SECONDS'])
+@admission.limit('dashboard', route_slots=2, on_shed=shed_response)
+def system_manager_stats():
+    """الحصول على إحصائيات لوحة تحكم مسؤول النظام"""
+    try:
+        conn = get_db_connection()
+        data = system_manager_dashboard_data(conn, presence, logs_limit=20)
         conn.close()
 
         # تحضير بيانات الرسوم البيانية
         chart_data = {
-            'statusData': [s['count'] for s in status_distribution],
-            'dailyLabels': [d['operation_date'] for d in daily_consumption],
-            'dailyPetrol': [float(d['total_petrol']) for d in daily_consumption],
-            'dailyDiesel': [float(d['total_diesel']) for d in daily_consumption]
+            'statusData': [s['count'] for s in data['status_distribution']],
+            'dailyLabels': [d['operation_date'] for d in data['daily_consumption']],
+            'dailyPetrol': [d['total_petrol'] for d in data['daily_consumption']],
+            'dailyDiesel': [d['total_diesel'] for d in data['daily_consumption']]
         }
 
         return jsonify({
             'success': True,
-            'stats': {
-                'total_operations': total_ops,
-                'dispensed_receipts': dispensed,
-                'non_dispensed_receipts': non_dispensed,
-                'total_petrol': float(today_stats['total_petrol'] or 0),
-                'total_diesel': float(today_stats['total_diesel'] or 0),
-                'dispensed_percentage': dispensed_percentage,
-                'non_dispensed_percentage': non_dispensed_percentage,
-                'operations_change': 12.5,  # يمكن حسابها من البيانات السابقة
-                'active_users': len(active_users)
-            },
-            'today_dispensed_receipts': [dict(r) for r in today_dispensed_receipts],
-            'operations': [dict(o) for o in operations],
-            'today_active_users': [dict(u) for u in active_users],
-            'recent_activity_logs': [dict(l) for l in recent_activity_logs],
-            'all_users': [dict(u) for u in all_users],
+            'stats': data['today_stats'],
+            'today_dispensed_receipts': data['today_dispensed_receipts'],
+            'operations': data['operations'],
+            'today_active_users': data['active_users'],
+            'online_users': data['online_users'],
+            'recent_activity_logs': data['recent_activity_logs'],
+            'all_users': data['all_users'],
             'charts': chart_data
         })
 
@@ -599,122 +882,29 @@ def system_manager_stats():
 @app.route('/system-manager/dashboard')
 @login_required
 @role_required('مسؤول النظام')
+@conditional.etag(*SYSTEM_MANAGER_TABLES, window=app.config['PRESENCE_FLUSH_SECONDS'])
+@admission.limit('dashboard', on_shed=shed_response)
 def system_manager_dashboard():
     """لوحة تحكم مسؤول النظام"""
     conn = get_db_connection()
 
-    # تاريخ اليوم
-    today = datetime.now().strftime('%Y-%m-%d')
-    today_date_ar = datetime.now().strftime('%Y/%m/%d')
-
-    # إحصائيات اليوم
-    today_stats = conn.execute('''
-        SELECT 
-            COUNT(*) as total_operations,
-            SUM(CASE WHEN receipt_status_id = 1 THEN 1 ELSE 0 END) as dispensed_receipts,
-            SUM(CASE WHEN receipt_status_id != 1 THEN 1 ELSE 0 END) as non_dispensed_receipts,
-            COALESCE(SUM(petrol_quantity), 0) as total_petrol,
-            COALESCE(SUM(diesel_quantity), 0) as total_diesel
-        FROM fuel_operations 
-        WHERE operation_date = ?
-    ''', (today,)).fetchone()
-
-    # حساب النسب المئوية
-    total_ops = today_stats['total_operations'] or 0
-    dispensed = today_stats['dispensed_receipts'] or 0
-    non_dispensed = today_stats['non_dispensed_receipts'] or 0
-
-    dispensed_percentage = (dispensed / total_ops * 100) if total_ops > 0 else 0
-    non_dispensed_percentage = (non_dispensed / total_ops * 100) if total_ops > 0 else 0
-
-    # السندات المنصرفة اليوم
-    today_dispensed_receipts = conn.execute('''
-        SELECT f.*, u.name as unit_name, r.name as status_name, r.color_code
-        FROM fuel_operations f
-        JOIN units u ON f.unit_id = u.id
-        JOIN receipt_statuses r ON f.receipt_status_id = r.id
-        WHERE f.operation_date = ? 
-        AND f.receipt_status_id = 1
-        ORDER BY f.created_at DESC
-        LIMIT 20
-    ''', (today,)).fetchall()
-
-    # جميع العمليات مع تفاصيل إضافية
-    operations = conn.execute('''
-        SELECT 
-            f.*,
-            u.name as unit_name,
-            r.name as status_name,
-            r.color_code as status_color,
-            d.name as dispense_name,
-            us.name as user_name,
-            us.role as user_role,
-            (SELECT name FROM users WHERE id = (
-                SELECT user_id FROM activity_logs 
-                WHERE table_name = 'fuel_operations' 
-                AND record_id = f.id 
-                AND action = 'تعديل عملية'
-                ORDER BY created_at DESC LIMIT 1
-            )) as last_updated_by
-        FROM fuel_operations f
-        JOIN units u ON f.unit_id = u.id
-        JOIN receipt_statuses r ON f.receipt_status_id = r.id
-        JOIN dispense_types d ON f.dispense_type_id = d.id
-        JOIN users us ON f.user_id = us.id
-        ORDER BY f.created_at DESC
-        LIMIT 100
-    ''').fetchall()
-
-    # المستخدمين النشطين اليوم
-    active_users = conn.execute('''
-        SELECT DISTINCT u.id, u.name 
-        FROM users u
-        JOIN activity_logs a ON u.id = a.user_id
-        WHERE DATE(a.created_at) = DATE('now')
-        AND a.action LIKE '%تسجيل دخول%'
-    ''').fetchall()
-
-    # النشاطات الأخيرة
-    recent_activity_logs = conn.execute('''
-        SELECT 
-            a.*,
-            u.name as user_name
-        FROM activity_logs a
-        JOIN users u ON a.user_id = u.id
-        WHERE a.table_name = 'fuel_operations'
-        ORDER BY a.created_at DESC
-        LIMIT 10
-    ''').fetchall()
+    data = system_manager_dashboard_data(conn, presence, logs_limit=10, dispensed_limit=20)
 
     # البيانات للفلترة
-    receipt_statuses = conn.execute('SELECT * FROM receipt_statuses').fetchall()
     dispense_types = conn.execute('SELECT * FROM dispense_types').fetchall()
-    all_users = conn.execute('SELECT id, name, role FROM users WHERE is_active = 1').fetchall()
 
     conn.close()
 
     return render_template('system_manager/dashboard.html',
-                           today_date=today_date_ar,
-                           today_stats={
-                               'total_operations': total_ops,
-                               'dispensed_receipts': dispensed,
-                               'non_dispensed_receipts': non_dispensed,
-                               'total_petrol': float(today_stats['total_petrol'] or 0),
-                               'total_diesel': float(today_stats['total_diesel'] or 0),
-                               'dispensed_percentage': dispensed_percentage,
-                               'non_dispensed_percentage': non_dispensed_percentage,
-                               'petrol_percentage': 60,  # يمكن حسابها من البيانات
-                               'diesel_percentage': 40,  # يمكن حسابها من البيانات
-                               'operations_change': 12.5,
-                               'active_users': len(active_users)
-                           },
-                           today_dispensed_receipts=today_dispensed_receipts,
-                           today_active_users=active_users,
-                           operations=operations,
-                           recent_activity_logs=recent_activity_logs,
-                           receipt_statuses=receipt_statuses,
+                           today_date=datetime.now().strftime('%Y/%m/%d'),
+                           today_stats=data['today_stats'],
+                           today_dispensed_receipts=data['today_dispensed_receipts'],
+                           today_active_users=data['active_users'],
+                           operations=data['operations'],
+                           recent_activity_logs=data['recent_activity_logs'],
+                           receipt_statuses=data['receipt_statuses'],
                            dispense_types=dispense_types,
-                           all_users=all_users,
+                           all_users=data['all_users'],
                            now=datetime.now())
 
 
@@ -724,10 +914,14 @@ def system_manager_dashboard():
 @app.route('/operations/dashboard')
 @login_required
 @role_required('المناوب بالعمليات')
+@conditional.etag('fuel_operations', 'units', 'dispense_types')
 def operations_dashboard():
     """لوحة تحكم مناوب العمليات"""
     conn = get_db_connection()
 
+    # رمز المزامنة قبل القراءة: ما يتغير بعدها يصل العميل في أول مزامنة
+    token = sync_token(conn)
+
     # تاريخ اليوم والشهر
     today = datetime.now().strftime('%Y-%m-%d')
     current_month = datetime.now().strftime('%Y-%m')
@@ -743,109 +937,20 @@ def operations_dashboard():
     # تحويل current_unit إلى dict إذا كان موجوداً
     current_unit_dict = dict(current_unit) if current_unit else None
 
-    # الحصول على أعلى رقم سند
-    max_receipt_result = conn.execute(
-        'SELECT COALESCE(MAX(receipt_number), 1000) FROM fuel_operations'
-    ).fetchone()
-    max_receipt_number = max_receipt_result[0] if max_receipt_result else 1000
-
-    # إحصائيات الوحدة
-    unit_stats = conn.execute('''
-        SELECT 
-            COUNT(*) as total_operations,
-            SUM(CASE WHEN receipt_status_id = 1 THEN 1 ELSE 0 END) as dispensed_operations,
-            SUM(CASE WHEN receipt_status_id != 1 THEN 1 ELSE 0 END) as non_dispensed_operations
-        FROM fuel_operations 
-        WHERE unit_id = ?
-    ''', (session.get('unit_id'),)).fetchone() or {'total_operations': 0, 'dispensed_operations': 0,
-                                                   'non_dispensed_operations': 0}
+    # الحصول على أعلى رقم سند (ضمن نطاق أرقام هذا الموقع)
+    max_receipt_number = replication.next_receipt_number(conn) - 1
 
-    # تحويل إلى dict
-    unit_stats_dict = dict(unit_stats)
-
-    # إحصائيات اليوم
-    today_stats = conn.execute('''
-        SELECT 
-            COUNT(*) as today_operations,
-            SUM(CASE WHEN receipt_status_id = 2 THEN 1 ELSE 0 END) as pending_operations,
-            COALESCE(SUM(petrol_quantity), 0) as today_petrol,
-            COALESCE(SUM(diesel_quantity), 0) as today_diesel
-        FROM fuel_operations 
-        WHERE operation_date = ? AND user_id = ?
-    ''', (today, session['user_id'])).fetchone() or {'today_operations': 0, 'pending_operations': 0, 'today_petrol': 0,
-                                                     'today_diesel': 0}
+    # إحصائيات الوحدة واليوم من العدادات (بحث بالمفتاح بدل COUNT/SUM على كل العمليات)
+    unit_stats_dict = counters.unit_counts(conn, session.get('unit_id'))
+    today_stats_dict = counters.user_day_counts(conn, session['user_id'], today)
 
-    # تحويل إلى dict
-    today_stats_dict = dict(today_stats)
+    # السجلات قيد الانتظار
+    pending_operations = repository.user_pending_operations(conn, session['user_id'])
 
-    # جميع السجلات المدخلة من قبل المستخدم
-    all_operations_rows = conn.execute('''
-        SELECT 
-            f.*,
-            u.name as unit_name,
-            r.name as status_name,
-            d.name as dispense_name,
-            (
-                SELECT a.created_at 
-                FROM activity_logs a 
-                WHERE a.table_name = 'fuel_operations' 
-                AND a.record_id = f.id 
-                AND a.action = 'تعديل حالة السند'
-                ORDER BY a.created_at DESC LIMIT 1
-            ) as dispensed_at,
-            (
-                SELECT us.name 
-                FROM activity_logs a 
-                JOIN users us ON a.user_id = us.id 
-                WHERE a.table_name = 'fuel_operations' 
-                AND a.record_id = f.id 
-                AND a.action = 'تعديل حالة السند'
-                ORDER BY a.created_at DESC LIMIT 1
-            ) as dispensed_by,
-            (
-                SELECT a.details 
-                FROM activity_logs a 
-                WHERE a.table_name = 'fuel_operations' 
-                AND a.record_id = f.id 
-                AND a.action = 'تعديل حالة السند'
-                ORDER BY a.created_at DESC LIMIT 1
-            ) as dispense_notes
-        FROM fuel_operations f
-        LEFT JOIN units u ON f.unit_id = u.id
-        JOIN receipt_statuses r ON f.receipt_status_id = r.id
-        JOIN dispense_types d ON f.dispense_type_id = d.id
-        WHERE f.user_id = ?
-        ORDER BY f.created_at DESC
-    ''', (session['user_id'],)).fetchall()
-
-    # تحويل جميع الصفوف إلى قواميس
-    all_operations = [dict(row) for row in all_operations_rows]
-
-    # السجلات التي تم صرفها
-    dispensed_operations_rows = conn.execute('''
-        SELECT 
-            f.*,
-            u.name as unit_name,
-            r.name as status_name,
-            d.name as dispense_name,
-            a.created_at as dispensed_at,
-            us.name as dispensed_by,
-            a.details as dispense_notes
-        FROM fuel_operations f
-        LEFT JOIN units u ON f.unit_id = u.id
-        JOIN receipt_statuses r ON f.receipt_status_id = r.id
-        JOIN dispense_types d ON f.dispense_type_id = d.id
-        JOIN activity_logs a ON f.id = a.record_id
-        JOIN users us ON a.user_id = us.id
-        WHERE f.user_id = ? 
-        AND a.table_name = 'fuel_operations'
-        AND a.action = 'تعديل حالة السند'
-        AND f.receipt_status_id = 1
-        ORDER BY a.created_at DESC
-    ''', (session['user_id'],)).fetchall()
-
-    # تحويل إلى قواميس
-    dispensed_operations = [dict(row) for row in dispensed_operations_rows]
+    # أحدث السجلات المنصرفة (الأقدم تُحمَّل عند الطلب)
+    dispensed_operations, dispensed_next = repository.user_dispensed_operations(
+        conn, session['user_id'], app.config['OPERATIONS_PAGE_SIZE']
+    )
 
     # البيانات اللازمة للنموذج
     units_rows = conn.execute('SELECT * FROM units WHERE is_active = 1 ORDER BY name').fetchall()
@@ -860,13 +965,73 @@ def operations_dashboard():
                            current_unit=current_unit_dict,
                            unit_stats=unit_stats_dict,
                            today_stats=today_stats_dict,
-                           all_operations=all_operations,
+                           pending_operations=pending_operations,
                            dispensed_operations=dispensed_operations,
+                           dispensed_next=dispensed_next,
                            units=units,
                            dispense_types=dispense_types,
                            today=today,
                            current_month=current_month,
-                           max_receipt_number=max_receipt_number)  # إضافة هذا المتغير
+                           max_receipt_number=max_receipt_number,  # إضافة هذا المتغير
+                           sync_token=token)
+
+@app.route('/api/operations/dispensed')
+@login_required
+@role_required('المناوب بالعمليات')
+def operations_dispensed_page():
+    """صفحة أقدم من السجلات المنصرفة للمستخدم (صفوف HTML جاهزة للإلحاق بالجدول)"""
+    try:
+        before = request.args.get('before')
+        cursor = repository.parse_cursor(before) if before else None
+
+        conn = get_db_connection()
+        operations, next_cursor = repository.user_dispensed_operations(
+            conn,
+            session['user_id'],
+            app.config['OPERATIONS_PAGE_SIZE'],
+            before=cursor
+        )
+        conn.close()
+
+        return jsonify({
+            'success': True,
+            'html': render_template('operations/_dispensed_rows.html',
+                                    dispensed_operations=operations,
+                                    offset=request.args.get('offset', 0, type=int)),
+            'next': next_cursor
+        })
+
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'خطأ في تحميل السجلات: {str(e)}'
+        }), 500
+
+@app.route('/api/autocomplete/<kind>')
+@login_required
+def autocomplete_api(kind):
+    """اقتراحات أسماء السائقين أو المركبات لبادئة من فهرس الذاكرة (بدون LIKE على العمليات)"""
+    if kind not in master_data.KINDS:
+        return jsonify({'success': False, 'message': 'نوع غير معروف'}), 404
+
+    try:
+        conn = get_db_connection()
+        suggestions = master_data.autocomplete.suggest(
+            conn, kind, request.args.get('q', ''),
+            min(request.args.get('limit', 10, type=int), master_data.autocomplete.top)
+        )
+        conn.close()
+
+        return jsonify({'success': True, 'suggestions': suggestions})
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'خطأ في الاقتراحات: {str(e)}'
+        }), 500
 
 # ============================================
 # API لتحديث العملية
@@ -879,79 +1044,108 @@ def update_operation(operation_id):
     """تحديث عملية"""
     try:
         data = request.get_json()
+        user_id, ip_address = session['user_id'], request.remote_addr
 
-        conn = get_db_connection()
+        # استخراج الشهر من التاريخ
+        operation_date = data.get('operation_date', '')
+        month = operation_date[:7] if operation_date else datetime.now().strftime('%Y-%m')[:7]
 
-        # التحقق من ملكية العملية
-        operation = conn.execute(
-            'SELECT * FROM fuel_operations WHERE id = ? AND user_id = ?',
-            (operation_id, session['user_id'])
-        ).fetchone()
+        def apply(conn):
+            # التحقق من ملكية العملية
+            operation = conn.execute(
+                'SELECT * FROM fuel_operations WHERE id = ? AND user_id = ?',
+                (operation_id, user_id)
+            ).fetchone()
 
-        if not operation:
-            return jsonify({
-                'success': False,
-                'message': 'العملية غير موجودة أو لا تملك صلاحية التعديل'
-            }), 403
+            if not operation:
+                return 403, 'العملية غير موجودة أو لا تملك صلاحية التعديل'
 
-        # التحقق من حالة السند (لا يمكن تعديل المنصرف)
-        if operation['receipt_status_id'] == 1:
-            return jsonify({
-                'success': False,
-                'message': 'لا يمكن تعديل العملية المنصرفة'
-            }), 400
+            # التحقق من حالة السند (لا يمكن تعديل المنصرف)
+            if operation['receipt_status_id'] == 1:
+                return 400, 'لا يمكن تعديل العملية المنصرفة'
 
-        # استخراج الشهر من التاريخ
-        operation_date = data.get('operation_date', '')
-        month = operation_date[:7] if operation_date else datetime.now().strftime('%Y-%m')[:7]
+            # عمليات الشهر المغلق مجمدة، ولا تُنقل عملية إلى شهر مغلق
+            for frozen in (operation['month'], month):
+                if is_closed(conn, frozen):
+                    return 400, closed_message(frozen)
 
-        # تحديث البيانات
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE fuel_operations 
-            SET operation_date = ?,
-                driver_name = ?,
-                vehicle_type = ?,
-                petrol_quantity = ?,
-                diesel_quantity = ?,
-                unit_id = ?,
-                dispense_type_id = ?,
-                purpose = ?,
-                notes = ?,
-                month = ?,
-                updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (
-            data.get('operation_date'),
-            data.get('driver_name', ''),
-            data.get('vehicle_type', ''),
-            float(data.get('petrol_quantity', 0)),
-            float(data.get('diesel_quantity', 0)),
-            data.get('unit_id') or None,
-            data.get('dispense_type_id', 1),
-            data.get('purpose', ''),
-            data.get('notes', ''),
-            month,
-            operation_id
-        ))
-
-        # تسجيل النشاط
-        log_activity(
-            session['user_id'],
-            'تعديل عملية',
-            'fuel_operations',
-            operation_id,
-            f'تعديل بيانات العملية #{operation["receipt_number"]}'
-        )
+            # التحقق من حصة الوحدة الشهرية
+            quota_warnings = quota.check(
+                conn, data.get('unit_id'), month,
+                data.get('petrol_quantity', 0), data.get('diesel_quantity', 0),
+                replacing=operation
+            )
+            if quota_warnings and app.config['QUOTA_ENFORCEMENT'] == 'reject':
+                return 400, '، '.join(quota_warnings)
 
-        conn.commit()
-        conn.close()
+            # الاسم المعتمد للسائق والمركبة
+            driver_id, driver_name = master_data.resolve(conn, 'driver', data.get('driver_name', ''))
+            vehicle_id, vehicle_type = master_data.resolve(conn, 'vehicle', data.get('vehicle_type', ''))
+
+            # تحديث البيانات
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE fuel_operations 
+                SET operation_date = ?,
+                    driver_name = ?,
+                    vehicle_type = ?,
+                    driver_id = ?,
+                    vehicle_id = ?,
+                    petrol_quantity = ?,
+                    diesel_quantity = ?,
+                    unit_id = ?,
+                    dispense_type_id = ?,
+                    purpose = ?,
+                    notes = ?,
+                    month = ?,
+                    updated_at = datetime('now', 'localtime')
+                WHERE id = ?
+            ''', (
+                data.get('operation_date'),
+                driver_name,
+                vehicle_type,
+                driver_id,
+                vehicle_id,
+                float(data.get('petrol_quantity', 0)),
+                float(data.get('diesel_quantity', 0)),
+                data.get('unit_id') or None,
+                data.get('dispense_type_id', 1),
+                data.get('purpose', ''),
+                data.get('notes', ''),
+                month,
+                operation_id
+            ))
+
+            # تحديث رصيد الحصة وإعادة تقييم الكميات بعد التعديل
+            updated = conn.execute('SELECT * FROM fuel_operations WHERE id = ?', (operation_id,)).fetchone()
+            quota.move(conn, operation, updated)
+            anomaly_detector.check(conn, updated)
+
+            # تسجيل النشاط
+            record_activity(
+                conn,
+                user_id,
+                'تعديل عملية',
+                'fuel_operations',
+                operation_id,
+                f'تعديل بيانات العملية #{operation["receipt_number"]}',
+                ip_address
+            )
+
+            return 200, quota_warnings
+
+        status, result = db_writer.execute(apply)
+        if status != 200:
+            return jsonify({'success': False, 'message': result}), status
 
         return jsonify({
             'success': True,
-            'message': 'تم تحديث العملية بنجاح'
+            'message': 'تم تحديث العملية بنجاح',
+            'warnings': result
         })
 
+    except WriteBusy:
+        return write_busy_response()
     except Exception as e:
         return jsonify({
             'success': False,
@@ -982,60 +1176,7 @@ def fuel_operations():
     status_id = request.args.get('status_id', '')
     month = request.args.get('month', '')
 
-    query = '''
-        SELECT 
-            f.*,
-            u.name as unit_name,
-            r.name as status_name,
-            r.color_code,
-            d.name as dispense_name,
-            us.name as user_name,
-            us.role as user_role,
-            (
-                SELECT a.created_at 
-                FROM activity_logs a 
-                WHERE a.table_name = 'fuel_operations' 
-                AND a.record_id = f.id 
-                AND a.action = 'تعديل حالة السند'
-                ORDER BY a.created_at DESC LIMIT 1
-            ) as dispensed_at,
-            (
-                SELECT us2.name 
-                FROM activity_logs a 
-                JOIN users us2 ON a.user_id = us2.id 
-                WHERE a.table_name = 'fuel_operations' 
-                AND a.record_id = f.id 
-                AND a.action = 'تعديل حالة السند'
-                ORDER BY a.created_at DESC LIMIT 1
-            ) as dispensed_by
-        FROM fuel_operations f
-        LEFT JOIN units u ON f.unit_id = u.id
-        JOIN receipt_statuses r ON f.receipt_status_id = r.id
-        JOIN dispense_types d ON f.dispense_type_id = d.id
-        JOIN users us ON f.user_id = us.id
-        WHERE 1=1
-    '''
-    params = []
-
-    if search:
-        query += " AND (f.driver_name LIKE ? OR f.vehicle_type LIKE ? OR f.receipt_number LIKE ? OR f.purpose LIKE ?)"
-        params.extend([f'%{search}%', f'%{search}%', f'%{search}%', f'%{search}%'])
-
-    if unit_id and unit_id != 'all':
-        query += " AND f.unit_id = ?"
-        params.append(unit_id)
-
-    if status_id and status_id != 'all':
-        query += " AND f.receipt_status_id = ?"
-        params.append(status_id)
-
-    if month and month != 'all':
-        query += " AND f.month = ?"
-        params.append(month)
-
-    query += " ORDER BY f.operation_date DESC, f.created_at DESC"
-
-    operations = conn.execute(query, params).fetchall()
+    operations = repository.search_operations(conn, search, unit_id, status_id, month)
     units = conn.execute('SELECT * FROM units WHERE is_active = 1 ORDER BY name').fetchall()
     statuses = conn.execute('SELECT * FROM receipt_statuses ORDER BY id').fetchall()
 
@@ -1255,102 +1396,16 @@ def fuel_dashboard():
             current_unit = dict(current_unit)
 
     # العمليات قيد الانتظار (غير المنصرفة)
-    pending_operations_rows = conn.execute('''
-        SELECT f.*, u.name as unit_name, r.name as status_name, d.name as dispense_name,
-               us.name as user_name, us.role as user_role
-        FROM fuel_operations f
-        LEFT JOIN units u ON f.unit_id = u.id
-        JOIN receipt_statuses r ON f.receipt_status_id = r.id
-        JOIN dispense_types d ON f.dispense_type_id = d.id
-        JOIN users us ON f.user_id = us.id
-        WHERE f.receipt_status_id = 2  -- غير منصرف فقط
-        ORDER BY f.operation_date DESC, f.created_at DESC
-    ''').fetchall()
-
-    # تحويل كل الصفوف إلى قواميس
-    pending_operations = [dict(row) for row in pending_operations_rows]
+    pending_operations = repository.pending_operations(conn)
 
     # العمليات المنصرفة اليوم
-    today_dispensed_rows = conn.execute('''
-        SELECT f.*, u.name as unit_name, r.name as status_name, d.name as dispense_name,
-               us.name as user_name, us.role as user_role,
-               (
-                   SELECT a.created_at 
-                   FROM activity_logs a 
-                   WHERE a.table_name = 'fuel_operations' 
-                   AND a.record_id = f.id 
-                   AND a.action = 'تعديل حالة السند'
-                   ORDER BY a.created_at DESC LIMIT 1
-               ) as dispensed_at,
-               (
-                   SELECT us2.name 
-                   FROM activity_logs a 
-                   JOIN users us2 ON a.user_id = us2.id 
-                   WHERE a.table_name = 'fuel_operations' 
-                   AND a.record_id = f.id 
-                   AND a.action = 'تعديل حالة السند'
-                   ORDER BY a.created_at DESC LIMIT 1
-               ) as dispensed_by
-        FROM fuel_operations f
-        LEFT JOIN units u ON f.unit_id = u.id
-        JOIN receipt_statuses r ON f.receipt_status_id = r.id
-        JOIN dispense_types d ON f.dispense_type_id = d.id
-        JOIN users us ON f.user_id = us.id
-        WHERE f.receipt_status_id = 1  -- منصرف فقط
-        AND DATE(f.operation_date) = DATE('now')
-        ORDER BY f.operation_date DESC
-    ''').fetchall()
-
-    # تحويل إلى قواميس
-    today_dispensed = [dict(row) for row in today_dispensed_rows]
+    today_dispensed = repository.dispensed_in_window(conn, time_windows.today())
 
     # جميع العمليات مع تفاصيل إضافية
-    all_operations_rows = conn.execute('''
-        SELECT 
-            f.*,
-            u.name as unit_name,
-            r.name as status_name,
-            d.name as dispense_name,
-            us.name as user_name,
-            us.role as user_role,
-            (
-                SELECT a.created_at 
-                FROM activity_logs a 
-                WHERE a.table_name = 'fuel_operations' 
-                AND a.record_id = f.id 
-                AND a.action = 'تعديل حالة السند'
-                ORDER BY a.created_at DESC LIMIT 1
-            ) as dispensed_at,
-            (
-                SELECT us2.name 
-                FROM activity_logs a 
-                JOIN users us2 ON a.user_id = us2.id 
-                WHERE a.table_name = 'fuel_operations' 
-                AND a.record_id = f.id 
-                AND a.action = 'تعديل حالة السند'
-                ORDER BY a.created_at DESC LIMIT 1
-            ) as dispensed_by,
-            (
-                SELECT us3.name 
-                FROM activity_logs a 
-                JOIN users us3 ON a.user_id = us3.id 
-                WHERE a.table_name = 'fuel_operations' 
-                AND a.record_id = f.id 
-                AND a.action LIKE '%تعديل%'
-                AND a.action != 'تعديل حالة السند'
-                ORDER BY a.created_at DESC LIMIT 1
-            ) as last_updater
-        FROM fuel_operations f
-        LEFT JOIN units u ON f.unit_id = u.id
-        JOIN receipt_statuses r ON f.receipt_status_id = r.id
-        JOIN dispense_types d ON f.dispense_type_id = d.id
-        JOIN users us ON f.user_id = us.id
-        ORDER BY f.operation_date DESC, f.created_at DESC
-        LIMIT 500
-    ''').fetchall()
+    all_operations = repository.latest_operations(conn, 500)
 
-    # تحويل إلى قواميس
-    all_operations = [dict(row) for row in all_operations_rows]
+    for operation in itertools.chain(pending_operations, all_operations):
+        operation.anomaly_reasons = json.loads(operation.anomaly_reasons or '[]')
 
     # الإحصائيات
     today_stats = conn.execute('''
@@ -1382,10 +1437,15 @@ def fuel_dashboard():
     dispense_types_rows = conn.execute('SELECT * FROM dispense_types ORDER BY id').fetchall()
     dispense_types = [dict(row) for row in dispense_types_rows]
 
+    # مخزون الخزانات وتنبيهات الانخفاض
+    tanks = inventory.stock_levels(conn, app.config['STOCK_ALERT_DAYS'])
+
     conn.close()
 
     return render_template('fuel/dashboard.html',
                            current_unit=current_unit,
+                           tanks=tanks,
+                           low_stock_tanks=[tank for tank in tanks if tank['is_low']],
                            pending_operations=pending_operations,
                            today_dispensed=today_dispensed,
                            all_operations=all_operations,
@@ -1416,55 +1476,70 @@ def dispense_operation(operation_id):
     """تعديل حالة السند إلى منصرف"""
     try:
         data = request.get_json()
+        user_id, ip_address = session['user_id'], request.remote_addr
 
-        conn = get_db_connection()
+        def apply(conn):
+            # التحقق من وجود العملية
+            operation = conn.execute(
+                'SELECT * FROM fuel_operations WHERE id = ?',
+                (operation_id,)
+            ).fetchone()
 
-        # التحقق من وجود العملية
-        operation = conn.execute(
-            'SELECT * FROM fuel_operations WHERE id = ?',
-            (operation_id,)
-        ).fetchone()
+            if not operation:
+                return 404, 'العملية غير موجودة'
 
-        if not operation:
-            return jsonify({
-                'success': False,
-                'message': 'العملية غير موجودة'
-            }), 404
+            # التحقق من حالة السند (لا يمكن صرف المنصرف مسبقاً)
+            if operation['receipt_status_id'] == 1:
+                return 400, 'هذا السند تم صرفه مسبقاً'
 
-        # التحقق من حالة السند (لا يمكن صرف المنصرف مسبقاً)
-        if operation['receipt_status_id'] == 1:
-            return jsonify({
-                'success': False,
-                'message': 'هذا السند تم صرفه مسبقاً'
-            }), 400
+            if is_closed(conn, operation['month']):
+                return 400, closed_message(operation['month'])
 
-        # تحديث حالة السند
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE fuel_operations 
-            SET receipt_status_id = 1,  -- منصرف
-                operation_officer = ?,
-                updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (data.get('operation_officer', ''), operation_id))
-
-        # تسجيل النشاط
-        log_activity(
-            session['user_id'],
-            'تعديل حالة السند',
-            'fuel_operations',
-            operation_id,
-            f'تم صرف السند #{operation["receipt_number"]}. ملاحظات: {data.get("dispense_notes", "لا توجد")}'
-        )
+            # تحديث حالة السند
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE fuel_operations 
+                SET receipt_status_id = 1,  -- منصرف
+                    operation_officer = ?,
+                    updated_at = datetime('now', 'localtime')
+                WHERE id = ?
+            ''', (data.get('operation_officer', ''), operation_id))
 
-        conn.commit()
-        conn.close()
+            # نقل الكمية من المحجوز إلى المنصرف في رصيد الحصة
+            quota.move(conn, operation, conn.execute(
+                'SELECT * FROM fuel_operations WHERE id = ?', (operation_id,)
+            ).fetchone())
+
+            # خصم الكميات من مخزون الخزانات
+            inventory.record_dispense(conn, operation, user_id)
+
+            # إضافة الكميات المنصرفة إلى إحصائيات السائق والمركبة والوحدة
+            anomaly_detector.observe(conn, operation)
+
+            # تسجيل النشاط
+            record_activity(
+                conn,
+                user_id,
+                'تعديل حالة السند',
+                'fuel_operations',
+                operation_id,
+                f'تم صرف السند #{operation["receipt_number"]}. ملاحظات: {data.get("dispense_notes", "لا توجد")}',
+                ip_address
+            )
+
+            return 200, None
+
+        status, message = db_writer.execute(apply)
+        if status != 200:
+            return jsonify({'success': False, 'message': message}), status
 
         return jsonify({
             'success': True,
             'message': 'تم صرف السند بنجاح'
         })
 
+    except WriteBusy:
+        return write_busy_response()
     except Exception as e:
         return jsonify({
             'success': False,
@@ -1479,37 +1554,14 @@ def get_operation_details(operation_id):
     try:
         conn = get_db_connection()
 
-        operation = conn.execute('''
-            SELECT 
-                f.*,
-                u.name as unit_name,
-                r.name as status_name,
-                d.name as dispense_name,
-                us.name as user_name,
-                us.role as user_role,
-                (
-                    SELECT us2.name 
-                    FROM activity_logs a 
-                    JOIN users us2 ON a.user_id = us2.id 
-                    WHERE a.table_name = 'fuel_operations' 
-                    AND a.record_id = f.id 
-                    AND a.action LIKE '%تعديل%'
-                    ORDER BY a.created_at DESC LIMIT 1
-                ) as last_updater
-            FROM fuel_operations f
-            LEFT JOIN units u ON f.unit_id = u.id
-            JOIN receipt_statuses r ON f.receipt_status_id = r.id
-            JOIN dispense_types d ON f.dispense_type_id = d.id
-            JOIN users us ON f.user_id = us.id
-            WHERE f.id = ?
-        ''', (operation_id,)).fetchone()
+        operation = repository.get_operation(conn, operation_id)
 
         conn.close()
 
         if operation:
             return jsonify({
                 'success': True,
-                'operation': dict(operation)
+                'operation': operation
             })
         else:
             return jsonify({
@@ -1531,29 +1583,126 @@ def print_receipt(operation_id):
     """طباعة سند الصرف"""
     conn = get_db_connection()
 
-    operation = conn.execute('''
-        SELECT 
-            f.*,
-            u.name as unit_name,
-            r.name as status_name,
-            d.name as dispense_name,
-            us.name as user_name,
-            us.role as user_role
-        FROM fuel_operations f
-        LEFT JOIN units u ON f.unit_id = u.id
-        JOIN receipt_statuses r ON f.receipt_status_id = r.id
-        JOIN dispense_types d ON f.dispense_type_id = d.id
-        JOIN users us ON f.user_id = us.id
-        WHERE f.id = ?
-    ''', (operation_id,)).fetchone()
+    operation = repository.get_receipt(conn, operation_id)
+    conn.close()
 
     if not operation or operation['receipt_status_id'] != 1:
         flash('لا يمكن طباعة سند غير منصرف', 'warning')
         return redirect(url_for('fuel_dashboard'))
 
+    return render_template('fuel/print_receipt.html',
+                           operation=operation,
+                           receipt_html=Markup(receipt_cache.render(signed_receipt(operation), render_receipt_body)))
+
+
+@app.route('/fuel/print-receipts')
+@login_required
+@role_required('المناوب بالمحروقات')
+def print_receipts():
+    """طباعة مجموعة سندات منصرفة في مستند واحد (بأرقام العمليات أو بتاريخ الصرف)"""
+    ids = [int(value) for value in request.args.get('ids', '').split(',') if value.strip().isdigit()]
+    date = request.args.get('date') or None
+    limit = app.config['RECEIPT_BATCH_LIMIT']
+
+    try:
+        window = time_windows.day(date) if date else time_windows.today()
+    except ValueError:
+        flash('تاريخ غير صالح', 'warning')
+        return redirect(url_for('fuel_dashboard'))
+
+    conn = get_db_connection()
+    if ids:
+        operations = repository.receipts_by_ids(conn, ids[:limit])
+    else:
+        operations = repository.receipts_by_window(conn, window, limit)
+        date = window.start.isoformat()
     conn.close()
 
-    return render_template('fuel/print_receipt.html', operation=operation)
+    receipts = [
+        Markup(receipt_cache.render(signed_receipt(operation), render_receipt_body))
+        for operation in operations
+    ]
+
+    return render_template('fuel/print_receipts.html', receipts=receipts, date=date)
+
+
+def signed_receipt(operation):
+    """بيانات السند مع حمولة QR الموقعة (جزء من بصمة التخزين)"""
+    return dict(operation, qr_payload=receipt_signer.sign(operation))
+
+
+def render_receipt_body(operation):
+    """تصيير محتوى سند واحد (يُخزن دائماً لكل عملية)"""
+    return render_template('fuel/_receipt_body.html',
+                           operation=operation,
+                           qr_svg=Markup(qr_svg(operation['qr_payload'])))
+
+
+# ============================================
+# التحقق من السندات عند المضخة
+# ============================================
+
+@app.route('/fuel/verify')
+@login_required
+@role_required('المناوب بالمحروقات')
+def verify_receipt_page():
+    """صفحة مسح رموز QR للسندات"""
+    return render_template('fuel/verify_receipt.html')
+
+
+@app.route('/api/verify-receipt', methods=['GET', 'POST'])
+@login_required
+@role_required('المناوب بالمحروقات')
+def verify_receipt():
+    """التحقق من رمز سند (POST مع redeem=true يسجل استخدامه)"""
+    try:
+        data = request.get_json(silent=True) or {}
+        code = data.get('code') or request.args.get('code', '')
+
+        # التحقق من التوقيع أولاً دون الرجوع لقاعدة البيانات
+        signed = receipt_signer.verify(code)
+        if signed is None:
+            return jsonify({
+                'success': True,
+                'valid': False,
+                'status': 'invalid',
+                'message': STATUS_MESSAGES['invalid']
+            })
+
+        conn = get_db_connection()
+        status, operation = check_receipt(conn, signed)
+        conn.close()
+
+        # تسجيل استخدام السند (مرة واحدة فقط)
+        if status == 'valid' and request.method == 'POST' and data.get('redeem'):
+            user_id = session['user_id']
+
+            def redeem(conn):
+                cursor = conn.execute('''
+                    INSERT OR IGNORE INTO receipt_redemptions (operation_id, redeemed_at, user_id)
+                    VALUES (?, datetime('now', 'localtime'), ?)
+                ''', (operation['id'], user_id))
+                if cursor.rowcount == 0:
+                    return check_receipt(conn, signed)
+                return status, operation
+
+            status, operation = db_writer.execute(redeem)
+
+        return jsonify({
+            'success': True,
+            'valid': status == 'valid',
+            'status': status,
+            'message': STATUS_MESSAGES[status],
+            'receipt': dict(operation) if operation else None
+        })
+
+    except WriteBusy:
+        return write_busy_response()
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'خطأ في التحقق من السند: {str(e)}'
+        }), 500
 
 
 # ============================================
@@ -1584,20 +1733,22 @@ def fuel_stats():
         ''', (today,)).fetchone()
 
         # إحصائيات الأسبوع
-        week_stats = conn.execute('''
+        week_clause, week_params = time_windows.rolling_days(7).day_predicate()
+        week_stats = conn.execute(f'''
             SELECT 
                 operation_date,
                 COUNT(*) as operations,
                 COALESCE(SUM(petrol_quantity), 0) as petrol,
                 COALESCE(SUM(diesel_quantity), 0) as diesel
             FROM fuel_operations 
-            WHERE operation_date >= DATE('now', '-7 days')
+            WHERE {week_clause}
             GROUP BY operation_date
             ORDER BY operation_date
-        ''').fetchall()
+        ''', week_params).fetchall()
 
         # إحصائيات الوحدات
-        unit_stats = conn.execute('''
+        month_clause, month_params = time_windows.rolling_days(30).day_predicate('f.operation_day')
+        unit_stats = conn.execute(f'''
             SELECT 
                 u.name as unit_name,
                 COUNT(f.id) as operations,
@@ -1606,11 +1757,11 @@ def fuel_stats():
             FROM units u
             LEFT JOIN fuel_operations f ON u.id = f.unit_id
             WHERE u.is_active = 1
-            AND f.operation_date >= DATE('now', '-30 days')
+            AND {month_clause}
             GROUP BY u.id
             ORDER BY operations DESC
             LIMIT 10
-        ''').fetchall()
+        ''', month_params).fetchall()
 
         conn.close()
 
@@ -1631,78 +1782,439 @@ def fuel_stats():
 
 
 
+# ============================================
+# API مخزون المحروقات
+# ============================================
+
+@app.route('/api/fuel/stock')
+@login_required
+@role_required('المناوب بالمحروقات')
+def fuel_stock():
+    """المخزون الحالي لكل خزان مع أيام التغطية"""
+    try:
+        conn = get_db_connection()
+        tanks = inventory.stock_levels(conn, app.config['STOCK_ALERT_DAYS'])
+        conn.close()
+
+        return jsonify({
+            'success': True,
+            'tanks': tanks
+        })
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'خطأ في الحصول على المخزون: {str(e)}'
+        }), 500
+
+
+@app.route('/api/fuel/deliveries', methods=['POST'])
+@login_required
+@role_required('المناوب بالمحروقات')
+def fuel_delivery():
+    """تسجيل توريد وقود إلى خزان"""
+    try:
+        data = request.get_json()
+
+        if not data or not data.get('tank_id') or float(data.get('quantity') or 0) <= 0:
+            return jsonify({'success': False, 'message': 'الخزان والكمية مطلوبان'}), 400
+
+        user_id, ip_address = session['user_id'], request.remote_addr
+        delivery_date = data.get('delivery_date') or datetime.now().strftime('%Y-%m-%d')
+
+        def apply(conn):
+            tank = conn.execute(
+                'SELECT * FROM fuel_tanks WHERE id = ? AND is_active = 1',
+                (data['tank_id'],)
+            ).fetchone()
+            if not tank:
+                return None
+
+            delivery_id = inventory.record_delivery(
+                conn,
+                tank['id'],
+                float(data['quantity']),
+                delivery_date,
+                reference=data.get('reference', ''),
+                supplier=data.get('supplier', ''),
+                notes=data.get('notes', ''),
+                user_id=user_id
+            )
+
+            # تسجيل النشاط
+            record_activity(
+                conn,
+                user_id,
+                'توريد وقود',
+                'fuel_deliveries',
+                delivery_id,
+                f'توريد {float(data["quantity"]):.1f} لتر إلى الخزان {tank["name"]}',
+                ip_address
+            )
+
+            return delivery_id
+
+        delivery_id = db_writer.execute(apply)
+        if delivery_id is None:
+            return jsonify({'success': False, 'message': 'الخزان غير موجود'}), 404
+
+        return jsonify({
+            'success': True,
+            'message': 'تم تسجيل التوريد بنجاح',
+            'delivery_id': delivery_id
+        })
+
+    except WriteBusy:
+        return write_busy_response()
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'خطأ في تسجيل التوريد: {str(e)}'
+        }), 500
+
+
+@app.route('/api/fuel/tanks/<int:tank_id>/adjust', methods=['POST'])
+@login_required
+@role_required('المناوب بالمحروقات')
+def fuel_tank_adjust(tank_id):
+    """تسوية مستوى خزان بعد القياس الفعلي"""
+    try:
+        data = request.get_json()
+
+        if not data or data.get('level') in (None, ''):
+            return jsonify({'success': False, 'message': 'المستوى المقاس مطلوب'}), 400
+
+        user_id, ip_address = session['user_id'], request.remote_addr
+
+        def apply(conn):
+            level = inventory.adjust_level(conn, tank_id, float(data['level']), user_id, data.get('notes', ''))
+            if level is not None:
+                record_activity(
+                    conn,
+                    user_id,
+                    'تسوية مخزون',
+                    'fuel_tanks',
+                    tank_id,
+                    f'تسوية مستوى الخزان إلى {level:.1f} لتر',
+                    ip_address
+                )
+            return level
+
+        level = db_writer.execute(apply)
+        if level is None:
+            return jsonify({'success': False, 'message': 'الخزان غير موجود'}), 404
+
+        return jsonify({
+            'success': True,
+            'message': 'تم تسوية المخزون بنجاح',
+            'level': level
+        })
+
+    except WriteBusy:
+        return write_busy_response()
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'خطأ في تسوية المخزون: {str(e)}'
+        }), 500
+
+
+@app.route('/api/admin/tanks', methods=['GET', 'POST'])
+@login_required
+@role_required('مدير النظام')
+def admin_tanks_api():
+    """عرض وإضافة خزانات المحروقات"""
+    try:
+        if request.method == 'GET':
+            conn = get_db_connection()
+            tanks = [dict(row) for row in conn.execute('SELECT * FROM fuel_tanks ORDER BY fuel, name').fetchall()]
+            conn.close()
+            return jsonify({'success': True, 'tanks': tanks})
+
+        data = request.get_json()
+        if not data or not data.get('name') or data.get('fuel') not in inventory.FUELS:
+            return jsonify({'success': False, 'message': 'اسم الخزان ونوع الوقود مطلوبان'}), 400
+
+        user_id, ip_address = session['user_id'], request.remote_addr
+
+        def apply(conn):
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO fuel_tanks (name, fuel, capacity, low_level, updated_at)
+                VALUES (?, ?, ?, ?, datetime('now', 'localtime'))
+            ''', (
+                data['name'],
+                data['fuel'],
+                float(data['capacity']) if data.get('capacity') else None,
+                float(data.get('low_level') or 0)
+            ))
+            tank_id = cursor.lastrowid
+
+            # المستوى الافتتاحي كحركة تسوية
+            if float(data.get('level') or 0):
+                inventory.adjust_level(conn, tank_id, float(data['level']), user_id, 'رصيد افتتاحي')
+
+            record_activity(
+                conn,
+                user_id,
+                'إضافة خزان',
+                'fuel_tanks',
+                tank_id,
+                f'إضافة الخزان {data["name"]}',
+                ip_address
+            )
+
+            return tank_id
+
+        tank_id = db_writer.execute(apply)
+
+        return jsonify({
+            'success': True,
+            'message': 'تم إضافة الخزان بنجاح',
+            'tank_id': tank_id
+        })
+
+    except WriteBusy:
+        return write_busy_response()
+    except sqlite3.IntegrityError:
+        return jsonify({'success': False, 'message': 'اسم الخزان موجود مسبقاً'}), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'خطأ في الخزانات: {str(e)}'
+        }), 500
+
+
 # ============================================
 # API Routes
 # ============================================
 
+def insert_operation(conn, data, user_id, ip_address, idempotency_key=None):
+    """إضافة عملية داخل أمر كتابة: (رقم السند، التنبيهات، هل هي إعادة إرسال)
+
+    رقم السند None عند رفض الحصة. مع idempotency_key تُرجع إعادة الإرسال نفس رقم السند دون إضافة.
+    """
+    if idempotency_key:
+        existing = conn.execute(
+            'SELECT receipt_number FROM idempotency_keys WHERE user_id = ? AND idempotency_key = ?',
+            (user_id, idempotency_key)
+        ).fetchone()
+        if existing:
+            return existing[0], [], True
+
+    # استخراج الشهر من التاريخ
+    operation_date = data.get('operation_date', '')
+    month = operation_date[:7] if operation_date else datetime.now().strftime('%Y-%m')[:7]
+
+    # لا تُضاف عمليات إلى شهر مغلق
+    if is_closed(conn, month):
+        return None, [closed_message(month)], False
+
+    # توليد رقم سند تلقائي (داخل معاملة الكاتب فلا يتكرر الرقم بين طلبين متزامنين، وضمن نطاق الموقع)
+    receipt_number = replication.next_receipt_number(conn)
+
+    # التحقق من حصة الوحدة الشهرية (بحث مباشر في الرصيد الجاري)
+    quota_warnings = []
+    if int(data.get('receipt_status_id', 1)) != quota.REFUNDED_STATUS:
+        quota_warnings = quota.check(
+            conn, data.get('unit_id'), month,
+            data.get('petrol_quantity', 0), data.get('diesel_quantity', 0)
+        )
+    if quota_warnings and app.config['QUOTA_ENFORCEMENT'] == 'reject':
+        return None, quota_warnings, False
+
+    # الاسم المعتمد للسائق والمركبة (تهجئة مختلفة لاسم مسجل تُكتب بالتهجئة المسجلة)
+    driver_id, driver_name = master_data.resolve(conn, 'driver', data.get('driver_name', ''))
+    vehicle_id, vehicle_type = master_data.resolve(conn, 'vehicle', data.get('vehicle_type', ''))
+
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO fuel_operations 
+        (operation_date, unit_id, driver_name, vehicle_type, driver_id, vehicle_id, petrol_quantity, 
+         diesel_quantity, operation_officer, receipt_status_id, receipt_number,
+         dispense_type_id, purpose, month, notes, user_id, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                datetime('now', 'localtime'), datetime('now', 'localtime'))
+    ''', (
+        operation_date,
+        data.get('unit_id'),
+        driver_name,
+        vehicle_type,
+        driver_id,
+        vehicle_id,
+        float(data.get('petrol_quantity', 0)),
+        float(data.get('diesel_quantity', 0)),
+        data.get('operation_officer', ''),
+        data.get('receipt_status_id', 1),
+        receipt_number,
+        data.get('dispense_type_id', 1),
+        data.get('purpose', ''),
+        month,
+        data.get('notes', ''),
+        user_id
+    ))
+
+    operation_id = cursor.lastrowid
+
+    # تقييم الكميات مقابل تاريخ السائق والمركبة والوحدة
+    operation = conn.execute('SELECT * FROM fuel_operations WHERE id = ?', (operation_id,)).fetchone()
+    anomaly_detector.check(conn, operation)
+    if operation['receipt_status_id'] == 1:
+        anomaly_detector.observe(conn, operation)
+        inventory.record_dispense(conn, operation, user_id)
+
+    # تسجيل الكمية في رصيد حصة الوحدة
+    quota.post(conn, operation)
+
+    if idempotency_key:
+        conn.execute('''
+            INSERT INTO idempotency_keys (user_id, idempotency_key, operation_id, receipt_number, created_at)
+            VALUES (?, ?, ?, ?, datetime('now', 'localtime'))
+        ''', (user_id, idempotency_key, operation_id, receipt_number))
+
+    # تسجيل النشاط
+    record_activity(
+        conn,
+        user_id,
+        'إضافة عملية',
+        'fuel_operations',
+        operation_id,
+        f'إضافة عملية جديدة برقم السند {receipt_number}',
+        ip_address
+    )
+
+    return receipt_number, quota_warnings, False
+
 @app.route('/api/add-operation', methods=['POST'])
 @login_required
 def add_operation():
-    """إضافة عملية جديدة"""
+    """إضافة عملية جديدة (ترويسة Idempotency-Key اختيارية تمنع التكرار عند إعادة الإرسال)"""
     try:
         data = request.get_json()
 
         if not data:
             return jsonify({'success': False, 'message': 'لا توجد بيانات'}), 400
 
-        conn = get_db_connection()
+        user_id, ip_address = session['user_id'], request.remote_addr
+        idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
 
-        # توليد رقم سند تلقائي
-        last_receipt = conn.execute('SELECT COALESCE(MAX(receipt_number), 1000) FROM fuel_operations').fetchone()[0]
-        receipt_number = last_receipt + 1
+        receipt_number, quota_warnings, duplicate = db_writer.execute(
+            insert_operation, data, user_id, ip_address, idempotency_key
+        )
+        if receipt_number is None:
+            return jsonify({'success': False, 'message': '، '.join(quota_warnings)}), 400
 
-        # استخراج الشهر من التاريخ
-        operation_date = data.get('operation_date', '')
-        month = operation_date[:7] if operation_date else datetime.now().strftime('%Y-%m')[:7]
+        return jsonify({
+            'success': True,
+            'message': 'تم إضافة العملية بنجاح',
+            'receipt_number': receipt_number,
+            'duplicate': duplicate,
+            'warnings': quota_warnings
+        })
 
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO fuel_operations 
-            (operation_date, unit_id, driver_name, vehicle_type, petrol_quantity, 
-             diesel_quantity, operation_officer, receipt_status_id, receipt_number,
-             dispense_type_id, purpose, month, notes, user_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            operation_date,
-            data.get('unit_id'),
-            data.get('driver_name', ''),
-            data.get('vehicle_type', ''),
-            float(data.get('petrol_quantity', 0)),
-            float(data.get('diesel_quantity', 0)),
-            data.get('operation_officer', ''),
-            data.get('receipt_status_id', 1),
-            receipt_number,
-            data.get('dispense_type_id', 1),
-            data.get('purpose', ''),
-            month,
-            data.get('notes', ''),
-            session['user_id']
-        ))
-
-        operation_id = cursor.lastrowid
-
-        # تسجيل النشاط
-        log_activity(
-            session['user_id'],
-            'إضافة عملية',
-            'fuel_operations',
-            operation_id,
-            f'إضافة عملية جديدة برقم السند {receipt_number}'
-        )
+    except WriteBusy:
+        return write_busy_response()
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'خطأ: {str(e)}'
+        }), 500
+
+def sync_token(conn):
+    """رمز المزامنة "updated_at|id": الوقت الحالي ناقص هامش يغطي معاملات بدأت ولم تُودع بعد"""
+    since = conn.execute(
+        "SELECT datetime('now', 'localtime', ?)", (f'-{app.config["SYNC_TOKEN_MARGIN"]} seconds',)
+    ).fetchone()[0]
+    return f'{since}|0'
 
-        conn.commit()
+@app.route('/api/operations/sync', methods=['POST'])
+@login_required
+@role_required('المناوب بالعمليات')
+def operations_sync():
+    """مزامنة العميل دون اتصال: دفعة عمليات بمفاتيح عدم تكرار، ثم التغييرات منذ رمز المزامنة السابق
+
+    الطلب: {operations: [{idempotency_key, ...حقول العملية}], since: رمز}
+    الرد: نتيجة لكل مفتاح (created | duplicate | rejected) ورقم السند، والتغييرات، ورمز جديد.
+    """
+    try:
+        data = request.get_json() or {}
+        operations = data.get('operations') or []
+        if len(operations) > app.config['SYNC_BATCH_LIMIT']:
+            return jsonify({
+                'success': False,
+                'message': f'الحد الأقصى {app.config["SYNC_BATCH_LIMIT"]} عملية في الدفعة'
+            }), 400
+        if any(not operation.get('idempotency_key') for operation in operations):
+            return jsonify({'success': False, 'message': 'كل عملية تحتاج idempotency_key'}), 400
+        since = data.get('since')
+        cursor = repository.parse_sync_token(str(since)) if since else None
+
+        user_id, ip_address = session['user_id'], request.remote_addr
+
+        def apply(conn):
+            # الدفعة كلها في أمر كتابة واحد، وكل عملية في نقطة حفظ حتى لا يُسقط خطؤها بقية الدفعة
+            results = []
+            for operation in operations:
+                key = str(operation['idempotency_key'])
+                conn.execute('SAVEPOINT sync_operation')
+                try:
+                    receipt_number, warnings, duplicate = insert_operation(
+                        conn, operation, user_id, ip_address, key
+                    )
+                except Exception as e:
+                    conn.execute('ROLLBACK TO sync_operation')
+                    conn.execute('RELEASE sync_operation')
+                    results.append({'idempotency_key': key, 'status': 'rejected', 'message': str(e)})
+                    continue
+                conn.execute('RELEASE sync_operation')
+
+                if receipt_number is None:
+                    results.append({'idempotency_key': key, 'status': 'rejected', 'message': '، '.join(warnings)})
+                else:
+                    results.append({
+                        'idempotency_key': key,
+                        'status': 'duplicate' if duplicate else 'created',
+                        'receipt_number': receipt_number,
+                        'warnings': warnings
+                    })
+            return results
+
+        results = db_writer.execute(apply) if operations else []
+
+        # التغييرات بعد مؤشر الرمز السابق؛ عند بلوغ الحد يصبح الرمز مؤشر آخر تغيير مُرسل
+        # (updated_at مع id حتى لا تتكرر الصفحة نفسها إذا تشارك صفوف أكثر من الحد نفس الطابع)
+        conn = get_db_connection()
+        token = sync_token(conn)
+        changes, deleted = [], []
+        if cursor:
+            changes = repository.user_changes(conn, user_id, cursor, app.config['SYNC_CHANGES_LIMIT'])
+            deleted = repository.deleted_operations(conn, user_id, cursor[0])
+            if len(changes) == app.config['SYNC_CHANGES_LIMIT']:
+                token = repository.format_cursor(changes[-1])
         conn.close()
 
         return jsonify({
             'success': True,
-            'message': 'تم إضافة العملية بنجاح',
-            'receipt_number': receipt_number
+            'results': results,
+            'changes': [{
+                'id': operation.id,
+                'receipt_number': operation.receipt_number,
+                'receipt_status_id': operation.receipt_status_id,
+                'status_name': operation.status_name,
+                'updated_at': operation.updated_at
+            } for operation in changes],
+            'deleted': deleted,
+            'token': token
         })
 
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except WriteBusy:
+        return write_busy_response()
     except Exception as e:
         return jsonify({
             'success': False,
-            'message': f'خطأ: {str(e)}'
+            'message': f'خطأ في المزامنة: {str(e)}'
         }), 500
 
 @app.route('/api/delete-operation/<int:operation_id>', methods=['DELETE'])
@@ -1710,37 +2222,55 @@ def add_operation():
 def delete_operation(operation_id):
     """حذف عملية"""
     try:
-        conn = get_db_connection()
+        user_id, ip_address = session['user_id'], request.remote_addr
 
-        # الحصول على بيانات العملية قبل الحذف
-        operation = conn.execute(
-            'SELECT receipt_number FROM fuel_operations WHERE id = ?',
-            (operation_id,)
-        ).fetchone()
+        def apply(conn):
+            # الحصول على بيانات العملية قبل الحذف
+            operation = conn.execute(
+                'SELECT * FROM fuel_operations WHERE id = ?',
+                (operation_id,)
+            ).fetchone()
 
-        if not operation:
-            return jsonify({'success': False, 'message': 'العملية غير موجودة'}), 404
+            if not operation:
+                return 404, 'العملية غير موجودة'
 
-        # حذف العملية
-        conn.execute('DELETE FROM fuel_operations WHERE id = ?', (operation_id,))
+            if is_closed(conn, operation['month']):
+                return 400, closed_message(operation['month'])
 
-        # تسجيل النشاط
-        log_activity(
-            session['user_id'],
-            'حذف عملية',
-            'fuel_operations',
-            operation_id,
-            f'حذف العملية برقم السند {operation["receipt_number"]}'
-        )
+            # حذف العملية وإزالتها من إحصائيات الشذوذ
+            conn.execute('DELETE FROM fuel_operations WHERE id = ?', (operation_id,))
+            anomaly_detector.flag(conn, operation_id, 0, [])
+            if operation['receipt_status_id'] == 1:
+                anomaly_detector.forget(conn, operation)
+                inventory.reverse_operation(conn, operation_id, user_id)
+                receipt_cache.invalidate(operation_id)
+                conn.execute('DELETE FROM receipt_redemptions WHERE operation_id = ?', (operation_id,))
+            quota.post(conn, operation, -1)
 
-        conn.commit()
-        conn.close()
+            # تسجيل النشاط
+            record_activity(
+                conn,
+                user_id,
+                'حذف عملية',
+                'fuel_operations',
+                operation_id,
+                f'حذف العملية برقم السند {operation["receipt_number"]}',
+                ip_address
+            )
+
+            return 200, None
+
+        status, message = db_writer.execute(apply)
+        if status != 200:
+            return jsonify({'success': False, 'message': message}), status
 
         return jsonify({
             'success': True,
             'message': 'تم حذف العملية بنجاح'
         })
 
+    except WriteBusy:
+        return write_busy_response()
     except Exception as e:
         return jsonify({
             'success': False,
@@ -1753,6 +2283,7 @@ def delete_operation(operation_id):
 @app.route('/api/admin/users', methods=['GET', 'POST'])
 @login_required
 @role_required('مدير النظام')
+@conditional.etag('users', 'units')
 def admin_users_api():
     """API لإدارة المستخدمين"""
     try:
@@ -1766,47 +2297,50 @@ def admin_users_api():
                 if field not in data:
                     return jsonify({'success': False, 'message': f'الحقل {field} مطلوب'}), 400
 
-            conn = get_db_connection()
-
-            # التحقق من عدم تكرار اسم المستخدم
-            existing_user = conn.execute(
-                'SELECT id FROM users WHERE username = ?',
-                (data['username'],)
-            ).fetchone()
-
-            if existing_user:
-                conn.close()
-                return jsonify({'success': False, 'message': 'اسم المستخدم موجود مسبقاً'}), 400
-
-            # تشفير كلمة المرور
+            # تشفير كلمة المرور (خارج أمر الكتابة حتى لا يشغل الكاتب)
             hashed_password = bcrypt.generate_password_hash(data['password']).decode('utf-8')
-
-            # إدخال المستخدم الجديد
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO users (name, username, password, role, unit_id, is_active)
-                VALUES (?, ?, ?, ?, ?, 1)
-            ''', (
-                data['name'],
-                data['username'],
-                hashed_password,
-                data['role'],
-                data.get('unit_id') or None
-            ))
-
-            user_id = cursor.lastrowid
-
-            # تسجيل النشاط
-            log_activity(
-                session['user_id'],
-                'إضافة مستخدم',
-                'users',
-                user_id,
-                f'إضافة مستخدم جديد: {data["name"]} ({data["role"]})'
-            )
-
-            conn.commit()
-            conn.close()
+            actor_id, ip_address = session['user_id'], request.remote_addr
+
+            def apply(conn):
+                # التحقق من عدم تكرار اسم المستخدم
+                existing_user = conn.execute(
+                    'SELECT id FROM users WHERE username = ?',
+                    (data['username'],)
+                ).fetchone()
+
+                if existing_user:
+                    return None
+
+                # إدخال المستخدم الجديد
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO users (name, username, password, role, unit_id, is_active)
+                    VALUES (?, ?, ?, ?, ?, 1)
+                ''', (
+                    data['name'],
+                    data['username'],
+                    hashed_password,
+                    data['role'],
+                    data.get('unit_id') or None
+                ))
+
+                user_id = cursor.lastrowid
+
+                # تسجيل النشاط
+                record_activity(
+                    conn,
+                    actor_id,
+                    'إضافة مستخدم',
+                    'users',
+                    user_id,
+                    f'إضافة مستخدم جديد: {data["name"]} ({data["role"]})',
+                    ip_address
+                )
+
+                return user_id
+
+            if db_writer.execute(apply) is None:
+                return jsonify({'success': False, 'message': 'اسم المستخدم موجود مسبقاً'}), 400
 
             return jsonify({
                 'success': True,
@@ -1829,6 +2363,8 @@ def admin_users_api():
                 'users': [dict(user) for user in users]
             })
 
+    except WriteBusy:
+        return write_busy_response()
     except Exception as e:
         return jsonify({
             'success': False,
@@ -1842,10 +2378,11 @@ def admin_users_api():
 def admin_user_api(user_id):
     """API لإدارة مستخدم محدد"""
     try:
-        conn = get_db_connection()
+        actor_id, ip_address = session['user_id'], request.remote_addr
 
         if request.method == 'GET':
             # الحصول على بيانات مستخدم
+            conn = get_db_connection()
             user = conn.execute('''
                 SELECT u.*, un.name as unit_name 
                 FROM users u 
@@ -1874,46 +2411,49 @@ def admin_user_api(user_id):
             required_fields = ['name', 'username', 'role']
             for field in required_fields:
                 if field not in data:
-                    conn.close()
                     return jsonify({'success': False, 'message': f'الحقل {field} مطلوب'}), 400
 
-            # التحقق من عدم تكرار اسم المستخدم (باستثناء نفس المستخدم)
-            existing_user = conn.execute(
-                'SELECT id FROM users WHERE username = ? AND id != ?',
-                (data['username'], user_id)
-            ).fetchone()
-
-            if existing_user:
-                conn.close()
+            def apply(conn):
+                # التحقق من عدم تكرار اسم المستخدم (باستثناء نفس المستخدم)
+                existing_user = conn.execute(
+                    'SELECT id FROM users WHERE username = ? AND id != ?',
+                    (data['username'], user_id)
+                ).fetchone()
+
+                if existing_user:
+                    return False
+
+                # تحديث البيانات
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE users 
+                    SET name = ?, username = ?, role = ?, unit_id = ?, is_active = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (
+                    data['name'],
+                    data['username'],
+                    data['role'],
+                    data.get('unit_id') or None,
+                    data.get('is_active', 1),
+                    user_id
+                ))
+
+                # تسجيل النشاط
+                record_activity(
+                    conn,
+                    actor_id,
+                    'تعديل مستخدم',
+                    'users',
+                    user_id,
+                    f'تعديل بيانات المستخدم ID: {user_id}',
+                    ip_address
+                )
+
+                return True
+
+            if not db_writer.execute(apply):
                 return jsonify({'success': False, 'message': 'اسم المستخدم موجود مسبقاً'}), 400
 
-            # تحديث البيانات
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE users 
-                SET name = ?, username = ?, role = ?, unit_id = ?, is_active = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (
-                data['name'],
-                data['username'],
-                data['role'],
-                data.get('unit_id') or None,
-                data.get('is_active', 1),
-                user_id
-            ))
-
-            # تسجيل النشاط
-            log_activity(
-                session['user_id'],
-                'تعديل مستخدم',
-                'users',
-                user_id,
-                f'تعديل بيانات المستخدم ID: {user_id}'
-            )
-
-            conn.commit()
-            conn.close()
-
             return jsonify({
                 'success': True,
                 'message': 'تم تحديث بيانات المستخدم بنجاح'
@@ -1922,41 +2462,46 @@ def admin_user_api(user_id):
         elif request.method == 'DELETE':
             # حذف مستخدم
             # لا يمكن حذف المستخدم الحالي
-            if user_id == session['user_id']:
-                conn.close()
+            if user_id == actor_id:
                 return jsonify({
                     'success': False,
                     'message': 'لا يمكن حذف حسابك الخاص'
                 }), 400
 
-            # الحصول على بيانات المستخدم قبل الحذف
-            user = conn.execute('SELECT name FROM users WHERE id = ?', (user_id,)).fetchone()
+            def apply(conn):
+                # الحصول على بيانات المستخدم قبل الحذف
+                user = conn.execute('SELECT name FROM users WHERE id = ?', (user_id,)).fetchone()
 
-            if not user:
-                conn.close()
-                return jsonify({'success': False, 'message': 'المستخدم غير موجود'}), 404
+                if not user:
+                    return False
 
-            # حذف المستخدم
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
+                # حذف المستخدم
+                cursor = conn.cursor()
+                cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
 
-            # تسجيل النشاط
-            log_activity(
-                session['user_id'],
-                'حذف مستخدم',
-                'users',
-                user_id,
-                f'حذف المستخدم: {user["name"]}'
-            )
+                # تسجيل النشاط
+                record_activity(
+                    conn,
+                    actor_id,
+                    'حذف مستخدم',
+                    'users',
+                    user_id,
+                    f'حذف المستخدم: {user["name"]}',
+                    ip_address
+                )
 
-            conn.commit()
-            conn.close()
+                return True
+
+            if not db_writer.execute(apply):
+                return jsonify({'success': False, 'message': 'المستخدم غير موجود'}), 404
 
             return jsonify({
                 'success': True,
                 'message': 'تم حذف المستخدم بنجاح'
             })
 
+    except WriteBusy:
+        return write_busy_response()
     except Exception as e:
         return jsonify({
             'success': False,
@@ -1978,36 +2523,39 @@ def admin_change_password_api(user_id):
         if len(data['new_password']) < 6:
             return jsonify({'success': False, 'message': 'كلمة المرور يجب أن تكون 6 أحرف على الأقل'}), 400
 
-        conn = get_db_connection()
-
         # تشفير كلمة المرور الجديدة
         hashed_password = bcrypt.generate_password_hash(data['new_password']).decode('utf-8')
+        actor_id, ip_address = session['user_id'], request.remote_addr
 
-        # تحديث كلمة المرور
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE users 
-            SET password = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (hashed_password, user_id))
+        def apply(conn):
+            # تحديث كلمة المرور
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE users 
+                SET password = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (hashed_password, user_id))
 
-        # تسجيل النشاط
-        log_activity(
-            session['user_id'],
-            'تغيير كلمة المرور',
-            'users',
-            user_id,
-            'تغيير كلمة مرور المستخدم'
-        )
+            # تسجيل النشاط
+            record_activity(
+                conn,
+                actor_id,
+                'تغيير كلمة المرور',
+                'users',
+                user_id,
+                'تغيير كلمة مرور المستخدم',
+                ip_address
+            )
 
-        conn.commit()
-        conn.close()
+        db_writer.execute(apply)
 
         return jsonify({
             'success': True,
             'message': 'تم تغيير كلمة المرور بنجاح'
         })
 
+    except WriteBusy:
+        return write_busy_response()
     except Exception as e:
         return jsonify({
             'success': False,
@@ -2026,42 +2574,45 @@ def admin_toggle_status_api(user_id):
         if 'is_active' not in data:
             return jsonify({'success': False, 'message': 'حالة المستخدم مطلوبة'}), 400
 
-        conn = get_db_connection()
-
         # لا يمكن تعطيل المستخدم الحالي
         if user_id == session['user_id'] and data['is_active'] == 0:
-            conn.close()
             return jsonify({
                 'success': False,
                 'message': 'لا يمكن تعطيل حسابك الخاص'
             }), 400
 
-        # تحديث حالة المستخدم
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE users 
-            SET is_active = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (data['is_active'], user_id))
-
-        # تسجيل النشاط
+        actor_id, ip_address = session['user_id'], request.remote_addr
         action = 'تفعيل مستخدم' if data['is_active'] else 'تعطيل مستخدم'
-        log_activity(
-            session['user_id'],
-            action,
-            'users',
-            user_id,
-            f'{action} ID: {user_id}'
-        )
 
-        conn.commit()
-        conn.close()
+        def apply(conn):
+            # تحديث حالة المستخدم
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE users 
+                SET is_active = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (data['is_active'], user_id))
+
+            # تسجيل النشاط
+            record_activity(
+                conn,
+                actor_id,
+                action,
+                'users',
+                user_id,
+                f'{action} ID: {user_id}',
+                ip_address
+            )
+
+        db_writer.execute(apply)
 
         return jsonify({
             'success': True,
             'message': f'تم {"تفعيل" if data["is_active"] else "تعطيل"} المستخدم بنجاح'
         })
 
+    except WriteBusy:
+        return write_busy_response()
     except Exception as e:
         return jsonify({
             'success': False,
@@ -2069,6 +2620,140 @@ def admin_toggle_status_api(user_id):
         }), 500
 
 
+@app.route('/api/admin/activity-logs')
+@login_required
+@role_required('مدير النظام')
+@admission.limit('report', on_shed=shed_response)
+def admin_activity_logs_api():
+    """البحث في سجل الأنشطة (يشمل الأرشيف الشهري عند الحاجة)"""
+    try:
+        conn = get_db_connection()
+        logs = query_activity_logs(
+            conn,
+            date_from=request.args.get('from') or None,
+            date_to=request.args.get('to') or None,
+            user_id=request.args.get('user_id', type=int),
+            table_name=request.args.get('table_name') or None,
+            record_id=request.args.get('record_id', type=int),
+            action=request.args.get('action') or None,
+            limit=min(request.args.get('limit', 200, type=int), 1000),
+            archive_dir=app.config['ARCHIVE_DIR']
+        )
+        conn.close()
+
+        return jsonify({
+            'success': True,
+            'logs': logs
+        })
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'خطأ في البحث في سجل الأنشطة: {str(e)}'
+        }), 500
+
+
+# ============================================
+# مهام الخلفية (تقارير وتصدير)
+# ============================================
+
+def submit_job(kind, params):
+    """إرسال مهمة والرد فوراً برقمها ورابط متابعتها (202)"""
+    conn = get_db_connection()
+    try:
+        job_id, status, reused = job_queue.submit(conn, kind, params, session['user_id'])
+    finally:
+        conn.close()
+
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status': status,
+        'reused': reused,
+        'status_url': url_for('job_status_api', job_id=job_id)
+    }), 202
+
+@app.route('/api/jobs', methods=['POST'])
+@login_required
+@role_required('مدير النظام')
+def jobs_api():
+    """إرسال مهمة تقرير أو تصدير"""
+    try:
+        data = request.get_json() or {}
+        return submit_job(data.get('kind'), data.get('params') or {})
+
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    except WriteBusy:
+        return write_busy_response()
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'خطأ في إرسال المهمة: {str(e)}'
+        }), 500
+
+@app.route('/api/jobs/<job_id>')
+@login_required
+@role_required('مدير النظام')
+def job_status_api(job_id):
+    """حالة المهمة وتقدمها، ورابط التنزيل عند اكتمالها"""
+    conn = get_db_connection()
+    job = job_status(conn, job_id)
+    conn.close()
+
+    if not job:
+        return jsonify({'success': False, 'message': 'المهمة غير موجودة'}), 404
+
+    artifact = job.pop('artifact')
+    if job['status'] == 'done' and artifact:
+        job['download_url'] = url_for('job_download', job_id=job_id)
+        job['filename'] = artifact['filename']
+
+    return jsonify({'success': True, 'job': job})
+
+@app.route('/api/jobs/<job_id>/download')
+@login_required
+@role_required('مدير النظام')
+def job_download(job_id):
+    """تنزيل ناتج المهمة"""
+    conn = get_db_connection()
+    job = job_status(conn, job_id)
+    conn.close()
+
+    if not job or job['status'] != 'done' or not job['artifact'] or not os.path.exists(job['artifact']['path']):
+        return jsonify({'success': False, 'message': 'ناتج المهمة غير متاح (انتهت صلاحيته أو لم تكتمل)'}), 404
+
+    artifact = job['artifact']
+    return send_file(
+        artifact['path'],
+        mimetype=artifact['content_type'],
+        as_attachment=True,
+        download_name=artifact['filename']
+    )
+
+
+@app.route('/api/admin/cache-stats')
+@login_required
+@role_required('مدير النظام')
+def admin_cache_stats_api():
+    """إحصائيات التخزين المؤقت لأجزاء القوالب في العامل الحالي"""
+    return jsonify({
+        'success': True,
+        'fragment_cache': fragment_cache.stats(),
+        'receipt_cache': receipt_cache.stats(),
+        'writer': db_writer.stats(),
+        'snapshot': snapshot_store.stats(),
+        'jobs': job_queue.stats(),
+        'singleflight': flight.stats(),
+        'admission': admission.stats(),
+        'autocomplete': master_data.autocomplete.stats(),
+        'month_archive': month_archive.stats(),
+        'columnar': columnar_archive.stats(),
+        'compression': compressor.stats(),
+        'conditional': conditional.stats()
+    })
 
 
 # ============================================
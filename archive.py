@@ -0,0 +1,338 @@
+"""
+archive.py - أرشفة سجل الأنشطة في ملفات شهرية منفصلة
+"""
+import os
+import re
+import sys
+import sqlite3
+from datetime import datetime, timedelta
+
+from writer import BusyRetry, default_lock_path, locked_transaction
+
+ARCHIVE_DIR = 'archive'
+
+# عدد المعرفات في كل معاملة نقل (القفل يُحرر بين الدفعات فتمر كتابات الويب)
+MOVE_BATCH = 2000
+
+ACTIVITY_COLUMNS = 'id, user_id, action, table_name, record_id, details, ip_address, created_at'
+
+_ARCHIVE_FILE = re.compile(r'^activity_logs_(\d{4}-\d{2})\.db$')
+
+# آخر صرف وآخر تعديل لكل عملية محفوظان في operation_audit (لا تفرغ بعد أرشفة السجل):
+# الإجراء ← أعمدة (الوقت، المستخدم، التفاصيل)
+AUDIT_ACTIONS = {
+    'تعديل حالة السند': ('dispensed_at', 'dispensed_by', 'dispense_notes'),
+    'تعديل عملية': ('last_updated_at', 'last_updated_by', None),
+}
+
+
+def _audit_upsert(at_column, columns):
+    """ON CONFLICT يحدّث سطر العملية فقط إذا لم يكن المحفوظ أحدث"""
+    return f'''
+        ON CONFLICT(operation_id) DO UPDATE SET
+            {', '.join(f'{column} = excluded.{column}' for column in columns)}
+        WHERE operation_audit.{at_column} IS NULL OR excluded.{at_column} >= operation_audit.{at_column}'''
+
+
+def audit_statements(schema='main'):
+    """تحديث operation_audit من آخر إدخال لكل عملية في {schema}.activity_logs (لا يستبدل الأحدث منه)"""
+    statements = []
+    for action, (at_column, by_column, details_column) in AUDIT_ACTIONS.items():
+        columns = [at_column, by_column] + ([details_column] if details_column else [])
+        values = ['created_at', 'user_id'] + (['details'] if details_column else [])
+        statements.append(f'''
+            INSERT INTO main.operation_audit (operation_id, {', '.join(columns)})
+            SELECT record_id, {', '.join(values)}
+            FROM (
+                SELECT record_id, created_at, user_id, details,
+                       ROW_NUMBER() OVER (PARTITION BY record_id ORDER BY created_at DESC, id DESC) AS rank
+                FROM {schema}.activity_logs
+                WHERE table_name = 'fuel_operations' AND action = '{action}' AND record_id IS NOT NULL
+            )
+            WHERE rank = 1
+            {_audit_upsert(at_column, columns)}
+        ''')
+    return statements
+
+
+def audit_trigger_statements():
+    """مشغلات تُبقي operation_audit محدّثاً مع كل إدخال في السجل، وتحذف سطر العملية المحذوفة"""
+    statements = []
+    for action, (at_column, by_column, details_column) in AUDIT_ACTIONS.items():
+        columns = [at_column, by_column] + ([details_column] if details_column else [])
+        values = ['NEW.created_at', 'NEW.user_id'] + (['NEW.details'] if details_column else [])
+        statements.append(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_activity_logs_audit_{at_column}
+            AFTER INSERT ON activity_logs
+            WHEN NEW.table_name = 'fuel_operations' AND NEW.action = '{action}' AND NEW.record_id IS NOT NULL
+            BEGIN
+                INSERT INTO operation_audit (operation_id, {', '.join(columns)})
+                VALUES (NEW.record_id, {', '.join(values)})
+                {_audit_upsert(at_column, columns)};
+            END
+        ''')
+    statements.append('''
+        CREATE TRIGGER IF NOT EXISTS trg_fuel_operations_audit_delete
+        AFTER DELETE ON fuel_operations
+        BEGIN
+            DELETE FROM operation_audit WHERE operation_id = OLD.id;
+        END
+    ''')
+    return statements
+
+
+def _shift_month(month, delta):
+    """إزاحة شهر بصيغة YYYY-MM بعدد من الأشهر"""
+    year, mon = map(int, month.split('-'))
+    index = year * 12 + (mon - 1) + delta
+    return f'{index // 12:04d}-{index % 12 + 1:02d}'
+
+
+def _month_bounds(month):
+    """بداية الشهر وبداية الشهر التالي (للمقارنة النصية على created_at)"""
+    return f'{month}-01', f'{_shift_month(month, 1)}-01'
+
+
+def archive_path(month, archive_dir=ARCHIVE_DIR):
+    """مسار ملف أرشيف شهر معين"""
+    return os.path.join(archive_dir, f'activity_logs_{month}.db')
+
+
+def archived_months(archive_dir=ARCHIVE_DIR):
+    """قائمة الأشهر المؤرشفة مرتبة تصاعدياً"""
+    if not os.path.isdir(archive_dir):
+        return []
+    months = []
+    for name in os.listdir(archive_dir):
+        match = _ARCHIVE_FILE.match(name)
+        if match:
+            months.append(match.group(1))
+    return sorted(months)
+
+
+def backfill_operation_audit(conn, archive_dir=ARCHIVE_DIR):
+    """operation_audit من ملفات الأرشيف التي سبقت إضافته (مرة واحدة؛ ما بعدها تلتقطه المشغلات قبل النقل)"""
+    if conn.execute("SELECT 1 FROM schema_migrations WHERE name = 'operation_audit_from_archives'").fetchone():
+        return
+    conn.commit()
+    for month in archived_months(archive_dir):
+        conn.execute('ATTACH DATABASE ? AS arch', (archive_path(month, archive_dir),))
+        try:
+            for statement in audit_statements('arch'):
+                conn.execute(statement)
+            conn.commit()
+        finally:
+            conn.execute('DETACH DATABASE arch')
+    conn.execute("INSERT INTO schema_migrations (name) VALUES ('operation_audit_from_archives')")
+    conn.commit()
+
+
+def archive_closed_months(conn, keep_months=3, archive_dir=ARCHIVE_DIR, now=None,
+                          lock_path=None, retry=None, batch_size=MOVE_BATCH):
+    """نقل الأشهر المغلقة من activity_logs إلى ملفات الأرشيف الشهرية
+
+    يبقى في الجدول الحي الشهر الحالي و keep_months من الأشهر السابقة. النقل بدفعات معرفات
+    محدودة، كل دفعة في معاملة BEGIN IMMEDIATE تحت قفل ملف الكاتب (locked_transaction).
+    """
+    lock_path = lock_path or default_lock_path(conn)
+    retry = retry or BusyRetry()
+    os.makedirs(archive_dir, exist_ok=True)
+    backfill_operation_audit(conn, archive_dir)
+
+    current_month = (now or datetime.now()).strftime('%Y-%m')
+    cutoff = f'{_shift_month(current_month, -keep_months)}-01'
+
+    months = [row[0] for row in conn.execute('''
+        SELECT DISTINCT substr(created_at, 1, 7)
+        FROM activity_logs
+        WHERE created_at < ?
+        ORDER BY 1
+    ''', (cutoff,)).fetchall()]
+
+    archived = {}
+    for month in months:
+        start, end = _month_bounds(month)
+
+        # لا يمكن إرفاق قاعدة بيانات داخل معاملة مفتوحة
+        conn.commit()
+        conn.execute('ATTACH DATABASE ? AS arch', (archive_path(month, archive_dir),))
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS arch.activity_logs (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    action TEXT NOT NULL,
+                    table_name TEXT,
+                    record_id INTEGER,
+                    details TEXT,
+                    ip_address TEXT,
+                    created_at TIMESTAMP
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS arch.idx_logs_created ON activity_logs(created_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS arch.idx_logs_record ON activity_logs(table_name, record_id)')
+            conn.commit()
+
+            first, last = conn.execute(
+                'SELECT MIN(id), MAX(id) FROM main.activity_logs WHERE created_at >= ? AND created_at < ?',
+                (start, end)
+            ).fetchone()
+            archived[month] = 0
+            low = first
+            while low is not None and low <= last:
+                high = low + batch_size
+                # النسخ والحذف لكل دفعة في معاملة واحدة (INSERT OR IGNORE يجعل الإعادة آمنة)
+                with locked_transaction(conn, lock_path, retry):
+                    conn.execute(f'''
+                        INSERT OR IGNORE INTO arch.activity_logs ({ACTIVITY_COLUMNS})
+                        SELECT {ACTIVITY_COLUMNS} FROM main.activity_logs
+                        WHERE id >= ? AND id < ? AND created_at >= ? AND created_at < ?
+                    ''', (low, high, start, end))
+                    cursor = conn.execute(
+                        'DELETE FROM main.activity_logs WHERE id >= ? AND id < ? AND created_at >= ? AND created_at < ?',
+                        (low, high, start, end)
+                    )
+                    archived[month] += cursor.rowcount
+                low = high
+        finally:
+            conn.execute('DETACH DATABASE arch')
+
+    return archived
+
+
+def query_activity_logs(conn, date_from=None, date_to=None, user_id=None, table_name=None,
+                        record_id=None, action=None, limit=200, archive_dir=ARCHIVE_DIR):
+    """البحث في سجل الأنشطة مع دمج الأرشيف الشهري عند الحاجة
+
+    date_from و date_to بصيغة YYYY-MM-DD (شاملة).
+    """
+    conditions = []
+    params = []
+
+    if date_from:
+        conditions.append('a.created_at >= ?')
+        params.append(date_from)
+    if date_to:
+        conditions.append('a.created_at < ?')
+        day_after = datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)
+        params.append(day_after.strftime('%Y-%m-%d'))
+    if user_id:
+        conditions.append('a.user_id = ?')
+        params.append(user_id)
+    if table_name:
+        conditions.append('a.table_name = ?')
+        params.append(table_name)
+    if record_id:
+        conditions.append('a.record_id = ?')
+        params.append(record_id)
+    if action:
+        conditions.append('a.action = ?')
+        params.append(action)
+
+    where = ' AND '.join(conditions) if conditions else '1=1'
+    query = f'''
+        SELECT a.*, u.name as user_name
+        FROM {{schema}}.activity_logs a
+        LEFT JOIN main.users u ON a.user_id = u.id
+        WHERE {where}
+        ORDER BY a.created_at DESC, a.id DESC
+        LIMIT ?
+    '''
+    params.append(limit)
+
+    logs = [dict(row) for row in conn.execute(query.format(schema='main'), params).fetchall()]
+
+    # الأشهر المؤرشفة التي يتقاطع معها النطاق المطلوب
+    first_month = date_from[:7] if date_from else None
+    last_month = date_to[:7] if date_to else None
+    months = [
+        month for month in archived_months(archive_dir)
+        if (first_month is None or month >= first_month)
+        and (last_month is None or month <= last_month)
+    ]
+
+    if months:
+        conn.commit()
+        for month in reversed(months):
+            conn.execute('ATTACH DATABASE ? AS arch', (archive_path(month, archive_dir),))
+            try:
+                rows = conn.execute(query.format(schema='arch'), params).fetchall()
+            finally:
+                conn.execute('DETACH DATABASE arch')
+            logs.extend(dict(row) for row in rows)
+
+        logs.sort(key=lambda log: (log['created_at'] or '', log['id']), reverse=True)
+        logs = logs[:limit]
+
+    return logs
+
+
+def check():
+    """أرشفة شهر في نسخة مؤقتة من القاعدة ثم التأكد من بقاء آخر صرف وآخر تعديل للعملية (True عند النجاح)"""
+    import shutil
+    import tempfile
+
+    import repository
+    from database import upgrade_database
+
+    work_dir = tempfile.mkdtemp(prefix='archive-check-')
+    try:
+        db_path = os.path.join(work_dir, 'database.db')
+        shutil.copy('database.db', db_path)
+        upgrade_database(db_path)
+        conn = sqlite3.connect(db_path)
+
+        user_id, user_name = conn.execute('SELECT id, name FROM users ORDER BY id LIMIT 1').fetchone()
+        operation_id = conn.execute('''
+            INSERT INTO fuel_operations (operation_date, unit_id, driver_name, vehicle_type, petrol_quantity,
+                                         receipt_status_id, receipt_number, dispense_type_id, month, user_id,
+                                         created_at, updated_at)
+            VALUES (date('now', 'localtime'), 1, 'فحص الأرشفة', 'تجربة', 20, 1,
+                    (SELECT COALESCE(MAX(receipt_number), 0) + 1 FROM fuel_operations), 1,
+                    strftime('%Y-%m', 'now', 'localtime'), ?, datetime('now', 'localtime'), datetime('now', 'localtime'))
+        ''', (user_id,)).lastrowid
+        for action, details, created_at in (('تعديل عملية', 'تعديل', '2020-01-15 09:00:00'),
+                                            ('تعديل حالة السند', 'ملاحظة الصرف', '2020-01-16 10:00:00')):
+            conn.execute(f'''
+                INSERT INTO activity_logs ({ACTIVITY_COLUMNS})
+                VALUES (NULL, ?, ?, 'fuel_operations', ?, ?, '127.0.0.1', ?)
+            ''', (user_id, action, operation_id, details, created_at))
+        conn.commit()
+
+        archived = archive_closed_months(conn, archive_dir=os.path.join(work_dir, 'archive'))
+        live = conn.execute('SELECT COUNT(*) FROM activity_logs WHERE record_id = ? AND table_name = ?',
+                            (operation_id, 'fuel_operations')).fetchone()[0]
+        operation = repository.get_operation(conn, operation_id)
+        conn.close()
+
+        expected = {
+            'dispensed_at': '2020-01-16 10:00:00',
+            'dispensed_by': user_name,
+            'dispense_notes': 'ملاحظة الصرف',
+            'last_updated_at': '2020-01-15 09:00:00',
+            'last_updater': user_name,
+        }
+        actual = {field: operation[field] for field in expected}
+        ok = '2020-01' in archived and live == 0 and actual == expected
+        print(f"{'✅' if ok else '❌'} أُرشف {archived.get('2020-01', 0)} نشاط من 2020-01؛ بيانات العملية بعد الأرشفة: {actual}")
+        return ok
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--check':
+        sys.exit(0 if check() else 1)
+
+    keep = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+
+    # بلا مهلة انشغال داخلية: الانتظار عبر BusyRetry كما في الكاتب
+    conn = sqlite3.connect('database.db', isolation_level=None, timeout=0)
+    result = archive_closed_months(conn, keep_months=keep)
+    conn.close()
+
+    if result:
+        for month, count in result.items():
+            print(f"📦 {month}: تم أرشفة {count} نشاط")
+    else:
+        print("✅ لا توجد أشهر مغلقة للأرشفة")
@@ -0,0 +1,231 @@
+"""
+columnar.py - أرشيف عمودي للأشهر المغلقة: ملف .npy لكل عمود وقاموس للأعمدة النصية، يُفتح بتعيين الذاكرة
+"""
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from analytics import AnalyticsEngine, DICTIONARY_COLUMNS, ROW_QUERY
+
+# أعمدة الأرشيف (نفس أعمدة محرك التحليلات مع المعرف)
+COLUMNS = ('id', 'day', 'month', 'unit_id', 'dispense_type_id', 'status_id', 'driver', 'vehicle', 'petrol', 'diesel')
+
+DICTIONARY_FILE = 'dictionary.json'
+
+
+def columns_path(month, month_dir):
+    return os.path.join(month_dir, f'fuel_operations_{month}.columns')
+
+
+def write_month(conn, month, month_dir):
+    """كتابة أعمدة عمليات الشهر (مرتبة بالمعرف) في مجلده: عدد الصفوف
+
+    يُكتب المجلد باسم مؤقت ثم يُعاد تسميته فلا يرى القارئ شهراً نصف مكتوب.
+    """
+    rows = conn.execute(f'{ROW_QUERY} WHERE month = ? ORDER BY id', (month,)).fetchall()
+    encoder = AnalyticsEngine()
+    ids, columns = encoder.to_arrays(rows)
+    columns['id'] = ids
+    dictionary = {'driver': encoder.driver_names, 'vehicle': encoder.vehicle_names}
+
+    os.makedirs(month_dir, exist_ok=True)
+    path = columns_path(month, month_dir)
+    staging = tempfile.mkdtemp(prefix=f'.{os.path.basename(path)}.', dir=month_dir)
+    try:
+        for name in COLUMNS:
+            np.save(os.path.join(staging, f'{name}.npy'), np.ascontiguousarray(columns[name]))
+        with open(os.path.join(staging, DICTIONARY_FILE), 'w', encoding='utf-8') as f:
+            json.dump(dictionary, f, ensure_ascii=False)
+        remove_month(month, month_dir)
+        os.rename(staging, path)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    return len(ids)
+
+
+def remove_month(month, month_dir):
+    shutil.rmtree(columns_path(month, month_dir), ignore_errors=True)
+
+
+class ColumnarArchive:
+    """أعمدة الأشهر المؤرشفة معيَّنة في الذاكرة (np.load بـ mmap_mode)؛ يُفتح كل عمود عند أول طلب له فقط
+
+    المصفوفات للقراءة فقط ويتشاركها العمال عبر ذاكرة التخزين المؤقت لنظام التشغيل.
+    """
+
+    def __init__(self, month_dir):
+        self.month_dir = month_dir
+        self._lock = threading.Lock()
+        self._columns = {}
+        self._dictionaries = {}
+        self.opens = 0
+        self.hits = 0
+
+    def months(self):
+        """الأشهر التي لها مجلد أعمدة مكتمل"""
+        try:
+            entries = os.listdir(self.month_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(entry[len('fuel_operations_'):-len('.columns')] for entry in entries
+                      if entry.startswith('fuel_operations_') and entry.endswith('.columns'))
+
+    def _signature(self, month):
+        """هوية مجلد الشهر: إعادة الإغلاق تنشئ مجلداً جديداً فتسقط المصفوفات القديمة"""
+        stat = os.stat(columns_path(month, self.month_dir))
+        return stat.st_ino, stat.st_mtime_ns
+
+    def column(self, month, name):
+        """عمود شهر مؤرشف (numpy.memmap للقراءة فقط)"""
+        signature = self._signature(month)
+        with self._lock:
+            cached = self._columns.get((month, name))
+            if cached and cached[0] == signature:
+                self.hits += 1
+                return cached[1]
+
+        values = np.load(os.path.join(columns_path(month, self.month_dir), f'{name}.npy'), mmap_mode='r')
+        with self._lock:
+            self._columns[(month, name)] = (signature, values)
+            self.opens += 1
+        return values
+
+    def dictionary(self, month):
+        """قواميس الأعمدة النصية للشهر: {العمود: [النص لكل رمز]}"""
+        signature = self._signature(month)
+        with self._lock:
+            cached = self._dictionaries.get(month)
+            if cached and cached[0] == signature:
+                return cached[1]
+
+        with open(os.path.join(columns_path(month, self.month_dir), DICTIONARY_FILE), encoding='utf-8') as f:
+            dictionary = json.load(f)
+        dictionary = {name: tuple(dictionary[name]) for name in DICTIONARY_COLUMNS}
+        with self._lock:
+            self._dictionaries[month] = (signature, dictionary)
+        return dictionary
+
+    def stats(self):
+        with self._lock:
+            mapped = sum(values.nbytes for _, values in self._columns.values())
+            return {
+                'months': len(self.months()),
+                'open_columns': len(self._columns),
+                'mapped_bytes': mapped,
+                'opens': self.opens,
+                'hits': self.hits
+            }
+
+
+# ============================================
+# قياس الأداء
+# ============================================
+
+def _benchmark_db(path, rows, months):
+    """قاعدة مؤقتة بجدول عمليات اصطناعي موزع على الأشهر (الأعمدة التي يقرؤها التقرير وما يشبه بقيتها)"""
+    rng = np.random.default_rng(7)
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE fuel_operations (
+            id INTEGER PRIMARY KEY, operation_date DATE, operation_day INTEGER, month TEXT,
+            unit_id INTEGER, dispense_type_id INTEGER, receipt_status_id INTEGER,
+            driver_name TEXT, vehicle_type TEXT, purpose TEXT, notes TEXT,
+            petrol_quantity REAL, diesel_quantity REAL, created_at TIMESTAMP, updated_at TIMESTAMP
+        )
+    ''')
+    start_day = int(np.datetime64('2024-01-01', 'D').astype(np.int64))
+    days = np.sort(rng.integers(0, months * 30, rows)) + start_day
+    drivers = [f'سائق {i}' for i in range(400)]
+    batch = []
+    for i, day in enumerate(days, 1):
+        date = str(np.datetime64(int(day), 'D'))
+        batch.append((
+            i, date, int(day), date[:7], int(rng.integers(1, 12)), int(rng.integers(1, 4)), int(rng.integers(1, 3)),
+            drivers[int(rng.integers(0, len(drivers)))], 'باص', 'مهمة رسمية', '',
+            float(rng.integers(0, 80)), float(rng.integers(0, 120)), f'{date} 08:00:00', f'{date} 08:00:00'
+        ))
+        if len(batch) == 10000:
+            conn.executemany('INSERT INTO fuel_operations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+            batch = []
+    if batch:
+        conn.executemany('INSERT INTO fuel_operations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+    conn.execute('CREATE INDEX idx_benchmark_month ON fuel_operations(month)')
+    conn.commit()
+    return conn
+
+
+def benchmark(rows=500000, months=24):
+    """إجمالي البنزين والديزل لكل وحدة عبر كل الأشهر: مسح SQLite، تحميل الصفوف إلى NumPy، والأعمدة المعيَّنة"""
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'benchmark.db')
+        month_dir = os.path.join(directory, 'months')
+        conn = _benchmark_db(db_path, rows, months)
+        closed = [row[0] for row in conn.execute('SELECT DISTINCT month FROM fuel_operations ORDER BY month')]
+        for month in closed:
+            write_month(conn, month, month_dir)
+
+        start = time.perf_counter()
+        expected = conn.execute('''
+            SELECT unit_id, SUM(petrol_quantity), SUM(diesel_quantity)
+            FROM fuel_operations GROUP BY unit_id ORDER BY unit_id
+        ''').fetchall()
+        scan_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        AnalyticsEngine().to_arrays(conn.execute(f'{ROW_QUERY} ORDER BY id').fetchall())
+        load_ms = (time.perf_counter() - start) * 1000
+        conn.close()
+
+        def aggregate(archive):
+            petrol = diesel = 0
+            for month in archive.months():
+                units = archive.column(month, 'unit_id')
+                petrol = petrol + np.bincount(units, weights=archive.column(month, 'petrol'), minlength=12)
+                diesel = diesel + np.bincount(units, weights=archive.column(month, 'diesel'), minlength=12)
+            return petrol, diesel
+
+        archive = ColumnarArchive(month_dir)
+        start = time.perf_counter()
+        petrol, diesel = aggregate(archive)
+        first_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        aggregate(archive)
+        warm_ms = (time.perf_counter() - start) * 1000
+
+        for unit, petrol_sum, diesel_sum in expected:
+            assert abs(petrol[unit] - petrol_sum) < 1e-6 and abs(diesel[unit] - diesel_sum) < 1e-6
+
+        db_bytes = os.path.getsize(db_path)
+        read_bytes = archive.stats()['mapped_bytes']
+        print(f'📦 {rows} عملية في {len(closed)} شهراً: قاعدة {db_bytes / 1e6:.1f} م.ب، '
+              f'الأعمدة المقروءة {read_bytes / 1e6:.1f} م.ب (unit_id وpetrol وdiesel)')
+        print(f'🐢 SQLite GROUP BY على الجدول: {scan_ms:.1f} مللي ثانية')
+        print(f'🐢 تحميل الصفوف إلى مصفوفات NumPy (إعادة التحميل الكامل للمحرك): {load_ms:.1f} مللي ثانية')
+        print(f'⚡ الأعمدة المعيَّنة في الذاكرة: {first_ms:.1f} مللي ثانية (أول فتح)، {warm_ms:.1f} مللي ثانية (مفتوحة)')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark':
+        benchmark(*(int(arg) for arg in sys.argv[2:4]))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'build':
+        # كتابة أعمدة الأشهر المغلقة التي ليس لها أرشيف عمودي (أُغلقت قبل إضافته)
+        from app import app, get_db_connection
+
+        month_dir = app.config['MONTH_ARCHIVE_DIR']
+        archived = set(ColumnarArchive(month_dir).months())
+        conn = get_db_connection()
+        for (month,) in conn.execute('SELECT month FROM closed_months ORDER BY month').fetchall():
+            if month not in archived:
+                print(f'🗄️ {month}: {write_month(conn, month, month_dir)} عملية')
+        conn.close()
+    else:
+        print('الاستخدام: python columnar.py [build | --benchmark [rows] [months]]')
+        sys.exit(1)
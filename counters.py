@@ -0,0 +1,108 @@
+"""
+counters.py - عدادات لوحة مناوب العمليات (لكل مستخدم في اليوم ولكل وحدة) تُحدَّث بالمشغلات مع كل كتابة
+"""
+import sqlite3
+import sys
+
+from writer import default_lock_path, locked_transaction
+
+# العدادات المتوقعة محسوبة من العمليات الخام (للمطابقة وإعادة البناء)
+USER_DAY_QUERY = '''
+    SELECT
+        user_id,
+        operation_date as day,
+        COUNT(*) as operations,
+        SUM(receipt_status_id = 2) as pending,
+        COALESCE(SUM(petrol_quantity), 0) as petrol,
+        COALESCE(SUM(diesel_quantity), 0) as diesel
+    FROM fuel_operations
+    GROUP BY user_id, operation_date
+'''
+
+UNIT_QUERY = '''
+    SELECT unit_id, COUNT(*) as operations, SUM(receipt_status_id = 1) as dispensed
+    FROM fuel_operations
+    WHERE unit_id IS NOT NULL
+    GROUP BY unit_id
+'''
+
+COUNTER_TABLES = (
+    ('user_daily_counters', ('user_id', 'day'), ('operations', 'pending', 'petrol', 'diesel'), USER_DAY_QUERY),
+    ('unit_counters', ('unit_id',), ('operations', 'dispensed'), UNIT_QUERY),
+)
+
+
+def unit_counts(conn, unit_id):
+    """عمليات الوحدة: الكل والمنصرف وغير المنصرف (بحث بالمفتاح الأساسي)"""
+    row = conn.execute(
+        'SELECT operations, dispensed FROM unit_counters WHERE unit_id = ?',
+        (unit_id,)
+    ).fetchone()
+    operations, dispensed = (row[0], row[1]) if row else (0, 0)
+    return {
+        'total_operations': operations,
+        'dispensed_operations': dispensed,
+        'non_dispensed_operations': operations - dispensed
+    }
+
+
+def user_day_counts(conn, user_id, day):
+    """عمليات المستخدم في يوم: العدد وقيد الانتظار والكميات"""
+    row = conn.execute(
+        'SELECT operations, pending, petrol, diesel FROM user_daily_counters WHERE user_id = ? AND day = ?',
+        (user_id, day)
+    ).fetchone()
+    return {
+        'today_operations': row[0] if row else 0,
+        'pending_operations': row[1] if row else 0,
+        'today_petrol': row[2] if row else 0.0,
+        'today_diesel': row[3] if row else 0.0
+    }
+
+
+def reconcile(conn, fix=False, tolerance=1e-6, lock_path=None, retry=None):
+    """مطابقة العدادات مع العمليات الخام، وإعادة بنائها عند fix=True
+
+    إعادة البناء معاملة BEGIN IMMEDIATE تحت قفل ملف الكاتب (locked_transaction)
+    حتى لا تتداخل مع كتابات العمال.
+    """
+    mismatches = []
+    for table, keys, columns, query in COUNTER_TABLES:
+        actual = {tuple(row[:len(keys)]): row[len(keys):] for row in conn.execute(query).fetchall()}
+        stored = {
+            tuple(row[:len(keys)]): row[len(keys):]
+            for row in conn.execute(f'SELECT {", ".join(keys + columns)} FROM {table}').fetchall()
+        }
+        for key in sorted(set(actual) | set(stored), key=repr):
+            expected = actual.get(key, (0,) * len(columns))
+            recorded = stored.get(key, (0,) * len(columns))
+            for column, want, have in zip(columns, expected, recorded):
+                if abs(float(want or 0) - float(have or 0)) > tolerance:
+                    mismatches.append({'table': table, 'key': key, 'column': column,
+                                       'counter': have, 'actual': want})
+
+    if fix and mismatches:
+        with locked_transaction(conn, lock_path or default_lock_path(conn), retry):
+            for table, keys, columns, query in COUNTER_TABLES:
+                conn.execute(f'DELETE FROM {table}')
+                conn.execute(f'INSERT INTO {table} ({", ".join(keys + columns)}) {query}')
+
+    return mismatches
+
+
+if __name__ == '__main__':
+    fix = '--fix' in sys.argv
+
+    conn = sqlite3.connect('database.db', isolation_level=None, timeout=0)
+    mismatches = reconcile(conn, fix=fix)
+    conn.close()
+
+    for item in mismatches:
+        print(f"  ⚠️ {item['table']} {item['key']} / {item['column']}: "
+              f"العداد {item['counter']} ≠ الفعلي {item['actual']}")
+    if not mismatches:
+        print("✅ العدادات مطابقة للعمليات")
+    elif fix:
+        print(f"✅ تم تصحيح {len(mismatches)} فرق")
+    else:
+        print(f"❌ {len(mismatches)} فرق (استخدم --fix لإعادة البناء)")
@@ -0,0 +1,373 @@
+"""
+dashboard_data.py - خدمة بيانات لوحة تحكم مسؤول النظام (مشتركة بين الصفحة و API)
+"""
+import os
+import sys
+import time
+from datetime import timedelta
+
+from singleflight import flight
+import time_windows
+
+# العمليات الأخيرة + السندات المنصرفة اليوم في استعلام واحد،
+# مع آخر معدّل لكل عملية من operation_audit (يبقى بعد أرشفة سجل الأنشطة)
+OPERATIONS_QUERY = '''
+    WITH recent AS (
+        SELECT id FROM fuel_operations
+        ORDER BY created_at DESC
+        LIMIT ?
+    ),
+    dispensed_today AS (
+        SELECT id FROM fuel_operations
+        WHERE receipt_status_id = 1
+        AND operation_day >= ? AND operation_day < ?
+    ),
+    picked AS (
+        SELECT id FROM recent
+        UNION
+        SELECT id FROM dispensed_today
+    )
+    SELECT
+        f.*,
+        u.name as unit_name,
+        r.name as status_name,
+        r.color_code,
+        r.color_code as status_color,
+        d.name as dispense_name,
+        us.name as user_name,
+        us.role as user_role,
+        lu.name as last_updated_by,
+        f.id IN (SELECT id FROM recent) as in_recent,
+        f.id IN (SELECT id FROM dispensed_today) as dispensed_today
+    FROM fuel_operations f
+    JOIN units u ON f.unit_id = u.id
+    JOIN receipt_statuses r ON f.receipt_status_id = r.id
+    JOIN dispense_types d ON f.dispense_type_id = d.id
+    JOIN users us ON f.user_id = us.id
+    LEFT JOIN operation_audit oa ON oa.operation_id = f.id
+    LEFT JOIN users lu ON oa.last_updated_by = lu.id
+    WHERE f.id IN (SELECT id FROM picked)
+    ORDER BY f.created_at DESC
+'''
+
+# جميع اللوحات التجميعية في استعلام واحد بمسحين يعتمدان على الفهارس:
+# توزيع الحالات (مسح فهرس الحالة فقط) ثم نافذة آخر 7 أيام (نطاق على operation_day)
+AGGREGATES_QUERY = '''
+    SELECT
+        receipt_status_id,
+        NULL as window_date,
+        COUNT(*) as operations,
+        0 as petrol,
+        0 as diesel
+    FROM fuel_operations
+    GROUP BY receipt_status_id
+
+    UNION ALL
+
+    SELECT
+        receipt_status_id,
+        operation_date as window_date,
+        COUNT(*) as operations,
+        COALESCE(SUM(petrol_quantity), 0) as petrol,
+        COALESCE(SUM(diesel_quantity), 0) as diesel
+    FROM fuel_operations
+    WHERE operation_day >= ? AND operation_day < ?
+    GROUP BY receipt_status_id, operation_date
+'''
+
+
+def _percentage(part, total):
+    return (part / total * 100) if total > 0 else 0
+
+
+def system_manager_dashboard_data(conn, presence, operations_limit=100, logs_limit=20,
+                                  dispensed_limit=None):
+    """جمع بيانات لوحة تحكم مسؤول النظام"""
+    today_window = time_windows.today()
+    week_window = time_windows.rolling_days(7)
+    today = today_window.start.isoformat()
+    yesterday = (today_window.start - timedelta(days=1)).isoformat()
+
+    receipt_statuses = [dict(row) for row in conn.execute('SELECT * FROM receipt_statuses ORDER BY id').fetchall()]
+
+    # المسح التجميعي
+    _, week_params = week_window.day_predicate()
+    status_counts = {}
+    daily = {}
+    today_stats = {'total_operations': 0, 'dispensed_receipts': 0, 'non_dispensed_receipts': 0,
+                   'total_petrol': 0.0, 'total_diesel': 0.0}
+    yesterday_operations = 0
+
+    # الاستعلامات الثقيلة مدموجة: طلبات اللوحة المتزامنة تتشارك تنفيذاً واحداً
+    for row in flight.query(conn, AGGREGATES_QUERY, week_params):
+        status_id = row['receipt_status_id']
+        day = row['window_date']
+        if day is None:
+            status_counts[status_id] = row['operations']
+            continue
+
+        totals = daily.setdefault(day, {'operation_date': day, 'total_petrol': 0.0, 'total_diesel': 0.0})
+        totals['total_petrol'] += float(row['petrol'])
+        totals['total_diesel'] += float(row['diesel'])
+
+        if day == today:
+            today_stats['total_operations'] += row['operations']
+            if status_id == 1:
+                today_stats['dispensed_receipts'] += row['operations']
+            else:
+                today_stats['non_dispensed_receipts'] += row['operations']
+            today_stats['total_petrol'] += float(row['petrol'])
+            today_stats['total_diesel'] += float(row['diesel'])
+        elif day == yesterday:
+            yesterday_operations += row['operations']
+
+    total_ops = today_stats['total_operations']
+    total_fuel = today_stats['total_petrol'] + today_stats['total_diesel']
+    today_stats.update({
+        'dispensed_percentage': _percentage(today_stats['dispensed_receipts'], total_ops),
+        'non_dispensed_percentage': _percentage(today_stats['non_dispensed_receipts'], total_ops),
+        'petrol_percentage': _percentage(today_stats['total_petrol'], total_fuel),
+        'diesel_percentage': _percentage(today_stats['total_diesel'], total_fuel),
+        'operations_change': _percentage(total_ops - yesterday_operations, yesterday_operations),
+    })
+
+    status_distribution = [
+        {'status_name': status['name'], 'count': status_counts.get(status['id'], 0),
+         'color_code': status['color_code']}
+        for status in receipt_statuses
+    ]
+    daily_consumption = [daily[day] for day in sorted(daily)]
+
+    # قوائم العمليات
+    _, today_params = today_window.day_predicate()
+    operations = []
+    today_dispensed_receipts = []
+    for row in flight.query(conn, OPERATIONS_QUERY, (operations_limit, *today_params)):
+        operation = dict(row)
+        if operation.pop('in_recent'):
+            operations.append(operation)
+        if operation.pop('dispensed_today'):
+            today_dispensed_receipts.append(operation)
+    if dispensed_limit is not None:
+        today_dispensed_receipts = today_dispensed_receipts[:dispensed_limit]
+
+    # المستخدمون والنشاطات
+    snapshot = presence.snapshot(conn)
+    active_users = presence.active_today(conn, snapshot)
+    online_users = presence.online_now(conn, snapshot)
+
+    recent_activity_logs = [dict(row) for row in conn.execute('''
+        SELECT a.*, u.name as user_name
+        FROM activity_logs a
+        JOIN users u ON a.user_id = u.id
+        WHERE a.table_name = 'fuel_operations'
+        ORDER BY a.created_at DESC
+        LIMIT ?
+    ''', (logs_limit,)).fetchall()]
+
+    all_users = [dict(row) for row in conn.execute(
+        'SELECT id, name, role FROM users WHERE is_active = 1'
+    ).fetchall()]
+
+    today_stats['active_users'] = len(active_users)
+    today_stats['online_users'] = len(online_users)
+
+    return {
+        'today_stats': today_stats,
+        'status_distribution': status_distribution,
+        'daily_consumption': daily_consumption,
+        'operations': operations,
+        'today_dispensed_receipts': today_dispensed_receipts,
+        'active_users': active_users,
+        'online_users': online_users,
+        'recent_activity_logs': recent_activity_logs,
+        'receipt_statuses': receipt_statuses,
+        'all_users': all_users,
+    }
+
+
+# ============================================
+# قياس الأداء
+# ============================================
+
+# معاملات مساري الصفحة و API كما في app.py
+ROUTE_ARGUMENTS = {
+    'page': {'logs_limit': 10, 'dispensed_limit': 20},
+    'api': {'logs_limit': 20},
+}
+
+# المرجع: استعلامات اللوحة السابقة، استعلام لكل لوحة (آخر معدّل باستعلام فرعي مرتبط على activity_logs)
+BASELINE_OPERATIONS_QUERY = '''
+    SELECT
+        f.*,
+        u.name as unit_name,
+        r.name as status_name,
+        r.color_code as status_color,
+        d.name as dispense_name,
+        us.name as user_name,
+        us.role as user_role,
+        (SELECT name FROM users WHERE id = (
+            SELECT user_id FROM activity_logs
+            WHERE table_name = 'fuel_operations'
+            AND record_id = f.id
+            AND action = 'تعديل عملية'
+            ORDER BY created_at DESC LIMIT 1
+        )) as last_updated_by
+    FROM fuel_operations f
+    JOIN units u ON f.unit_id = u.id
+    JOIN receipt_statuses r ON f.receipt_status_id = r.id
+    JOIN dispense_types d ON f.dispense_type_id = d.id
+    JOIN users us ON f.user_id = us.id
+    ORDER BY f.created_at DESC
+    LIMIT ?
+'''
+
+
+def baseline_dashboard_data(conn, presence, operations_limit=100, logs_limit=20, dispensed_limit=None):
+    """بيانات اللوحة بالطريقة السابقة (للمقارنة فقط): إحصائيات اليوم، المنصرف اليوم، العمليات،
+    توزيع الحالات، استهلاك الأسبوع، المستخدمون، النشاطات، الحالات والمستخدمون للفلترة"""
+    today = time_windows.today().start.isoformat()
+    week_clause, week_params = time_windows.rolling_days(7).day_predicate()
+    data = {
+        'today_stats': conn.execute('''
+            SELECT
+                COUNT(*) as total_operations,
+                SUM(CASE WHEN receipt_status_id = 1 THEN 1 ELSE 0 END) as dispensed_receipts,
+                SUM(CASE WHEN receipt_status_id != 1 THEN 1 ELSE 0 END) as non_dispensed_receipts,
+                COALESCE(SUM(petrol_quantity), 0) as total_petrol,
+                COALESCE(SUM(diesel_quantity), 0) as total_diesel
+            FROM fuel_operations
+            WHERE operation_date = ?
+        ''', (today,)).fetchone(),
+        'today_dispensed_receipts': conn.execute('''
+            SELECT f.*, u.name as unit_name, r.name as status_name, r.color_code
+            FROM fuel_operations f
+            JOIN units u ON f.unit_id = u.id
+            JOIN receipt_statuses r ON f.receipt_status_id = r.id
+            WHERE f.operation_date = ?
+            AND f.receipt_status_id = 1
+            ORDER BY f.created_at DESC
+            LIMIT ?
+        ''', (today, -1 if dispensed_limit is None else dispensed_limit)).fetchall(),
+        'operations': conn.execute(BASELINE_OPERATIONS_QUERY, (operations_limit,)).fetchall(),
+        'status_distribution': conn.execute('''
+            SELECT r.name as status_name, COUNT(f.id) as count, r.color_code
+            FROM receipt_statuses r
+            LEFT JOIN fuel_operations f ON r.id = f.receipt_status_id
+            GROUP BY r.id, r.name, r.color_code
+            ORDER BY r.id
+        ''').fetchall(),
+        'daily_consumption': conn.execute(f'''
+            SELECT
+                operation_date,
+                COALESCE(SUM(petrol_quantity), 0) as total_petrol,
+                COALESCE(SUM(diesel_quantity), 0) as total_diesel
+            FROM fuel_operations
+            WHERE {week_clause}
+            GROUP BY operation_date
+            ORDER BY operation_date
+        ''', week_params).fetchall(),
+        'active_users': presence.active_today(conn),
+        'online_users': presence.online_now(conn),
+        'recent_activity_logs': conn.execute('''
+            SELECT a.*, u.name as user_name
+            FROM activity_logs a
+            JOIN users u ON a.user_id = u.id
+            WHERE a.table_name = 'fuel_operations'
+            ORDER BY a.created_at DESC
+            LIMIT ?
+        ''', (logs_limit,)).fetchall(),
+        'receipt_statuses': conn.execute('SELECT * FROM receipt_statuses').fetchall(),
+        'all_users': conn.execute('SELECT id, name, role FROM users WHERE is_active = 1').fetchall(),
+    }
+    return data
+
+
+def _seed(conn, operations):
+    """عمليات اصطناعية موزعة على آخر 60 يوماً مع سجل تعديل لثلثها (لقياس الأداء على نسخة مؤقتة)"""
+    import random
+
+    rng = random.Random(7)
+    units = [row[0] for row in conn.execute('SELECT id FROM units')]
+    users = [row[0] for row in conn.execute('SELECT id FROM users')]
+    statuses = [row[0] for row in conn.execute('SELECT id FROM receipt_statuses')]
+    types = [row[0] for row in conn.execute('SELECT id FROM dispense_types')]
+    first = conn.execute('SELECT COALESCE(MAX(receipt_number), 1000) FROM fuel_operations').fetchone()[0] + 1
+    today = time_windows.today().start
+    for i in range(operations):
+        day = (today - timedelta(days=rng.randrange(60))).isoformat()
+        stamp = f'{day} {rng.randrange(24):02d}:{rng.randrange(60):02d}:00'
+        cursor = conn.execute('''
+            INSERT INTO fuel_operations (operation_date, unit_id, driver_name, vehicle_type, petrol_quantity,
+                                         diesel_quantity, receipt_status_id, receipt_number, dispense_type_id,
+                                         month, user_id, created_at, updated_at)
+            VALUES (?, ?, ?, 'باص', ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (day, rng.choice(units), f'سائق {rng.randrange(300)}', rng.randrange(80), rng.randrange(120),
+              rng.choice(statuses), first + i, rng.choice(types), day[:7], rng.choice(users), stamp, stamp))
+        if i % 3 == 0:
+            conn.execute('''
+                INSERT INTO activity_logs (user_id, action, table_name, record_id, created_at)
+                VALUES (?, 'تعديل عملية', 'fuel_operations', ?, ?)
+            ''', (rng.choice(users), cursor.lastrowid, stamp))
+    conn.commit()
+
+
+def _measure(conn, collect, rounds):
+    """(عدد الاستعلامات في استدعاء واحد، متوسط الزمن بالمللي ثانية)"""
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        collect()
+    finally:
+        conn.set_trace_callback(None)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        collect()
+    return len(statements), (time.perf_counter() - start) / rounds * 1000
+
+
+def benchmark(conn, presence, rounds=50):
+    """عدد استعلامات SQL وزمن جمع البيانات لكل مسار (الصفحة و API): الاستعلامات السابقة مقابل الحالية"""
+    results = {}
+    for name, arguments in ROUTE_ARGUMENTS.items():
+        baseline = _measure(conn, lambda: baseline_dashboard_data(conn, presence, **arguments), rounds)
+        current = _measure(conn, lambda: system_manager_dashboard_data(conn, presence, **arguments), rounds)
+        results[name] = {
+            'baseline_statements': baseline[0],
+            'baseline_ms': baseline[1],
+            'statements': current[0],
+            'ms': current[1],
+        }
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark':
+        import shutil
+        import sqlite3
+        import tempfile
+
+        from app import presence
+
+        rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+        operations = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+
+        # نسخة مؤقتة من القاعدة مع عمليات اصطناعية (القاعدة الأصلية لا تُمس)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'benchmark.db')
+            source = sqlite3.connect('database.db')
+            target = sqlite3.connect(path)
+            source.backup(target)
+            source.close()
+            _seed(target, operations)
+            target.row_factory = sqlite3.Row
+
+            print(f"⏳ {operations:,} عملية اصطناعية، {rounds} تكراراً لكل مسار")
+            for name, result in benchmark(target, presence, rounds).items():
+                print(f"  {name:>4}: السابق {result['baseline_statements']} استعلام SQL، {result['baseline_ms']:.2f} مللي ثانية"
+                      f" ← الحالي {result['statements']} استعلام SQL، {result['ms']:.2f} مللي ثانية")
+            target.close()
+    else:
+        print('الاستخدام: python dashboard_data.py --benchmark [rounds] [operations]')
+        sys.exit(1)
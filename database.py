@@ -5,6 +5,11 @@ import sqlite3
 import bcrypt
 from datetime import datetime
 
+import archive
+import master_data
+import replication
+import time_windows
+
 
 def init_database():
     """إنشاء وتهيئة قاعدة البيانات"""
@@ -238,6 +243,12 @@ def init_database():
 
     print(f"  ✅ تم إضافة {len(users_data)} مستخدم")
 
+    # ============================================
+    # تحديثات المخطط
+    # ============================================
+
+    apply_migrations(conn)
+
     # ============================================
     # تأكيد والحفظ
     # ============================================
@@ -257,6 +268,604 @@ def init_database():
     return True
 
 
+# الجداول التي يُتتبع إصدار بياناتها (تُستخدم كمفاتيح للتخزين المؤقت)
+VERSIONED_TABLES = ('units', 'dispense_types', 'receipt_statuses', 'users', 'fuel_operations')
+
+# جداول النشاط التي يُتتبع إصدارها (مفاتيح ETag للوحات التي تعرض السجل والحضور)
+ACTIVITY_TABLES = ('activity_logs', 'user_presence')
+
+# جداول البيانات المرجعية للسائقين والمركبات
+MASTER_TABLES = ('drivers', 'vehicles')
+
+# أعمدة العملية التي تغير العدادات عند تعديلها
+COUNTED_COLUMNS = ('user_id', 'unit_id', 'operation_date', 'receipt_status_id', 'petrol_quantity', 'diesel_quantity')
+
+
+def _counter_upserts(row, sign):
+    """جمل تحديث عدادات المستخدم/اليوم والوحدة لصف (NEW أو OLD) بإشارة +1 أو -1"""
+    return f'''
+                INSERT INTO user_daily_counters (user_id, day, operations, pending, petrol, diesel)
+                VALUES (
+                    {row}.user_id, {row}.operation_date, {sign},
+                    {sign} * ({row}.receipt_status_id = 2),
+                    {sign} * COALESCE({row}.petrol_quantity, 0),
+                    {sign} * COALESCE({row}.diesel_quantity, 0)
+                )
+                ON CONFLICT(user_id, day) DO UPDATE SET
+                    operations = operations + excluded.operations,
+                    pending = pending + excluded.pending,
+                    petrol = petrol + excluded.petrol,
+                    diesel = diesel + excluded.diesel;
+                INSERT INTO unit_counters (unit_id, operations, dispensed)
+                SELECT {row}.unit_id, {sign}, {sign} * ({row}.receipt_status_id = 1)
+                WHERE {row}.unit_id IS NOT NULL
+                ON CONFLICT(unit_id) DO UPDATE SET
+                    operations = operations + excluded.operations,
+                    dispensed = dispensed + excluded.dispensed;'''
+
+
+def _column_exists(cursor, table, column):
+    """التحقق من وجود عمود في جدول"""
+    return any(row[1] == column for row in cursor.execute(f"PRAGMA table_xinfo({table})"))
+
+
+def _run_once(cursor, name, statements):
+    """تنفيذ ترحيل بيانات مرة واحدة فقط وتسجيله في schema_migrations"""
+    if cursor.execute("SELECT 1 FROM schema_migrations WHERE name = ?", (name,)).fetchone():
+        return
+    for statement in statements:
+        cursor.execute(statement)
+    cursor.execute("INSERT INTO schema_migrations (name) VALUES (?)", (name,))
+
+
+def apply_migrations(conn):
+    """تطبيق تحديثات المخطط على قاعدة بيانات قائمة (آمنة عند التكرار)"""
+    cursor = conn.cursor()
+
+    # سجل ترحيلات البيانات المنفذة
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        name TEXT PRIMARY KEY,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    # جدول إصدارات البيانات: يزداد الرقم مع كل تعديل على الجدول
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS data_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+
+    for table in VERSIONED_TABLES:
+        cursor.execute(
+            "INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, 0)",
+            (table,)
+        )
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()}
+            AFTER {event} ON {table}
+            BEGIN
+                UPDATE data_versions SET version = version + 1 WHERE name = '{table}';
+            END
+            ''')
+
+    # رقم اليوم (منذ 1970-01-01) كعمود محسوب مفهرس بدلاً من DATE(operation_date)
+    if not _column_exists(cursor, 'fuel_operations', 'operation_day'):
+        cursor.execute('''
+        ALTER TABLE fuel_operations ADD COLUMN operation_day INTEGER
+        GENERATED ALWAYS AS (CAST(julianday(operation_date) - 2440587.5 AS INTEGER)) VIRTUAL
+        ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fuel_ops_day ON fuel_operations(operation_day)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fuel_ops_status_day ON fuel_operations(receipt_status_id, operation_day)")
+
+    # فهرس لقوائم "أحدث العمليات" (ORDER BY created_at DESC LIMIT)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fuel_ops_created ON fuel_operations(created_at)")
+
+    # فهرس للتحديث التدريجي للتحليلات (الصفوف المعدلة منذ آخر قراءة)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fuel_ops_updated ON fuel_operations(updated_at)")
+
+    # فهرس مركب لاستعلامات آخر تعديل/صرف لكل عملية
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_record ON activity_logs(table_name, record_id, action, created_at)")
+
+    # حضور المستخدمين (آخر ظهور لكل مستخدم) بدلاً من البحث في سجل الأنشطة
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS user_presence (
+        user_id INTEGER PRIMARY KEY,
+        last_seen TIMESTAMP,
+        last_login TIMESTAMP,
+        logged_out_at TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''')
+
+    for table in ACTIVITY_TABLES:
+        cursor.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, 0)", (table,))
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()}
+            AFTER {event} ON {table}
+            BEGIN
+                UPDATE data_versions SET version = version + 1 WHERE name = '{table}';
+            END
+            ''')
+
+    # إحصائيات الكميات المنصرفة لكل سائق/مركبة/وحدة (Welford + EWMA) لكشف الشذوذ
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS fuel_draw_stats (
+        dimension TEXT NOT NULL,
+        key TEXT NOT NULL,
+        fuel TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        mean REAL NOT NULL DEFAULT 0,
+        m2 REAL NOT NULL DEFAULT 0,
+        ewma REAL NOT NULL DEFAULT 0,
+        ewmvar REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (dimension, key, fuel)
+    )
+    ''')
+
+    # العمليات المعلّمة كشاذة
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS operation_anomalies (
+        operation_id INTEGER PRIMARY KEY,
+        score REAL NOT NULL,
+        reasons TEXT NOT NULL,
+        created_at TIMESTAMP,
+        FOREIGN KEY (operation_id) REFERENCES fuel_operations(id)
+    )
+    ''')
+
+    # الحصص الشهرية لكل وحدة مع الرصيد الجاري (المنصرف والمحجوز)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS unit_quota_ledger (
+        unit_id INTEGER NOT NULL,
+        month TEXT NOT NULL,
+        petrol_quota REAL,
+        diesel_quota REAL,
+        petrol_used REAL NOT NULL DEFAULT 0,
+        diesel_used REAL NOT NULL DEFAULT 0,
+        petrol_reserved REAL NOT NULL DEFAULT 0,
+        diesel_reserved REAL NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP,
+        PRIMARY KEY (unit_id, month),
+        FOREIGN KEY (unit_id) REFERENCES units(id)
+    )
+    ''')
+
+    # خزانات المحروقات مع المستوى الحالي (رصيد مُجسَّد يُحدَّث مع كل حركة)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS fuel_tanks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        fuel TEXT NOT NULL CHECK (fuel IN ('petrol', 'diesel')),
+        capacity REAL,
+        level REAL NOT NULL DEFAULT 0,
+        low_level REAL DEFAULT 0,
+        is_active BOOLEAN DEFAULT 1,
+        updated_at TIMESTAMP
+    )
+    ''')
+
+    # سندات توريد الوقود
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS fuel_deliveries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tank_id INTEGER NOT NULL,
+        quantity REAL NOT NULL,
+        delivery_date TEXT NOT NULL,
+        reference TEXT,
+        supplier TEXT,
+        notes TEXT,
+        user_id INTEGER,
+        created_at TIMESTAMP,
+        FOREIGN KEY (tank_id) REFERENCES fuel_tanks(id),
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''')
+
+    # حركات المخزون (توريد، صرف، إرجاع، تسوية)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stock_movements (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tank_id INTEGER NOT NULL,
+        quantity REAL NOT NULL,
+        kind TEXT NOT NULL,
+        operation_id INTEGER,
+        delivery_id INTEGER,
+        level_after REAL,
+        user_id INTEGER,
+        notes TEXT,
+        created_at TIMESTAMP,
+        FOREIGN KEY (tank_id) REFERENCES fuel_tanks(id),
+        FOREIGN KEY (delivery_id) REFERENCES fuel_deliveries(id)
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_moves_tank ON stock_movements(tank_id, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_moves_operation ON stock_movements(operation_id)")
+
+    # الاستهلاك اليومي لكل نوع وقود (لحساب أيام التغطية)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS fuel_stock_daily (
+        fuel TEXT NOT NULL,
+        day INTEGER NOT NULL,
+        dispensed REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (fuel, day)
+    )
+    ''')
+
+    # السندات المستخدمة عند المضخة (استخدام واحد لكل سند)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS receipt_redemptions (
+        operation_id INTEGER PRIMARY KEY,
+        redeemed_at TIMESTAMP NOT NULL,
+        user_id INTEGER,
+        FOREIGN KEY (operation_id) REFERENCES fuel_operations(id),
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''')
+
+    # عدادات لوحة مناوب العمليات: عمليات المستخدم في كل يوم، وعمليات كل وحدة
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS user_daily_counters (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        operations INTEGER NOT NULL DEFAULT 0,
+        pending INTEGER NOT NULL DEFAULT 0,
+        petrol REAL NOT NULL DEFAULT 0,
+        diesel REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day)
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS unit_counters (
+        unit_id INTEGER PRIMARY KEY,
+        operations INTEGER NOT NULL DEFAULT 0,
+        dispensed INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+
+    # المشغلات تحدّث العدادات مع كل كتابة مهما كان مسارها
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_fuel_operations_counters_insert
+    AFTER INSERT ON fuel_operations
+    BEGIN{_counter_upserts('NEW', 1)}
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_fuel_operations_counters_delete
+    AFTER DELETE ON fuel_operations
+    BEGIN{_counter_upserts('OLD', -1)}
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_fuel_operations_counters_update
+    AFTER UPDATE OF {', '.join(COUNTED_COLUMNS)} ON fuel_operations
+    BEGIN{_counter_upserts('OLD', -1)}{_counter_upserts('NEW', 1)}
+    END
+    ''')
+
+    # العمليات المنصرفة للمستخدم بترتيب وقت الصرف (لا تُعدّل العملية بعد صرفها)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fuel_ops_user_status ON fuel_operations(user_id, receipt_status_id, updated_at)")
+
+    # مهام الخلفية (تقارير وتصدير) ونواتجها على القرص
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        params TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        progress REAL NOT NULL DEFAULT 0,
+        message TEXT,
+        artifact TEXT,
+        user_id INTEGER,
+        created_at TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP,
+        expires_at TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_lookup ON jobs(kind, params, status, expires_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_expires ON jobs(expires_at)")
+
+    # مفاتيح عدم التكرار للعمليات المرسلة من العميل (إعادة الإرسال تُرجع نفس رقم السند)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        user_id INTEGER NOT NULL,
+        idempotency_key TEXT NOT NULL,
+        operation_id INTEGER,
+        receipt_number INTEGER,
+        created_at TIMESTAMP,
+        PRIMARY KEY (user_id, idempotency_key),
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''')
+
+    # السائقون والمركبات: اسم معتمد لكل اسم موحد (normalized) مع عدد مرات الاستخدام لترتيب الاقتراحات
+    for table in MASTER_TABLES:
+        cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            normalized TEXT NOT NULL UNIQUE,
+            uses INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP
+        )
+        ''')
+        # إصدار الجدول لا يتغير مع عدد الاستخدام (فهرس الإكمال يُبنى عند تغير الأسماء فقط)
+        cursor.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, 0)", (table,))
+        for event in ('INSERT', 'UPDATE OF name, normalized', 'DELETE'):
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.split()[0].lower()}
+            AFTER {event} ON {table}
+            BEGIN
+                UPDATE data_versions SET version = version + 1 WHERE name = '{table}';
+            END
+            ''')
+    for column in ('driver_id', 'vehicle_id'):
+        if not _column_exists(cursor, 'fuel_operations', column):
+            cursor.execute(f"ALTER TABLE fuel_operations ADD COLUMN {column} INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fuel_ops_driver ON fuel_operations(driver_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fuel_ops_vehicle ON fuel_operations(vehicle_id)")
+
+    # الأشهر المغلقة: إجمالياتها وملف تقريرها المضغوط وبصمته
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS closed_months (
+        month TEXT PRIMARY KEY,
+        operations INTEGER NOT NULL,
+        petrol REAL NOT NULL,
+        diesel REAL NOT NULL,
+        artifact TEXT NOT NULL,
+        sha256 TEXT NOT NULL,
+        closed_by INTEGER,
+        closed_at TIMESTAMP,
+        FOREIGN KEY (closed_by) REFERENCES users(id)
+    )
+    ''')
+
+    # كل شهر حتى آخر شهر مغلق مجمد مهما كان مسار الكتابة (الواجهة، المزامنة، النسخ بين المواقع)
+    for event, condition in (
+        ('INSERT', 'NEW.month <= (SELECT MAX(month) FROM closed_months)'),
+        ('UPDATE', 'OLD.month <= (SELECT MAX(month) FROM closed_months) OR NEW.month <= (SELECT MAX(month) FROM closed_months)'),
+        ('DELETE', 'OLD.month <= (SELECT MAX(month) FROM closed_months)'),
+    ):
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_fuel_operations_closed_{event.lower()}
+        BEFORE {event} ON fuel_operations
+        WHEN {condition}
+        BEGIN
+            SELECT RAISE(ABORT, 'الشهر مغلق: لا يمكن تعديل عملياته');
+        END
+        ''')
+
+    # معرف هذا الموقع في النسخ بين الألوية وبداية نطاق أرقام سنداته (applying = 1 أثناء تطبيق حزمة مستوردة)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS replication_site (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        site_id TEXT NOT NULL,
+        receipt_base INTEGER NOT NULL DEFAULT 0,
+        applying INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO replication_site (id, site_id) VALUES (1, lower(hex(randomblob(4))))")
+
+    # سجل التغييرات على مستوى الصف: المحلية (site_version فارغ) والمستوردة بإصدارها في موقعها الأصل
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS change_log (
+        version INTEGER PRIMARY KEY AUTOINCREMENT,
+        site_id TEXT NOT NULL,
+        site_version INTEGER,
+        table_name TEXT NOT NULL,
+        row_key TEXT NOT NULL,
+        operation TEXT NOT NULL,
+        row_data TEXT,
+        changed_at TIMESTAMP NOT NULL
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_change_log_row ON change_log(table_name, row_key, changed_at)")
+
+    # الصفوف المستوردة من مواقع أخرى: (الموقع الأصل، المعرف الأصلي) ← المعرف المحلي
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS replication_rows (
+        table_name TEXT NOT NULL,
+        origin_site TEXT NOT NULL,
+        origin_id INTEGER NOT NULL,
+        local_id INTEGER NOT NULL,
+        PRIMARY KEY (table_name, origin_site, origin_id)
+    )
+    ''')
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_replication_rows_local ON replication_rows(table_name, local_id)")
+
+    # آخر إصدار مطبق من كل موقع أصل، وما صُدِّر إلى كل نظير واستُورد منه
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS replication_vector (
+        site_id TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS replication_peers (
+        peer TEXT PRIMARY KEY,
+        exported_version INTEGER NOT NULL DEFAULT 0,
+        received_version INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP
+    )
+    ''')
+
+    # التغييرات المستوردة التي خالفت قيداً محلياً (تنتظر المعالجة اليدوية)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS replication_conflicts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        site_id TEXT NOT NULL,
+        site_version INTEGER NOT NULL,
+        table_name TEXT NOT NULL,
+        row_key TEXT NOT NULL,
+        change TEXT NOT NULL,
+        reason TEXT,
+        created_at TIMESTAMP
+    )
+    ''')
+
+    for statement in replication.trigger_statements():
+        cursor.execute(statement)
+
+    # يزداد مع كل استيراد يغير العمليات (محرك التحليلات يعيد تحميلها كاملة)
+    cursor.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, 0)", (replication.IMPORTS_VERSION,))
+
+    # آخر صرف وآخر تعديل لكل عملية (يبقى بعد نقل سجل الأنشطة إلى ملفات الأرشيف الشهرية)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS operation_audit (
+        operation_id INTEGER PRIMARY KEY,
+        dispensed_at TIMESTAMP,
+        dispensed_by INTEGER,
+        dispense_notes TEXT,
+        last_updated_at TIMESTAMP,
+        last_updated_by INTEGER
+    )
+    ''')
+    for statement in archive.audit_trigger_statements():
+        cursor.execute(statement)
+
+    # العمليات المحذوفة مع صاحبها (مزامنة العميل دون اتصال: كل مناوب يتلقى حذف عملياته فقط)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS deleted_operations (
+        operation_id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        deleted_at TIMESTAMP NOT NULL
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_deleted_operations_at ON deleted_operations(deleted_at)")
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_fuel_operations_deleted
+    AFTER DELETE ON fuel_operations
+    BEGIN
+        INSERT OR REPLACE INTO deleted_operations (operation_id, user_id, deleted_at)
+        VALUES (OLD.id, OLD.user_id, datetime('now', 'localtime'));
+    END
+    ''')
+
+    # توحيد الطوابع الزمنية على التوقيت المحلي (كانت CURRENT_TIMESTAMP بتوقيت UTC)
+    _run_once(cursor, 'local_timestamps', [
+        "UPDATE activity_logs SET created_at = datetime(created_at, 'localtime') WHERE created_at IS NOT NULL",
+        "UPDATE fuel_operations SET created_at = datetime(created_at, 'localtime') WHERE created_at IS NOT NULL",
+        "UPDATE fuel_operations SET updated_at = datetime(updated_at, 'localtime') WHERE updated_at IS NOT NULL",
+    ])
+
+    _run_once(cursor, 'backfill_user_presence', [
+        """
+        INSERT OR IGNORE INTO user_presence (user_id, last_seen, last_login)
+        SELECT user_id, MAX(created_at), MAX(created_at)
+        FROM activity_logs
+        WHERE action = 'تسجيل دخول' AND user_id IS NOT NULL
+        GROUP BY user_id
+        """,
+    ])
+
+    # متوسط الاستهلاك اليومي من العمليات المنصرفة السابقة
+    _run_once(cursor, 'backfill_fuel_stock_daily', [
+        """
+        INSERT OR IGNORE INTO fuel_stock_daily (fuel, day, dispensed)
+        SELECT 'petrol', operation_day, SUM(petrol_quantity)
+        FROM fuel_operations
+        WHERE receipt_status_id = 1 AND petrol_quantity > 0
+        GROUP BY operation_day
+        """,
+        """
+        INSERT OR IGNORE INTO fuel_stock_daily (fuel, day, dispensed)
+        SELECT 'diesel', operation_day, SUM(diesel_quantity)
+        FROM fuel_operations
+        WHERE receipt_status_id = 1 AND diesel_quantity > 0
+        GROUP BY operation_day
+        """,
+    ])
+
+    _run_once(cursor, 'backfill_unit_quota_ledger', [
+        """
+        INSERT OR IGNORE INTO unit_quota_ledger
+            (unit_id, month, petrol_used, diesel_used, petrol_reserved, diesel_reserved, updated_at)
+        SELECT
+            unit_id,
+            month,
+            COALESCE(SUM(CASE WHEN receipt_status_id = 1 THEN petrol_quantity END), 0),
+            COALESCE(SUM(CASE WHEN receipt_status_id = 1 THEN diesel_quantity END), 0),
+            COALESCE(SUM(CASE WHEN receipt_status_id NOT IN (1, 4) THEN petrol_quantity END), 0),
+            COALESCE(SUM(CASE WHEN receipt_status_id NOT IN (1, 4) THEN diesel_quantity END), 0),
+            datetime('now', 'localtime')
+        FROM fuel_operations
+        WHERE unit_id IS NOT NULL AND month IS NOT NULL
+        GROUP BY unit_id, month
+        """,
+    ])
+
+    _run_once(cursor, 'backfill_operation_counters', [
+        """
+        INSERT OR IGNORE INTO user_daily_counters (user_id, day, operations, pending, petrol, diesel)
+        SELECT
+            user_id,
+            operation_date,
+            COUNT(*),
+            SUM(receipt_status_id = 2),
+            COALESCE(SUM(petrol_quantity), 0),
+            COALESCE(SUM(diesel_quantity), 0)
+        FROM fuel_operations
+        GROUP BY user_id, operation_date
+        """,
+        """
+        INSERT OR IGNORE INTO unit_counters (unit_id, operations, dispensed)
+        SELECT unit_id, COUNT(*), SUM(receipt_status_id = 1)
+        FROM fuel_operations
+        WHERE unit_id IS NOT NULL
+        GROUP BY unit_id
+        """,
+    ])
+
+    # دمج تهجئات أسماء السائقين والمركبات الحالية وربط العمليات بسجلاتها
+    conn.create_function('normalize_ar', 1, master_data.normalize, deterministic=True)
+    _run_once(cursor, 'backfill_drivers_vehicles',
+              master_data.backfill_statements('driver') + master_data.backfill_statements('vehicle'))
+
+    # التهجئات القريبة (خطأ حرف) تُضم إلى الأكثر استخداماً
+    if not cursor.execute("SELECT 1 FROM schema_migrations WHERE name = 'merge_near_duplicate_names'").fetchone():
+        for kind in master_data.KINDS:
+            master_data.merge_near_duplicates(cursor, kind)
+        cursor.execute("INSERT INTO schema_migrations (name) VALUES ('merge_near_duplicate_names')")
+
+    _run_once(cursor, 'backfill_operation_audit', archive.audit_statements('main'))
+
+    # المحذوفات السابقة من سجل الأنشطة، وصاحب العملية من سجل إضافتها إن وُجد
+    _run_once(cursor, 'backfill_deleted_operations', [
+        """
+        INSERT OR IGNORE INTO deleted_operations (operation_id, user_id, deleted_at)
+        SELECT d.record_id,
+               (SELECT a.user_id FROM activity_logs a
+                WHERE a.table_name = 'fuel_operations' AND a.record_id = d.record_id
+                AND a.action = 'إضافة عملية'),
+               MAX(d.created_at)
+        FROM activity_logs d
+        WHERE d.table_name = 'fuel_operations' AND d.action = 'حذف عملية' AND d.record_id IS NOT NULL
+        GROUP BY d.record_id
+        """,
+    ])
+
+    # الصفوف الموجودة قبل سجل التغييرات تدخل أول حزمة تصدير
+    _run_once(cursor, 'backfill_change_log', replication.backfill_statements())
+
+    conn.commit()
+
+
+def upgrade_database(db_path='database.db'):
+    """تطبيق تحديثات المخطط على ملف قاعدة البيانات"""
+    conn = sqlite3.connect(db_path)
+    try:
+        apply_migrations(conn)
+        archive.backfill_operation_audit(conn)
+    finally:
+        conn.close()
+
+
 def test_database():
     """اختبار اتصال قاعدة البيانات"""
     try:
@@ -287,10 +896,54 @@ def test_database():
         return False
 
 
+def test_query_plans(db_path='database.db'):
+    """التحقق بـ EXPLAIN QUERY PLAN من أن شروط اليوم والنافذة المتحركة والمستخدمين النشطين تستخدم الفهارس"""
+    import dashboard_data
+    import repository
+
+    today = time_windows.today()
+    week = time_windows.rolling_days(7)
+    logins_clause, logins_params = today.timestamp_predicate('a.created_at')
+    week_clause, week_params = week.day_predicate()
+    checks = [
+        ('السندات المنصرفة اليوم', repository.DISPENSED_BY_DAY,
+         today.day_predicate()[1], 'idx_fuel_ops_status_day'),
+        ('لوحة مسؤول النظام: المنصرف اليوم', dashboard_data.OPERATIONS_QUERY,
+         (10,) + today.day_predicate()[1], 'idx_fuel_ops_status_day'),
+        ('لوحة مسؤول النظام: آخر 7 أيام', dashboard_data.AGGREGATES_QUERY,
+         week_params, 'idx_fuel_ops_day'),
+        ('إحصائيات الأسبوع', f'''
+            SELECT operation_date, COUNT(*) FROM fuel_operations
+            WHERE {week_clause} GROUP BY operation_date
+        ''', week_params, 'idx_fuel_ops_day'),
+        ('المستخدمون النشطون اليوم', f'''
+            SELECT DISTINCT u.id, u.name FROM users u
+            JOIN activity_logs a ON u.id = a.user_id
+            WHERE {logins_clause} AND a.action LIKE '%تسجيل دخول%'
+        ''', logins_params, 'idx_logs_created'),
+    ]
+
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    passed = True
+    print(f"\n🔎 خطط الاستعلامات:")
+    for name, query, params, index in checks:
+        plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', params)]
+        uses_index = any(f'INDEX {index} ' in detail for detail in plan)
+        passed = passed and uses_index
+        print(f"   {'✅' if uses_index else '❌'} {name}: {index}")
+        if not uses_index:
+            for detail in plan:
+                print(f"      {detail}")
+    conn.close()
+    return passed
+
+
 if __name__ == '__main__':
     print("=" * 50)
     print("نظام إدارة قاعدة بيانات المحروقات")
     print("=" * 50)
 
     init_database()
-    test_database()
\ No newline at end of file
+    test_database()
+    if not test_query_plans():
+        raise SystemExit(1)
\ No newline at end of file
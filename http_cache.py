@@ -0,0 +1,193 @@
+"""
+http_cache.py - ضغط الردود (gzip/brotli) والطلبات الشرطية بـ ETag من إصدارات البيانات (304 قبل تنفيذ المسار)
+"""
+import functools
+import gzip
+import hashlib
+import os
+import threading
+import time
+
+from flask import make_response, request, session
+
+import time_windows
+
+try:
+    import brotli
+except ImportError:
+    # brotli مثبت في requirements.txt؛ إن غاب عن بيئة ما يُستخدم gzip فقط
+    brotli = None
+
+# أنواع المحتوى التي يفيدها الضغط (الصور والملفات المضغوطة أصلاً تُرسل كما هي)
+COMPRESSIBLE = {
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript',
+    'application/json', 'application/javascript', 'image/svg+xml',
+}
+
+
+def _accepted(header):
+    """الترميزات المقبولة من Accept-Encoding مع أوزانها"""
+    accepted = {}
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        if name:
+            accepted[name.lower()] = weight
+    return accepted
+
+
+class ResponseCompressor:
+    """ضغط الردود النصية الأكبر من min_size حسب ما يقبله المتصفح (brotli أولاً إن توفر)"""
+
+    def __init__(self, min_size=1024, gzip_level=6, brotli_quality=5):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self._lock = threading.Lock()
+        self.compressed = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.skipped = 0
+
+    def _encoding(self, header):
+        accepted = _accepted(header)
+        if brotli is not None and accepted.get('br', 0) > 0:
+            return 'br'
+        if accepted.get('gzip', accepted.get('*', 0)) > 0:
+            return 'gzip'
+        return None
+
+    def __call__(self, response):
+        """دالة after_request"""
+        if (response.status_code != 200
+                or response.direct_passthrough
+                or response.is_streamed
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE
+                or 'no-transform' in (response.headers.get('Cache-Control') or '')):
+            return response
+
+        # الرد يختلف حسب Accept-Encoding حتى لو لم يُضغط هذه المرة
+        response.vary.add('Accept-Encoding')
+        data = response.get_data()
+        encoding = self._encoding(request.headers.get('Accept-Encoding'))
+        if encoding is None or len(data) < self.min_size:
+            with self._lock:
+                self.skipped += 1
+            return response
+
+        if encoding == 'br':
+            body = brotli.compress(data, quality=self.brotli_quality)
+        else:
+            body = gzip.compress(data, compresslevel=self.gzip_level, mtime=0)
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+
+        # ETag القوي يخص البايتات: بعد الضغط يصبح ضعيفاً (المحتوى نفسه بترميز مختلف)
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+
+        with self._lock:
+            self.compressed[encoding] = self.compressed.get(encoding, 0) + 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(body)
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {
+                'brotli_available': brotli is not None,
+                'min_size': self.min_size,
+                'compressed': dict(self.compressed),
+                'skipped': self.skipped,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'ratio': self.bytes_out / self.bytes_in if self.bytes_in else None
+            }
+
+
+def release_token(paths):
+    """بصمة نسخة التطبيق (أحدث تعديل للملفات والقوالب) حتى لا تصمد ETag القديمة بعد النشر
+
+    واحدة لكل العمال لأنها من الملفات وليست من وقت بدء العامل.
+    """
+    latest = 0
+    for path in paths:
+        if os.path.isdir(path):
+            files = [os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+        else:
+            files = [path]
+        for file in files:
+            latest = max(latest, os.stat(file).st_mtime_ns)
+    return str(latest)
+
+
+class ConditionalGet:
+    """ETag ضعيف من إصدارات الجداول (data_versions) دون قراءة جسم الرد أو تجزئته
+
+    versions(*tables) تُعيد أرقام إصدار الجداول؛ المفتاح يشمل الجلسة (المستخدم ودوره وآخر دخوله)
+    ومعاملات الطلب ونافذة زمنية اختيارية للبيانات المتغيرة مع الوقت (المتصلون الآن، اليوم).
+    """
+
+    def __init__(self, versions, release=''):
+        self.versions = versions
+        self.release = release
+        self._lock = threading.Lock()
+        self.not_modified = 0
+        self.misses = 0
+
+    def _etag(self, tables, window):
+        key = (
+            self.release,
+            request.endpoint,
+            sorted(request.view_args.items()) if request.view_args else (),
+            sorted(request.args.items(multi=True)),
+            sorted((name, str(value)) for name, value in session.items() if not name.startswith('_')),
+            self.versions(*tables),
+            time_windows.today().start.isoformat(),
+            int(time.time() // window) if window else None,
+        )
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:20]
+
+    def etag(self, *tables, window=None):
+        """ديكور لمسار GET: 304 إذا طابق If-None-Match، وإلا ينفذ المسار ويضيف ETag
+
+        tables: الجداول التي يقرؤها المسار. window: ثوانٍ تتغير بعدها ETag ولو لم تتغير البيانات.
+        """
+        def decorator(f):
+            @functools.wraps(f)
+            def decorated_function(*args, **kwargs):
+                if request.method not in ('GET', 'HEAD'):
+                    return f(*args, **kwargs)
+
+                etag = self._etag(tables, window)
+                if request.if_none_match.contains_weak(etag):
+                    with self._lock:
+                        self.not_modified += 1
+                    response = make_response('', 304)
+                else:
+                    with self._lock:
+                        self.misses += 1
+                    pending_flashes = bool(session.get('_flashes'))
+                    response = make_response(f(*args, **kwargs))
+                    # صفحة عرضت رسائل flash لا تُعاد بـ 304 (تظهر الرسائل مرة واحدة فقط)
+                    if response.status_code != 200 or (pending_flashes and not session.get('_flashes')):
+                        return response
+
+                response.set_etag(etag, weak=True)
+                # المتصفح يعيد التحقق في كل مرة، والوسطاء لا يخزنون صفحة مستخدم لغيره
+                response.headers['Cache-Control'] = 'private, no-cache'
+                return response
+            return decorated_function
+        return decorator
+
+    def stats(self):
+        with self._lock:
+            return {'not_modified': self.not_modified, 'misses': self.misses}
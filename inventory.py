@@ -0,0 +1,135 @@
+"""
+inventory.py - مخزون خزانات المحروقات: التوريدات وحركات المخزون والرصيد الحالي لكل خزان
+"""
+from datetime import timedelta
+
+import time_windows
+
+FUELS = ('petrol', 'diesel')
+FUEL_NAMES = {'petrol': 'بترول', 'diesel': 'ديزل'}
+
+# عدد الأيام المستخدمة لحساب متوسط الاستهلاك اليومي (أيام التغطية)
+USAGE_DAYS = 30
+
+
+def _move(conn, tank_id, quantity, kind, operation_id=None, delivery_id=None, user_id=None, notes=None):
+    """تسجيل حركة مخزون وتحديث مستوى الخزان في نفس المعاملة"""
+    conn.execute('''
+        UPDATE fuel_tanks
+        SET level = level + ?, updated_at = datetime('now', 'localtime')
+        WHERE id = ?
+    ''', (quantity, tank_id))
+    level_after = conn.execute('SELECT level FROM fuel_tanks WHERE id = ?', (tank_id,)).fetchone()[0]
+    conn.execute('''
+        INSERT INTO stock_movements
+        (tank_id, quantity, kind, operation_id, delivery_id, level_after, user_id, notes, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now', 'localtime'))
+    ''', (tank_id, quantity, kind, operation_id, delivery_id, level_after, user_id, notes))
+    return level_after
+
+
+def _add_daily_usage(conn, fuel, quantity):
+    """تجميع الاستهلاك اليومي لكل نوع وقود (لحساب أيام التغطية دون مسح السجل)"""
+    conn.execute('''
+        INSERT INTO fuel_stock_daily (fuel, day, dispensed) VALUES (?, ?, ?)
+        ON CONFLICT(fuel, day) DO UPDATE SET dispensed = dispensed + excluded.dispensed
+    ''', (fuel, time_windows.day_number(time_windows.local_now()), quantity))
+
+
+def _pick_tank(conn, fuel):
+    """الخزان النشط الذي يُصرف منه نوع الوقود (الأعلى مستوى)"""
+    return conn.execute('''
+        SELECT id FROM fuel_tanks
+        WHERE fuel = ? AND is_active = 1
+        ORDER BY level DESC, id
+        LIMIT 1
+    ''', (fuel,)).fetchone()
+
+
+def record_dispense(conn, operation, user_id=None):
+    """خصم كميات عملية منصرفة من الخزانات (بدون خزانات معرفة لا يُسجل شيء)"""
+    for fuel in FUELS:
+        quantity = float(operation[f'{fuel}_quantity'] or 0)
+        if quantity <= 0:
+            continue
+        tank = _pick_tank(conn, fuel)
+        if not tank:
+            continue
+        _move(conn, tank['id'], -quantity, 'dispense', operation_id=operation['id'], user_id=user_id)
+        _add_daily_usage(conn, fuel, quantity)
+
+
+def reverse_operation(conn, operation_id, user_id=None):
+    """إرجاع كميات عملية منصرفة إلى خزاناتها (عند حذف العملية)"""
+    movements = conn.execute('''
+        SELECT m.tank_id, SUM(m.quantity) as quantity, t.fuel
+        FROM stock_movements m
+        JOIN fuel_tanks t ON m.tank_id = t.id
+        WHERE m.operation_id = ?
+        GROUP BY m.tank_id
+    ''', (operation_id,)).fetchall()
+    for movement in movements:
+        if movement['quantity'] >= 0:
+            continue
+        _move(conn, movement['tank_id'], -movement['quantity'], 'reversal',
+              operation_id=operation_id, user_id=user_id)
+        _add_daily_usage(conn, movement['fuel'], movement['quantity'])
+
+
+def record_delivery(conn, tank_id, quantity, delivery_date, reference=None, supplier=None,
+                    notes=None, user_id=None):
+    """تسجيل توريد وقود إلى خزان"""
+    cursor = conn.execute('''
+        INSERT INTO fuel_deliveries
+        (tank_id, quantity, delivery_date, reference, supplier, notes, user_id, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now', 'localtime'))
+    ''', (tank_id, quantity, delivery_date, reference, supplier, notes, user_id))
+    delivery_id = cursor.lastrowid
+    _move(conn, tank_id, quantity, 'delivery', delivery_id=delivery_id, user_id=user_id, notes=reference)
+    return delivery_id
+
+
+def adjust_level(conn, tank_id, measured_level, user_id=None, notes=None):
+    """تسوية مستوى خزان بعد القياس الفعلي (جرد)"""
+    current = conn.execute('SELECT level FROM fuel_tanks WHERE id = ?', (tank_id,)).fetchone()
+    if not current:
+        return None
+    return _move(conn, tank_id, measured_level - current['level'], 'adjustment', user_id=user_id, notes=notes)
+
+
+def stock_levels(conn, alert_days=3):
+    """المخزون الحالي لكل خزان مع أيام التغطية وتنبيه انخفاض المخزون"""
+    since = time_windows.day_number(time_windows.local_now() - timedelta(days=USAGE_DAYS))
+    daily_usage = {
+        row['fuel']: float(row['dispensed']) / USAGE_DAYS
+        for row in conn.execute('''
+            SELECT fuel, SUM(dispensed) as dispensed
+            FROM fuel_stock_daily
+            WHERE day > ?
+            GROUP BY fuel
+        ''', (since,)).fetchall()
+    }
+
+    tanks = [dict(row) for row in conn.execute('''
+        SELECT id, name, fuel, capacity, level, low_level, updated_at
+        FROM fuel_tanks
+        WHERE is_active = 1
+        ORDER BY fuel, name
+    ''').fetchall()]
+
+    # أيام التغطية لكل نوع وقود على مستوى مجموع خزاناته
+    fuel_levels = {}
+    for tank in tanks:
+        fuel_levels[tank['fuel']] = fuel_levels.get(tank['fuel'], 0.0) + tank['level']
+
+    for tank in tanks:
+        usage = daily_usage.get(tank['fuel'], 0.0)
+        tank['fuel_name'] = FUEL_NAMES.get(tank['fuel'], tank['fuel'])
+        tank['daily_usage'] = usage
+        tank['days_of_cover'] = fuel_levels[tank['fuel']] / usage if usage > 0 else None
+        tank['fill_percentage'] = (tank['level'] / tank['capacity'] * 100) if tank['capacity'] else None
+        tank['is_low'] = (
+            tank['level'] <= (tank['low_level'] or 0)
+            or (tank['days_of_cover'] is not None and tank['days_of_cover'] < alert_days)
+        )
+    return tanks
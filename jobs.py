@@ -0,0 +1,337 @@
+"""
+jobs.py - مهام الخلفية: تقارير وتصدير طويلة تُنفذ في مجمع عمليات، بحالة وتقدم في جدول jobs ونواتج على القرص
+"""
+import csv
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from snapshot import SnapshotStore
+from writer import WriteCoordinator
+
+# أسماء الحالات المعروضة
+STATUS_NAMES = {
+    'queued': 'في الانتظار',
+    'running': 'قيد التنفيذ',
+    'done': 'مكتملة',
+    'failed': 'فشلت',
+}
+
+# أقل فاصل (ثوانٍ) بين كتابتين للتقدم من داخل المهمة
+PROGRESS_INTERVAL = 0.5
+
+
+# ============================================
+# أنواع المهام (تُنفذ في عملية العامل)
+# ============================================
+
+def unit_year_report(conn, params, out, progress):
+    """تقرير سنوي لكل وحدة: عدد العمليات والكميات لكل شهر"""
+    if not params.get('year'):
+        raise ValueError('السنة مطلوبة')
+    year = int(params['year'])
+    units = conn.execute('SELECT id, name FROM units ORDER BY name').fetchall()
+
+    writer = csv.writer(out)
+    writer.writerow(['الوحدة', 'الشهر', 'عدد العمليات', 'المنصرف', 'بترول (لتر)', 'ديزل (لتر)'])
+    for index, unit in enumerate(units):
+        rows = conn.execute('''
+            SELECT substr(operation_date, 1, 7) as month,
+                   COUNT(*),
+                   SUM(receipt_status_id = 1),
+                   COALESCE(SUM(petrol_quantity), 0),
+                   COALESCE(SUM(diesel_quantity), 0)
+            FROM fuel_operations
+            WHERE unit_id = ? AND operation_date >= ? AND operation_date < ?
+            GROUP BY month
+            ORDER BY month
+        ''', (unit['id'], f'{year}-01-01', f'{year + 1}-01-01')).fetchall()
+        for row in rows:
+            writer.writerow([unit['name'], *row])
+        progress((index + 1) / len(units), unit['name'])
+
+    return f'units-{year}.csv'
+
+
+def operations_export(conn, params, out, progress, chunk=1000):
+    """تصدير العمليات (مع أسماء الوحدة والحالة ونوع الصرف) في فترة اختيارية"""
+    where = ['1 = 1']
+    values = []
+    if params.get('date_from'):
+        where.append('f.operation_date >= ?')
+        values.append(params['date_from'])
+    if params.get('date_to'):
+        where.append('f.operation_date <= ?')
+        values.append(params['date_to'])
+    if params.get('unit_id'):
+        where.append('f.unit_id = ?')
+        values.append(int(params['unit_id']))
+    where = ' AND '.join(where)
+
+    total = conn.execute(f'SELECT COUNT(*) FROM fuel_operations f WHERE {where}', values).fetchone()[0]
+    cursor = conn.execute(f'''
+        SELECT f.receipt_number, f.operation_date, u.name, f.driver_name, f.vehicle_type,
+               f.petrol_quantity, f.diesel_quantity, r.name, d.name, f.purpose, f.notes, us.name
+        FROM fuel_operations f
+        LEFT JOIN units u ON f.unit_id = u.id
+        LEFT JOIN receipt_statuses r ON f.receipt_status_id = r.id
+        LEFT JOIN dispense_types d ON f.dispense_type_id = d.id
+        LEFT JOIN users us ON f.user_id = us.id
+        WHERE {where}
+        ORDER BY f.operation_date, f.id
+    ''', values)
+
+    writer = csv.writer(out)
+    writer.writerow(['رقم السند', 'التاريخ', 'الوحدة', 'السائق', 'المركبة', 'بترول (لتر)',
+                     'ديزل (لتر)', 'الحالة', 'نوع الصرف', 'الغرض', 'ملاحظات', 'المستخدم'])
+    written = 0
+    while True:
+        rows = cursor.fetchmany(chunk)
+        if not rows:
+            break
+        writer.writerows(tuple(row) for row in rows)
+        written += len(rows)
+        progress(written / total, f'{written} / {total}')
+
+    return 'operations.csv'
+
+
+def analytics_report(conn, params, out, progress):
+    """تقرير تحليلي (نفس معاملات /api/admin/analytics) بصيغة JSON"""
+    from analytics import engine
+
+    rows = engine.report(
+        conn,
+        params.get('dimensions') or ['month'],
+        params.get('measures') or ['count', 'petrol_sum', 'diesel_sum'],
+        date_from=params.get('from'),
+        date_to=params.get('to'),
+        unit_id=params.get('unit_id'),
+        dispense_type_id=params.get('dispense_type_id'),
+        status_id=params.get('status_id'),
+        window=params.get('window')
+    )
+    json.dump({'params': params, 'rows': rows}, out, ensure_ascii=False)
+    return 'analytics.json'
+
+
+# نوع المهمة: (الدالة، نوع المحتوى)؛ الدالة تكتب الناتج في out وتُرجع اسم الملف للتنزيل
+JOB_KINDS = {
+    'unit_year_report': (unit_year_report, 'text/csv'),
+    'operations_export': (operations_export, 'text/csv'),
+    'analytics_report': (analytics_report, 'application/json'),
+}
+
+
+# ============================================
+# التنفيذ داخل عملية العامل
+# ============================================
+
+# منسق كتابة لكل عملية عامل (يتسلسل مع التطبيق عبر قفل الملف نفسه)
+_writers = {}
+
+
+def _writer(database):
+    if database not in _writers:
+        _writers[database] = WriteCoordinator(database)
+    return _writers[database]
+
+
+def _set_running(conn, job_id):
+    conn.execute('''
+        UPDATE jobs SET status = 'running', started_at = datetime('now', 'localtime')
+        WHERE id = ? AND status = 'queued'
+    ''', (job_id,))
+
+
+def _set_progress(conn, job_id, fraction, message):
+    conn.execute(
+        "UPDATE jobs SET progress = ?, message = ? WHERE id = ? AND status = 'running'",
+        (fraction, message, job_id)
+    )
+
+
+def _set_done(conn, job_id, artifact, ttl):
+    conn.execute('''
+        UPDATE jobs SET status = 'done', progress = 1, message = NULL, artifact = ?,
+               finished_at = datetime('now', 'localtime'),
+               expires_at = datetime('now', 'localtime', ?)
+        WHERE id = ?
+    ''', (artifact, f'+{int(ttl)} seconds', job_id))
+
+
+def _set_failed(conn, job_id, message, ttl):
+    conn.execute('''
+        UPDATE jobs SET status = 'failed', message = ?,
+               finished_at = datetime('now', 'localtime'),
+               expires_at = datetime('now', 'localtime', ?)
+        WHERE id = ? AND status IN ('queued', 'running')
+    ''', (message, f'+{int(ttl)} seconds', job_id))
+
+
+def run_job(database, artifact_dir, job_id, kind, params, ttl):
+    """تنفيذ مهمة في عملية العامل: القراءة من نسخة التقارير والناتج في artifact_dir/<id>"""
+    writer = _writer(database)
+    writer.execute(_set_running, job_id)
+
+    last_write = [0.0]
+
+    def progress(fraction, message=None):
+        now = time.monotonic()
+        if now - last_write[0] >= PROGRESS_INTERVAL:
+            last_write[0] = now
+            writer.post(_set_progress, job_id, min(fraction, 1.0), message)
+
+    os.makedirs(artifact_dir, exist_ok=True)
+    temp_path = os.path.join(artifact_dir, f'{job_id}.tmp')
+    function, content_type = JOB_KINDS[kind]
+    # ملفات CSV بعلامة BOM حتى يقرأ Excel النص العربي
+    encoding = 'utf-8-sig' if content_type == 'text/csv' else 'utf-8'
+    conn = SnapshotStore(database).connect()
+    try:
+        with open(temp_path, 'w', encoding=encoding, newline='') as out:
+            filename = function(conn, params, out, progress)
+        path = os.path.join(artifact_dir, job_id)
+        os.replace(temp_path, path)
+        writer.execute(_set_done, job_id, json.dumps({
+            'path': path, 'content_type': content_type, 'filename': filename
+        }), ttl)
+    except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        writer.execute(_set_failed, job_id, str(e), ttl)
+        raise
+    finally:
+        conn.close()
+
+
+# ============================================
+# طابور المهام (في عملية التطبيق)
+# ============================================
+
+def params_key(params):
+    """تمثيل ثابت للمعاملات (نفس المعاملات ← نفس النص)"""
+    return json.dumps(params, sort_keys=True, ensure_ascii=False)
+
+
+class JobQueue:
+    """إنشاء المهام وإرسالها لمجمع عمليات، مع إعادة استخدام ناتج مهمة مطابقة لم تنتهِ صلاحيته"""
+
+    def __init__(self, database, writer, artifact_dir, workers=2, ttl=3600):
+        self.database = database
+        self.writer = writer
+        self.artifact_dir = artifact_dir
+        self.workers = workers
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self.submitted = 0
+        self.reused = 0
+
+    def _executor(self):
+        """مجمع عمليات لكل عامل، بعمليات spawn نظيفة (لا تُورث خيط الكاتب وأقفاله)"""
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+                self._pid = os.getpid()
+            return self._pool
+
+    def submit(self, conn, kind, params, user_id=None):
+        """إرسال مهمة: (رقم المهمة، الحالة، هل هي ناتج سابق مُعاد استخدامه)"""
+        if kind not in JOB_KINDS:
+            raise ValueError(f'نوع مهمة غير معروف: {kind}')
+        key = params_key(params)
+        self.purge()
+
+        # ناتج مهمة مطابقة لم تنتهِ صلاحيته (أو مهمة مطابقة ما زالت جارية)
+        existing = conn.execute('''
+            SELECT id, status FROM jobs
+            WHERE kind = ? AND params = ?
+            AND (status IN ('queued', 'running')
+                 OR (status = 'done' AND expires_at > datetime('now', 'localtime')))
+            ORDER BY created_at DESC LIMIT 1
+        ''', (kind, key)).fetchone()
+        if existing:
+            with self._lock:
+                self.reused += 1
+            return existing['id'], existing['status'], True
+
+        job_id = uuid.uuid4().hex
+
+        def apply(conn):
+            conn.execute('''
+                INSERT INTO jobs (id, kind, params, user_id, created_at)
+                VALUES (?, ?, ?, ?, datetime('now', 'localtime'))
+            ''', (job_id, kind, key, user_id))
+
+        self.writer.execute(apply)
+        future = self._executor().submit(
+            run_job, self.database, self.artifact_dir, job_id, kind, params, self.ttl
+        )
+        future.add_done_callback(lambda f: self._finished(job_id, f))
+        with self._lock:
+            self.submitted += 1
+        return job_id, 'queued', False
+
+    def _finished(self, job_id, future):
+        """تسجيل الفشل إذا انتهت المهمة دون أن تسجله (مثل توقف عملية العامل)"""
+        error = future.exception()
+        if error is not None:
+            self.writer.post(_set_failed, job_id, str(error) or type(error).__name__, self.ttl)
+
+    def purge(self):
+        """حذف المهام المنتهية الصلاحية ونواتجها: عدد المهام المحذوفة"""
+        def apply(conn):
+            # مهام لم تكتمل خلال مدة الصلاحية (توقف العامل الذي أرسلها)
+            conn.execute('''
+                UPDATE jobs SET status = 'failed', message = 'انقطع تنفيذ المهمة',
+                       finished_at = datetime('now', 'localtime'), expires_at = datetime('now', 'localtime', ?)
+                WHERE status IN ('queued', 'running') AND created_at <= datetime('now', 'localtime', ?)
+            ''', (f'+{int(self.ttl)} seconds', f'-{int(self.ttl)} seconds'))
+            rows = conn.execute('''
+                SELECT id, artifact FROM jobs
+                WHERE expires_at IS NOT NULL AND expires_at <= datetime('now', 'localtime')
+            ''').fetchall()
+            conn.executemany('DELETE FROM jobs WHERE id = ?', [(row[0],) for row in rows])
+            return [row[1] for row in rows]
+
+        artifacts = self.writer.execute(apply)
+        for artifact in artifacts:
+            if artifact:
+                try:
+                    os.remove(json.loads(artifact)['path'])
+                except FileNotFoundError:
+                    pass
+        return len(artifacts)
+
+    def stats(self):
+        with self._lock:
+            return {'submitted': self.submitted, 'reused': self.reused, 'workers': self.workers}
+
+
+def job_status(conn, job_id):
+    """حالة مهمة وتقدمها (أو None)"""
+    row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if not row:
+        return None
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+    job['status_name'] = STATUS_NAMES.get(job['status'], job['status'])
+    artifact = job.pop('artifact')
+    job['artifact'] = json.loads(artifact) if artifact else None
+    return job
+
+
+if __name__ == '__main__':
+    # حذف النواتج المنتهية الصلاحية (مثلاً من مهمة cron)
+    from app import job_queue
+
+    print(f"✅ تم حذف {job_queue.purge()} مهمة منتهية الصلاحية")
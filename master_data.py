@@ -0,0 +1,251 @@
+"""
+master_data.py - بيانات السائقين والمركبات الموحدة: تطبيع الأسماء العربية، ودمج تهجئاتها، وفهرس إكمال تلقائي في الذاكرة
+"""
+import difflib
+import re
+import sys
+import threading
+import time
+
+# النوع ← (الجدول، عمود الاسم في العمليات، عمود المعرف في العمليات)
+KINDS = {
+    'driver': ('drivers', 'driver_name', 'driver_id'),
+    'vehicle': ('vehicles', 'vehicle_type', 'vehicle_id'),
+}
+
+_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+_LETTERS = str.maketrans({'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و', 'ة': 'ه'})
+_SEPARATORS = re.compile(r'[\s\-_./]+')
+
+# دمج التهجئات القريبة (خطأ حرف أو حرفين): نسبة التشابه، أقصر اسم موحد يُقارن، وكم ضعفاً تُستخدم التهجئة المعتمدة
+NEAR_MATCH_RATIO = 0.9
+NEAR_MATCH_MIN_LENGTH = 8
+NEAR_MATCH_USES = 3
+
+
+def normalize(text):
+    """مفتاح المقارنة: بلا تشكيل ولا تطويل، مع توحيد الألف والياء والتاء المربوطة والمسافات"""
+    if not text:
+        return ''
+    text = _DIACRITICS.sub('', text).translate(_LETTERS).lower()
+    return _SEPARATORS.sub(' ', text).strip()
+
+
+def similar(a, b, threshold=NEAR_MATCH_RATIO):
+    """اسمان موحدان قريبان على الأرجح لنفس الشخص/المركبة: نفس عدد الكلمات وتشابه الأحرف فوق الحد
+
+    الأسماء القصيرة لا تُقارن لأن حرفاً واحداً فيها يفرق بين اسمين مختلفين (سعد/سعيد).
+    """
+    if min(len(a), len(b)) < NEAR_MATCH_MIN_LENGTH or a.count(' ') != b.count(' '):
+        return False
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    return (matcher.real_quick_ratio() >= threshold
+            and matcher.quick_ratio() >= threshold
+            and matcher.ratio() >= threshold)
+
+
+def backfill_statements(kind):
+    """إنشاء سجلات النوع من قيم العمليات الحالية (التهجئة الأكثر استخداماً لكل اسم موحد) وربط العمليات بها
+
+    الدمج هنا بالتطابق التام للاسم الموحد فقط؛ التهجئات القريبة يضمها merge_near_duplicates بعده.
+    """
+    table, name_column, id_column = KINDS[kind]
+    return [
+        f'''
+        INSERT OR IGNORE INTO {table} (name, normalized, uses, created_at)
+        SELECT name, normalized, total, datetime('now', 'localtime')
+        FROM (
+            SELECT
+                name,
+                normalized,
+                SUM(uses) OVER (PARTITION BY normalized) AS total,
+                ROW_NUMBER() OVER (PARTITION BY normalized ORDER BY uses DESC, name) AS rank
+            FROM (
+                SELECT TRIM({name_column}) AS name, normalize_ar({name_column}) AS normalized, COUNT(*) AS uses
+                FROM fuel_operations
+                WHERE normalize_ar({name_column}) != ''
+                GROUP BY TRIM({name_column})
+            )
+        )
+        WHERE rank = 1
+        ''',
+        f'''
+        UPDATE fuel_operations
+        SET {id_column} = (SELECT id FROM {table} WHERE normalized = normalize_ar(fuel_operations.{name_column}))
+        WHERE normalize_ar({name_column}) != ''
+        ''',
+        # التهجئات المختلفة لنفس الاسم تُكتب بالتهجئة المعتمدة حتى لا تتفرق التقارير
+        f'''
+        UPDATE fuel_operations
+        SET {name_column} = (SELECT name FROM {table} WHERE id = fuel_operations.{id_column})
+        WHERE {id_column} IS NOT NULL
+          AND {name_column} != (SELECT name FROM {table} WHERE id = fuel_operations.{id_column})
+        ''',
+    ]
+
+
+def merge_near_duplicates(conn, kind, threshold=NEAR_MATCH_RATIO):
+    """ضم السجلات القريبة التهجئة (similar) إلى الأكثر استخداماً منها: عدد السجلات المضمومة
+
+    يُضم السجل فقط إلى سجل يُستخدم NEAR_MATCH_USES أضعافه على الأقل، فالاسمان المتقاربان
+    الشائعان كلاهما (غالباً شخصان مختلفان) يبقيان منفصلين. العمليات المرتبطة تُنقل إلى
+    السجل المعتمد وتُكتب بتهجئته.
+    """
+    table, name_column, id_column = KINDS[kind]
+    rows = conn.execute(f'SELECT id, name, normalized, uses FROM {table} ORDER BY uses DESC, id').fetchall()
+
+    # الأكثر استخداماً أولاً: السجل المعتمد لا يُضم بعد ذلك إلى غيره
+    kept = []
+    merged = 0
+    for row_id, name, normalized, uses in rows:
+        target = next(
+            (k for k in kept if k[3] >= NEAR_MATCH_USES * uses and similar(k[2], normalized, threshold)),
+            None
+        )
+        if target is None:
+            kept.append((row_id, name, normalized, uses))
+            continue
+        conn.execute(
+            f'UPDATE fuel_operations SET {id_column} = ?, {name_column} = ? WHERE {id_column} = ?',
+            (target[0], target[1], row_id)
+        )
+        conn.execute(f'UPDATE {table} SET uses = uses + ? WHERE id = ?', (uses, target[0]))
+        conn.execute(f'DELETE FROM {table} WHERE id = ?', (row_id,))
+        merged += 1
+    return merged
+
+
+def resolve(conn, kind, name):
+    """(المعرف، الاسم المعتمد) لاسم مُدخل داخل أمر كتابة: التهجئة المسجلة إن وُجدت، وإلا سجل جديد
+
+    المطابقة هنا بالاسم الموحد تماماً؛ التهجئة القريبة الجديدة تُسجل منفصلة (اقتراحات
+    الإكمال تدل المُدخل على التهجئة المعتمدة).
+    """
+    table = KINDS[kind][0]
+    normalized = normalize(name)
+    if not normalized:
+        return None, (name or '').strip()
+
+    row = conn.execute(f'SELECT id, name FROM {table} WHERE normalized = ?', (normalized,)).fetchone()
+    if row:
+        conn.execute(f'UPDATE {table} SET uses = uses + 1 WHERE id = ?', (row[0],))
+        return row[0], row[1]
+
+    name = ' '.join(name.split())
+    cursor = conn.execute(
+        f"INSERT INTO {table} (name, normalized, uses, created_at) VALUES (?, ?, 1, datetime('now', 'localtime'))",
+        (name, normalized)
+    )
+    return cursor.lastrowid, name
+
+
+# ============================================
+# فهرس الإكمال التلقائي
+# ============================================
+
+class _Node:
+    __slots__ = ('children', 'top')
+
+    def __init__(self):
+        self.children = {}
+        self.top = []
+
+
+class Trie:
+    """شجرة بادئات على الأسماء الموحدة؛ كل عقدة تحفظ أعلى الأسماء استخداماً تحتها فالبحث بطول البادئة فقط"""
+
+    def __init__(self, entries, top=10):
+        self.root = _Node()
+        self.size = 0
+        # entries مرتبة تنازلياً بالاستخدام فتمتلئ قوائم العقد بالأكثر استخداماً أولاً
+        for name, normalized in entries:
+            self.size += 1
+            words = normalized.split(' ')
+            # البحث من بداية الاسم أو من بداية أي كلمة فيه (اسم الأب أو العائلة)
+            starts = {' '.join(words[i:]) for i in range(len(words))}
+            for key in starts:
+                node = self.root
+                for char in key:
+                    node = node.children.setdefault(char, _Node())
+                    if len(node.top) < top and name not in node.top:
+                        node.top.append(name)
+
+    def suggest(self, prefix, limit=10):
+        node = self.root
+        for char in normalize(prefix):
+            node = node.children.get(char)
+            if node is None:
+                return []
+        return node.top[:limit]
+
+
+class AutocompleteIndex:
+    """فهرس لكل نوع في ذاكرة العامل، يُعاد بناؤه عند تغير إصدار جدوله (data_versions)"""
+
+    def __init__(self, top=10):
+        self.top = top
+        self._lock = threading.Lock()
+        self._tries = {}
+        self.builds = 0
+        self.lookups = 0
+
+    def _trie(self, conn, kind):
+        table = KINDS[kind][0]
+        row = conn.execute('SELECT version FROM data_versions WHERE name = ?', (table,)).fetchone()
+        version = row[0] if row else 0
+        with self._lock:
+            cached = self._tries.get(kind)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        entries = conn.execute(f'SELECT name, normalized FROM {table} ORDER BY uses DESC, name').fetchall()
+        trie = Trie(((name, normalized) for name, normalized in entries), self.top)
+        with self._lock:
+            self._tries[kind] = (version, trie)
+            self.builds += 1
+        return trie
+
+    def suggest(self, conn, kind, prefix, limit=10):
+        """الأسماء المعتمدة التي تبدأ (هي أو إحدى كلماتها) بالبادئة، الأكثر استخداماً أولاً"""
+        trie = self._trie(conn, kind)
+        with self._lock:
+            self.lookups += 1
+        return trie.suggest(prefix, limit)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'builds': self.builds,
+                'lookups': self.lookups,
+                'entries': {kind: trie.size for kind, (_, trie) in self._tries.items()}
+            }
+
+
+autocomplete = AutocompleteIndex()
+
+
+if __name__ == '__main__':
+    # قياس زمن الاقتراح من الفهرس مقابل LIKE على جدول العمليات
+    from app import get_db_connection
+
+    prefix = sys.argv[1] if len(sys.argv) > 1 else 'اح'
+    conn = get_db_connection()
+    for kind, (table, name_column, _) in KINDS.items():
+        count = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        autocomplete.suggest(conn, kind, prefix)
+
+        start = time.perf_counter()
+        for _ in range(1000):
+            suggestions = autocomplete.suggest(conn, kind, prefix)
+        trie_ms = (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(100):
+            conn.execute(
+                f'SELECT DISTINCT {name_column} FROM fuel_operations WHERE {name_column} LIKE ? LIMIT 10',
+                (f'{prefix}%',)
+            ).fetchall()
+        like_ms = (time.perf_counter() - start) * 10
+
+        print(f'🔎 {table} ({count} اسم): الفهرس {trie_ms:.3f} مللي ثانية، LIKE {like_ms:.3f} مللي ثانية ← {suggestions}')
+    conn.close()
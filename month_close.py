@@ -0,0 +1,214 @@
+"""
+month_close.py - إغلاق الأشهر: تجميد عمليات الشهر وكتابة تقريره المجمّع في ملف مضغوط يُقرأ بدل إعادة التجميع
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+from datetime import datetime
+
+import columnar
+
+_MONTH = re.compile(r'^\d{4}-(0[1-9]|1[0-2])$')
+
+# أبعاد التقرير المحفوظ: الاسم ← (عمود التجميع، عمود العرض، الربط)
+REPORT_DIMENSIONS = {
+    'by_unit': ('f.unit_id', 'u.name', 'LEFT JOIN units u ON u.id = f.unit_id'),
+    'by_dispense_type': ('f.dispense_type_id', 'd.name', 'LEFT JOIN dispense_types d ON d.id = f.dispense_type_id'),
+    'by_driver': ('f.driver_name', 'f.driver_name', ''),
+    'by_day': ('f.operation_date', 'f.operation_date', ''),
+}
+
+_MEASURES = '''
+    COUNT(*) AS operations,
+    SUM(f.receipt_status_id = 1) AS dispensed,
+    COALESCE(SUM(f.petrol_quantity), 0) AS petrol,
+    COALESCE(SUM(f.diesel_quantity), 0) AS diesel
+'''
+
+
+class MonthCloseError(Exception):
+    """لا يمكن إغلاق الشهر أو إعادة فتحه (صيغة خاطئة، شهر جارٍ، مغلق مسبقاً، أو شهر سابق مفتوح)"""
+
+
+def closed_message(month):
+    return f'الشهر {month} مغلق: لا يمكن إضافة عملياته أو تعديلها أو حذفها'
+
+
+def closed_through(conn):
+    """آخر شهر مغلق: كل شهر حتى هذا الشهر مجمد (أو None)"""
+    return conn.execute('SELECT MAX(month) FROM closed_months').fetchone()[0]
+
+
+def is_closed(conn, month):
+    """هل الشهر مجمد (لا تُضاف عملياته ولا تُعدَّل ولا تُحذف)"""
+    through = closed_through(conn)
+    return bool(month and through and month <= through)
+
+
+def month_report(conn, month):
+    """تقرير الشهر: الإجماليات ثم التجميع حسب الوحدة ونوع الصرف والسائق واليوم"""
+    totals = conn.execute(f'SELECT {_MEASURES} FROM fuel_operations f WHERE f.month = ?', (month,)).fetchone()
+    report = {'month': month, 'totals': dict(zip(('operations', 'dispensed', 'petrol', 'diesel'), totals))}
+    report['totals']['dispensed'] = report['totals']['dispensed'] or 0
+    for name, (key, label, join) in REPORT_DIMENSIONS.items():
+        cursor = conn.execute(f'''
+            SELECT {key} AS key, {label} AS name, {_MEASURES}
+            FROM fuel_operations f
+            {join}
+            WHERE f.month = ?
+            GROUP BY {key}
+            ORDER BY petrol + diesel DESC, key
+        ''', (month,))
+        columns = [column[0] for column in cursor.description]
+        report[name] = [dict(zip(columns, row)) for row in cursor]
+    return report
+
+
+def artifact_path(month, month_dir):
+    return os.path.join(month_dir, f'fuel_operations_{month}.json.gz')
+
+
+def close_month(conn, month, user_id, month_dir, now=None):
+    """إغلاق شهر داخل أمر كتابة: كتابة التقرير المضغوط وأعمدته (columnar) وتسجيله في closed_months (الإجماليات)
+
+    الإغلاق تسلسلي: كل شهر سابق فيه عمليات يجب أن يكون مغلقاً، والشهر الجاري لا يُغلق.
+    """
+    if not _MONTH.match(month or ''):
+        raise MonthCloseError(f'صيغة الشهر غير صحيحة: {month} (المطلوب YYYY-MM)')
+    if month >= (now or datetime.now()).strftime('%Y-%m'):
+        raise MonthCloseError(f'لا يمكن إغلاق الشهر {month} قبل انتهائه')
+    through = closed_through(conn)
+    if through and month <= through:
+        raise MonthCloseError(f'الشهر {month} مغلق مسبقاً')
+    earlier = conn.execute(
+        'SELECT MIN(month) FROM fuel_operations WHERE month < ? AND month > ?',
+        (month, through or '')
+    ).fetchone()[0]
+    if earlier:
+        raise MonthCloseError(f'أغلق الشهر {earlier} أولاً')
+
+    report = month_report(conn, month)
+    report['closed_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    report['closed_by'] = user_id
+    data = gzip.compress(json.dumps(report, ensure_ascii=False).encode('utf-8'), mtime=0)
+
+    os.makedirs(month_dir, exist_ok=True)
+    path = artifact_path(month, month_dir)
+    with open(f'{path}.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(f'{path}.tmp', path)
+    columnar.write_month(conn, month, month_dir)
+
+    totals = report['totals']
+    conn.execute('''
+        INSERT INTO closed_months (month, operations, petrol, diesel, artifact, sha256, closed_by, closed_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (month, totals['operations'], totals['petrol'], totals['diesel'],
+          os.path.basename(path), hashlib.sha256(data).hexdigest(), user_id, report['closed_at']))
+    return totals
+
+
+def reopen_month(conn, month, month_dir):
+    """إعادة فتح شهر (ومعه كل شهر مغلق بعده) للتصحيح: الأشهر المعاد فتحها"""
+    months = [row[0] for row in conn.execute('SELECT month FROM closed_months WHERE month >= ? ORDER BY month', (month,))]
+    if not months:
+        raise MonthCloseError(f'الشهر {month} غير مغلق')
+    conn.execute('DELETE FROM closed_months WHERE month >= ?', (month,))
+    for reopened in months:
+        try:
+            os.remove(artifact_path(reopened, month_dir))
+        except FileNotFoundError:
+            pass
+        columnar.remove_month(reopened, month_dir)
+    return months
+
+
+class MonthArchive:
+    """تقارير الأشهر المغلقة من ملفاتها، محفوظة في ذاكرة العامل (الملف لا يتغير ما دامت بصمته نفسها)"""
+
+    def __init__(self, month_dir):
+        self.month_dir = month_dir
+        self._lock = threading.Lock()
+        self._reports = {}
+        self._cumulative = (None, None)
+        self.loads = 0
+        self.hits = 0
+
+    def closed(self, conn):
+        """الأشهر المغلقة بإجمالياتها مرتبة تصاعدياً"""
+        cursor = conn.execute('SELECT month, operations, petrol, diesel, sha256 FROM closed_months ORDER BY month')
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def report(self, month, sha256):
+        """تقرير شهر مغلق (يُقرأ الملف ويُتحقق من بصمته مرة واحدة لكل عامل)"""
+        with self._lock:
+            cached = self._reports.get(month)
+            if cached and cached[0] == sha256:
+                self.hits += 1
+                return cached[1]
+
+        with open(artifact_path(month, self.month_dir), 'rb') as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != sha256:
+            raise MonthCloseError(f'ملف تقرير الشهر {month} لا يطابق بصمته المسجلة')
+        report = json.loads(gzip.decompress(data))
+        with self._lock:
+            self._reports[month] = (sha256, report)
+            self.loads += 1
+        return report
+
+    def cumulative(self, conn, dimensions=('by_unit', 'by_dispense_type')):
+        """مجموع الأبعاد عبر كل الأشهر المغلقة: (آخر شهر مغلق، {البعد: {المفتاح: المقاييس}})"""
+        closed = self.closed(conn)
+        signature = tuple((row['month'], row['sha256']) for row in closed)
+        with self._lock:
+            if self._cumulative[0] == signature:
+                return self._cumulative[1]
+
+        totals = {name: {} for name in dimensions}
+        for month, sha256 in signature:
+            report = self.report(month, sha256)
+            for name in dimensions:
+                for row in report[name]:
+                    entry = totals[name].setdefault(row['key'], {'operations': 0, 'dispensed': 0, 'petrol': 0, 'diesel': 0})
+                    for measure in entry:
+                        entry[measure] += row[measure] or 0
+        result = (signature[-1][0] if signature else None, totals)
+        with self._lock:
+            self._cumulative = (signature, result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {'months': len(self._reports), 'loads': self.loads, 'hits': self.hits}
+
+
+if __name__ == '__main__':
+    from app import app, get_db_connection, db_writer
+
+    month_dir = app.config['MONTH_ARCHIVE_DIR']
+    command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+    try:
+        if command == 'close' and len(sys.argv) > 2:
+            totals = db_writer.execute(lambda conn: close_month(conn, sys.argv[2], None, month_dir))
+            print(f"🔒 أُغلق الشهر {sys.argv[2]}: {totals['operations']} عملية، "
+                  f"بنزين {totals['petrol']:.0f}، ديزل {totals['diesel']:.0f}")
+        elif command == 'reopen' and len(sys.argv) > 2:
+            months = db_writer.execute(lambda conn: reopen_month(conn, sys.argv[2], month_dir))
+            print(f"🔓 أُعيد فتح: {'، '.join(months)}")
+        elif command == 'status':
+            conn = get_db_connection()
+            for row in MonthArchive(month_dir).closed(conn):
+                print(f"🔒 {row['month']}: {row['operations']} عملية، بنزين {row['petrol']:.0f}، ديزل {row['diesel']:.0f}")
+            conn.close()
+        else:
+            print('الاستخدام: python month_close.py [status | close YYYY-MM | reopen YYYY-MM]')
+            sys.exit(1)
+    except MonthCloseError as e:
+        print(f'❌ {e}')
+        sys.exit(1)
@@ -0,0 +1,118 @@
+"""
+presence.py - تتبع حضور المستخدمين (النشطون اليوم / المتصلون الآن) دون المرور بسجل الأنشطة
+"""
+import threading
+import time
+from datetime import timedelta
+
+import time_windows
+
+
+def _execute(conn, query, params):
+    conn.execute(query, params)
+
+
+class PresenceTracker:
+    """آخر ظهور لكل مستخدم في الذاكرة، مع مزامنة مقيدة إلى جدول user_presence"""
+
+    def __init__(self, writer, flush_interval=60, online_window=300):
+        self._writer = writer
+        self.flush_interval = flush_interval
+        self.online_window = online_window
+        self._last_seen = {}
+        self._last_flush = {}
+        self._lock = threading.Lock()
+
+    def _write(self, query, params):
+        # عبر الكاتب دون انتظار: الطلب لا يتأخر بسبب تحديث الحضور
+        self._writer.post(_execute, query, params)
+
+    def touch(self, user_id):
+        """تسجيل نشاط مستخدم (يُكتب إلى القاعدة مرة كل flush_interval ثانية على الأكثر)"""
+        now = time_windows.local_timestamp()
+        with self._lock:
+            self._last_seen[user_id] = now
+            flushed = self._last_flush.get(user_id)
+            if flushed is not None and time.monotonic() - flushed < self.flush_interval:
+                return
+            self._last_flush[user_id] = time.monotonic()
+
+        self._write('''
+            INSERT INTO user_presence (user_id, last_seen) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)
+        ''', (user_id, now))
+
+    def login(self, user_id):
+        """تسجيل دخول مستخدم"""
+        now = time_windows.local_timestamp()
+        with self._lock:
+            self._last_seen[user_id] = now
+            self._last_flush[user_id] = time.monotonic()
+
+        self._write('''
+            INSERT INTO user_presence (user_id, last_seen, last_login, logged_out_at)
+            VALUES (?, ?, ?, NULL)
+            ON CONFLICT(user_id) DO UPDATE SET
+                last_seen = excluded.last_seen,
+                last_login = excluded.last_login,
+                logged_out_at = NULL
+        ''', (user_id, now, now))
+
+    def logout(self, user_id):
+        """تسجيل خروج مستخدم"""
+        now = time_windows.local_timestamp()
+        with self._lock:
+            self._last_seen.pop(user_id, None)
+            self._last_flush.pop(user_id, None)
+
+        self._write('''
+            INSERT INTO user_presence (user_id, last_seen, logged_out_at) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                last_seen = excluded.last_seen,
+                logged_out_at = excluded.logged_out_at
+        ''', (user_id, now, now))
+
+    def snapshot(self, conn):
+        """حالة الحضور المشتركة مدمجة مع آخر ظهور غير مكتوب في هذا العامل"""
+        users = {
+            row['id']: dict(row)
+            for row in conn.execute('''
+                SELECT u.id, u.name, p.last_seen, p.last_login, p.logged_out_at
+                FROM user_presence p
+                JOIN users u ON p.user_id = u.id
+                WHERE u.is_active = 1
+            ''').fetchall()
+        }
+
+        with self._lock:
+            local = dict(self._last_seen)
+
+        for user_id, last_seen in local.items():
+            user = users.get(user_id)
+            if user and (user['last_seen'] or '') < last_seen:
+                user['last_seen'] = last_seen
+
+        return users
+
+    def active_today(self, conn, snapshot=None):
+        """المستخدمون الذين ظهروا اليوم"""
+        start = time_windows.today().start.strftime(time_windows.TIMESTAMP_FORMAT)
+        if snapshot is None:
+            snapshot = self.snapshot(conn)
+        users = snapshot.values()
+        return sorted(
+            (user for user in users if (user['last_seen'] or '') >= start),
+            key=lambda user: user['last_seen'],
+            reverse=True
+        )
+
+    def online_now(self, conn, snapshot=None):
+        """المستخدمون المتصلون خلال نافذة online_window ولم يسجلوا الخروج بعدها"""
+        since = time_windows.local_timestamp(time_windows.local_now() - timedelta(seconds=self.online_window))
+        if snapshot is None:
+            snapshot = self.snapshot(conn)
+        return [
+            user for user in snapshot.values()
+            if (user['last_seen'] or '') >= since
+            and (user['logged_out_at'] is None or user['last_seen'] > user['logged_out_at'])
+        ]
@@ -0,0 +1,186 @@
+"""
+quota.py - الحصص الشهرية للمحروقات لكل وحدة مع رصيد جارٍ يُحدَّث داخل معاملة العملية
+"""
+import sys
+import sqlite3
+
+from writer import default_lock_path, locked_transaction
+
+FUELS = ('petrol', 'diesel')
+FUEL_NAMES = {'petrol': 'البترول', 'diesel': 'الديزل'}
+
+DISPENSED_STATUS = 1
+REFUNDED_STATUS = 4
+
+# الاستهلاك الفعلي من العمليات الخام (للمطابقة وإعادة البناء)
+USAGE_QUERY = '''
+    SELECT
+        unit_id,
+        month,
+        COALESCE(SUM(CASE WHEN receipt_status_id = 1 THEN petrol_quantity END), 0) as petrol_used,
+        COALESCE(SUM(CASE WHEN receipt_status_id = 1 THEN diesel_quantity END), 0) as diesel_used,
+        COALESCE(SUM(CASE WHEN receipt_status_id NOT IN (1, 4) THEN petrol_quantity END), 0) as petrol_reserved,
+        COALESCE(SUM(CASE WHEN receipt_status_id NOT IN (1, 4) THEN diesel_quantity END), 0) as diesel_reserved
+    FROM fuel_operations
+    WHERE unit_id IS NOT NULL AND month IS NOT NULL
+    GROUP BY unit_id, month
+'''
+
+USAGE_COLUMNS = ('petrol_used', 'diesel_used', 'petrol_reserved', 'diesel_reserved')
+
+
+def _bucket(status_id):
+    """عمود الرصيد الذي تُحتسب فيه العملية: منصرف، محجوز (غير منصرف/معلق)، أو لا شيء (مسترد)"""
+    if status_id == DISPENSED_STATUS:
+        return 'used'
+    if status_id == REFUNDED_STATUS:
+        return None
+    return 'reserved'
+
+
+def post(conn, operation, sign=1):
+    """إضافة (sign=1) أو عكس (sign=-1) أثر عملية على رصيد وحدتها في شهرها"""
+    bucket = _bucket(operation['receipt_status_id'])
+    if bucket is None or not operation['unit_id'] or not operation['month']:
+        return
+
+    petrol = sign * float(operation['petrol_quantity'] or 0)
+    diesel = sign * float(operation['diesel_quantity'] or 0)
+    conn.execute(f'''
+        INSERT INTO unit_quota_ledger (unit_id, month, petrol_{bucket}, diesel_{bucket}, updated_at)
+        VALUES (?, ?, ?, ?, datetime('now', 'localtime'))
+        ON CONFLICT(unit_id, month) DO UPDATE SET
+            petrol_{bucket} = petrol_{bucket} + excluded.petrol_{bucket},
+            diesel_{bucket} = diesel_{bucket} + excluded.diesel_{bucket},
+            updated_at = excluded.updated_at
+    ''', (operation['unit_id'], operation['month'], petrol, diesel))
+
+
+def move(conn, old, new):
+    """نقل أثر عملية من حالتها السابقة إلى حالتها الجديدة (تعديل أو صرف)"""
+    post(conn, old, -1)
+    post(conn, new, 1)
+
+
+def balance(conn, unit_id, month):
+    """رصيد وحدة في شهر (بحث بالمفتاح الأساسي)، الحصة None تعني بلا حد"""
+    row = conn.execute(
+        'SELECT * FROM unit_quota_ledger WHERE unit_id = ? AND month = ?',
+        (unit_id, month)
+    ).fetchone()
+
+    result = {'unit_id': unit_id, 'month': month}
+    for fuel in FUELS:
+        quota = row[f'{fuel}_quota'] if row else None
+        used = row[f'{fuel}_used'] if row else 0.0
+        reserved = row[f'{fuel}_reserved'] if row else 0.0
+        result.update({
+            f'{fuel}_quota': quota,
+            f'{fuel}_used': used,
+            f'{fuel}_reserved': reserved,
+            f'{fuel}_remaining': None if quota is None else quota - used - reserved,
+        })
+    return result
+
+
+def check(conn, unit_id, month, petrol, diesel, replacing=None):
+    """رسائل تجاوز الحصة لطلب جديد (replacing: العملية التي يحل محلها الطلب عند التعديل)"""
+    if not unit_id or not month:
+        return []
+
+    current = balance(conn, unit_id, month)
+    requested = {'petrol': float(petrol or 0), 'diesel': float(diesel or 0)}
+
+    # استبعاد أثر العملية نفسها عند التعديل
+    if (replacing is not None and _bucket(replacing['receipt_status_id'])
+            and str(replacing['unit_id']) == str(unit_id) and replacing['month'] == month):
+        for fuel in FUELS:
+            current[f'{fuel}_remaining'] = (
+                None if current[f'{fuel}_remaining'] is None
+                else current[f'{fuel}_remaining'] + float(replacing[f'{fuel}_quantity'] or 0)
+            )
+
+    messages = []
+    for fuel in FUELS:
+        remaining = current[f'{fuel}_remaining']
+        if remaining is not None and requested[fuel] > 0 and requested[fuel] > remaining:
+            messages.append(
+                f'تجاوز حصة {FUEL_NAMES[fuel]} لشهر {month}: المطلوب {requested[fuel]:.1f} لتر، '
+                f'المتبقي {max(remaining, 0):.1f} لتر من {current[f"{fuel}_quota"]:.1f}'
+            )
+    return messages
+
+
+def set_quota(conn, unit_id, month, petrol_quota, diesel_quota):
+    """تحديد حصة وحدة لشهر (None = بلا حد)"""
+    conn.execute('''
+        INSERT INTO unit_quota_ledger (unit_id, month, petrol_quota, diesel_quota, updated_at)
+        VALUES (?, ?, ?, ?, datetime('now', 'localtime'))
+        ON CONFLICT(unit_id, month) DO UPDATE SET
+            petrol_quota = excluded.petrol_quota,
+            diesel_quota = excluded.diesel_quota,
+            updated_at = excluded.updated_at
+    ''', (unit_id, month, petrol_quota, diesel_quota))
+
+
+def list_balances(conn, month):
+    """أرصدة جميع الوحدات النشطة في شهر"""
+    rows = conn.execute('''
+        SELECT u.id as unit_id, u.name as unit_name
+        FROM units u
+        WHERE u.is_active = 1
+        ORDER BY u.name
+    ''').fetchall()
+    return [dict(balance(conn, row['unit_id'], month), unit_name=row['unit_name']) for row in rows]
+
+
+def reconcile(conn, fix=False, tolerance=1e-6, lock_path=None, retry=None):
+    """مطابقة الأرصدة مع العمليات الخام، وإعادة بنائها عند fix=True (تحت قفل ملف الكاتب)"""
+    actual = {(row['unit_id'], row['month']): row for row in conn.execute(USAGE_QUERY).fetchall()}
+    ledger = {
+        (row['unit_id'], row['month']): row
+        for row in conn.execute(f'SELECT unit_id, month, {", ".join(USAGE_COLUMNS)} FROM unit_quota_ledger').fetchall()
+    }
+
+    mismatches = []
+    for key in sorted(set(actual) | set(ledger), key=lambda k: (k[1], k[0])):
+        for column in USAGE_COLUMNS:
+            expected = float(actual[key][column]) if key in actual else 0.0
+            recorded = float(ledger[key][column]) if key in ledger else 0.0
+            if abs(expected - recorded) > tolerance:
+                mismatches.append({'unit_id': key[0], 'month': key[1], 'column': column,
+                                   'ledger': recorded, 'actual': expected})
+
+    if fix and mismatches:
+        with locked_transaction(conn, lock_path or default_lock_path(conn), retry):
+            conn.execute(f'UPDATE unit_quota_ledger SET {", ".join(f"{c} = 0" for c in USAGE_COLUMNS)}')
+            conn.execute(f'''
+                INSERT INTO unit_quota_ledger (unit_id, month, {", ".join(USAGE_COLUMNS)}, updated_at)
+                SELECT unit_id, month, {", ".join(USAGE_COLUMNS)}, datetime('now', 'localtime')
+                FROM ({USAGE_QUERY})
+                WHERE true
+                ON CONFLICT(unit_id, month) DO UPDATE SET
+                    {", ".join(f"{c} = excluded.{c}" for c in USAGE_COLUMNS)},
+                    updated_at = excluded.updated_at
+            ''')
+
+    return mismatches
+
+
+if __name__ == '__main__':
+    fix = '--fix' in sys.argv
+
+    conn = sqlite3.connect('database.db', isolation_level=None, timeout=0)
+    conn.row_factory = sqlite3.Row
+    mismatches = reconcile(conn, fix=fix)
+    conn.close()
+
+    for item in mismatches:
+        print(f"  ⚠️ الوحدة {item['unit_id']} / {item['month']} / {item['column']}: "
+              f"الرصيد {item['ledger']:.2f} ≠ الفعلي {item['actual']:.2f}")
+    if not mismatches:
+        print("✅ أرصدة الحصص مطابقة للعمليات")
+    elif fix:
+        print(f"✅ تم تصحيح {len(mismatches)} فرق")
+    else:
+        print(f"❌ {len(mismatches)} فرق (استخدم --fix لإعادة البناء)")
@@ -0,0 +1,198 @@
+"""
+receipt_signing.py - توقيع سندات الصرف برمز QR (HMAC) والتحقق منها دون الرجوع لقاعدة البيانات
+"""
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import sqlite3
+import sys
+import tempfile
+import time
+
+import qrcode
+import qrcode.image.svg
+
+PAYLOAD_PREFIX = 'FMS1'
+
+# طول التوقيع بعد الاقتطاع (16 بايت = 128 بت)
+SIGNATURE_BYTES = 16
+
+# مصدر مفتاح التوقيع: متغير البيئة، وإلا ملف سري في مجلد instance
+KEY_ENVIRONMENT = 'RECEIPT_SIGNING_KEY'
+KEY_FILE = 'receipt_signing.key'
+
+# استعلام التحقق: بحث واحد بفهرس رقم السند الفريد
+VERIFY_QUERY = '''
+    SELECT
+        f.id,
+        f.receipt_number,
+        f.receipt_status_id,
+        f.petrol_quantity,
+        f.diesel_quantity,
+        f.driver_name,
+        f.vehicle_type,
+        f.operation_date,
+        r.name as status_name,
+        rd.redeemed_at
+    FROM fuel_operations f
+    JOIN receipt_statuses r ON f.receipt_status_id = r.id
+    LEFT JOIN receipt_redemptions rd ON rd.operation_id = f.id
+    WHERE f.receipt_number = ?
+'''
+
+
+# رسائل نتيجة التحقق
+STATUS_MESSAGES = {
+    'valid': 'سند صحيح وصالح للصرف',
+    'invalid': 'توقيع غير صالح (سند مزور أو تالف)',
+    'not_found': 'السند غير موجود',
+    'modified': 'بيانات السند تغيرت بعد الطباعة',
+    'not_dispensed': 'السند غير منصرف',
+    'redeemed': 'تم استخدام هذا السند مسبقاً',
+}
+
+
+def _quantity(value):
+    """تمثيل ثابت للكمية داخل الرمز"""
+    return f'{float(value or 0):g}'
+
+
+def load_signing_key(instance_path, committed=None):
+    """مفتاح توقيع السندات من متغير البيئة RECEIPT_SIGNING_KEY أو من instance/receipt_signing.key
+
+    إن لم يوجد الملف يُنشأ بمفتاح عشوائي مرة واحدة (بالربط الذري فيتشاركه كل العمال).
+    يرفض التشغيل إذا كان المفتاح هو القيمة المكتوبة في الشيفرة (committed): من يملك الشيفرة يزوّر السندات.
+    """
+    key = os.environ.get(KEY_ENVIRONMENT, '').strip()
+    if not key:
+        path = os.path.join(instance_path, KEY_FILE)
+        if not os.path.exists(path):
+            os.makedirs(instance_path, exist_ok=True)
+            fd, staging = tempfile.mkstemp(prefix=f'.{KEY_FILE}.', dir=instance_path)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(secrets.token_urlsafe(32))
+                os.link(staging, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(staging)
+        with open(path) as f:
+            key = f.read().strip()
+
+    if not key or key == committed:
+        raise RuntimeError(
+            'مفتاح توقيع السندات فارغ أو هو المفتاح المكتوب في الشيفرة: '
+            f'عيّن {KEY_ENVIRONMENT} أو احذف {KEY_FILE} من مجلد instance ليُنشأ مفتاح جديد'
+        )
+    return key
+
+
+class ReceiptSigner:
+    """إنشاء والتحقق من حمولة QR: FMS1:رقم_السند:بترول:ديزل:التوقيع"""
+
+    def __init__(self, secret):
+        if isinstance(secret, str):
+            secret = secret.encode('utf-8')
+        # مفتاح مشتق مخصص للسندات (لا يُستخدم مفتاح الجلسات مباشرة)
+        self._key = hmac.new(secret, b'receipt-signing', hashlib.sha256).digest()
+
+    def _signature(self, message):
+        digest = hmac.new(self._key, message.encode('utf-8'), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:SIGNATURE_BYTES]).rstrip(b'=').decode('ascii')
+
+    def sign(self, operation):
+        """حمولة موقعة لسند"""
+        message = ':'.join((
+            PAYLOAD_PREFIX,
+            str(operation['receipt_number']),
+            _quantity(operation['petrol_quantity']),
+            _quantity(operation['diesel_quantity']),
+        ))
+        return f'{message}:{self._signature(message)}'
+
+    def verify(self, payload):
+        """التحقق من التوقيع فقط (بدون قاعدة البيانات): القيم الموقعة أو None"""
+        parts = (payload or '').strip().split(':')
+        if len(parts) != 5 or parts[0] != PAYLOAD_PREFIX:
+            return None
+
+        message, signature = ':'.join(parts[:4]), parts[4]
+        if not hmac.compare_digest(signature, self._signature(message)):
+            return None
+
+        try:
+            return {
+                'receipt_number': int(parts[1]),
+                'petrol_quantity': float(parts[2]),
+                'diesel_quantity': float(parts[3]),
+            }
+        except ValueError:
+            return None
+
+
+def check_receipt(conn, signed):
+    """مطابقة القيم الموقعة مع السجل الحالي: (حالة التحقق، السجل)"""
+    operation = conn.execute(VERIFY_QUERY, (signed['receipt_number'],)).fetchone()
+    if not operation:
+        return 'not_found', None
+    if (_quantity(operation['petrol_quantity']) != _quantity(signed['petrol_quantity'])
+            or _quantity(operation['diesel_quantity']) != _quantity(signed['diesel_quantity'])):
+        return 'modified', operation
+    if operation['receipt_status_id'] != 1:
+        return 'not_dispensed', operation
+    if operation['redeemed_at']:
+        return 'redeemed', operation
+    return 'valid', operation
+
+
+def qr_svg(payload):
+    """رمز QR بصيغة SVG (لا يحتاج مكتبة صور)"""
+    image = qrcode.make(
+        payload,
+        image_factory=qrcode.image.svg.SvgPathImage,
+        error_correction=qrcode.constants.ERROR_CORRECT_M,
+        border=2
+    )
+    return image.to_string(encoding='unicode')
+
+
+def benchmark(signer, conn, count=20000):
+    """عدد عمليات التحقق في الثانية: التوقيع فقط، ثم التوقيع + البحث في القاعدة"""
+    rows = conn.execute(
+        'SELECT receipt_number, petrol_quantity, diesel_quantity FROM fuel_operations LIMIT 1000'
+    ).fetchall()
+    if not rows:
+        return None
+    payloads = [signer.sign(row) for row in rows]
+
+    start = time.perf_counter()
+    for i in range(count):
+        signer.verify(payloads[i % len(payloads)])
+    signature_rate = count / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(count):
+        check_receipt(conn, signer.verify(payloads[i % len(payloads)]))
+    full_rate = count / (time.perf_counter() - start)
+
+    return signature_rate, full_rate
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    from app import app
+
+    conn = sqlite3.connect('database.db')
+    conn.row_factory = sqlite3.Row
+    result = benchmark(ReceiptSigner(app.config['RECEIPT_SIGNING_KEY']), conn, count)
+    conn.close()
+
+    if result is None:
+        print("⚠️ لا توجد عمليات لقياس الأداء")
+    else:
+        print(f"✅ التحقق من التوقيع: {result[0]:,.0f} عملية/ثانية")
+        print(f"✅ التوقيع + البحث في القاعدة: {result[1]:,.0f} عملية/ثانية")
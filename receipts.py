@@ -0,0 +1,79 @@
+"""
+receipts.py - تخزين دائم لسندات الصرف المصيّرة (السند المنصرف لا يتغير إلا بتعديل سجله)
+"""
+import hashlib
+import os
+import threading
+
+
+def fingerprint(operation, release=''):
+    """بصمة السجل المعروض: أي تغيير في العملية أو أسمائها المرتبطة أو نسخة التطبيق يبطل السند المخزن"""
+    content = repr((release, sorted(dict(operation).items())))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class ReceiptCache:
+    """ملف HTML لكل عملية على القرص، يحمل بصمة السجل في سطره الأول
+
+    release: بصمة نسخة التطبيق (http_cache.release_token) فلا يُقدَّم بعد النشر سند صُيِّر بقوالب سابقة.
+    """
+
+    def __init__(self, directory, release=''):
+        self.directory = directory
+        self.release = release
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, operation_id):
+        return os.path.join(self.directory, f'{int(operation_id)}.html')
+
+    def get(self, operation):
+        """السند المخزن إذا كانت بصمته مطابقة للسجل الحالي (أو None)"""
+        header = f'<!-- {fingerprint(operation, self.release)} -->\n'
+        try:
+            with open(self._path(operation['id']), encoding='utf-8') as f:
+                if f.readline() == header:
+                    with self._lock:
+                        self.hits += 1
+                    return f.read()
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, operation, html):
+        """حفظ سند مصيّر (كتابة ذرية عبر ملف مؤقت)"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(operation['id'])
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(f'<!-- {fingerprint(operation, self.release)} -->\n')
+            f.write(html)
+        os.replace(temp_path, path)
+
+    def render(self, operation, render):
+        """السند المخزن أو تصييره بالدالة render وحفظه"""
+        html = self.get(operation)
+        if html is None:
+            html = render(operation)
+            self.set(operation, html)
+        return html
+
+    def invalidate(self, operation_id):
+        """حذف السند المخزن لعملية"""
+        try:
+            os.remove(self._path(operation_id))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        """إحصائيات الإصابة للعامل الحالي"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / total * 100) if total > 0 else 0
+            }
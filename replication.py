@@ -0,0 +1,608 @@
+"""
+replication.py - النسخ بين مواقع الألوية: سجل تغييرات لكل صف، وحزم تغييرات مضغوطة تُصدَّر وتُستورد تدريجياً
+"""
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+from anomaly import AnomalyDetector
+import inventory
+import master_data
+import quota
+
+CHANGESET_FORMAT = 'fms-changeset/1'
+
+# طابع التغييرات المسجلة للصفوف الموجودة قبل تفعيل السجل (أي تعديل لاحق يتغلب عليها)
+BASELINE_STAMP = '1970-01-01 00:00:00'
+
+# حجم نطاق أرقام السندات لكل موقع (الموقع ذو receipt_base = 0 يبقى على الترقيم الحالي)
+RECEIPT_BLOCK = 10_000_000
+
+# الجداول المنسوخة بترتيب الاعتماد: مفتاح الصف عبر المواقع (عمود طبيعي، أو None أي (الموقع، المعرف الأصلي))
+# والأحداث المسجلة والأعمدة المنسوخة. الحسابات لا تُنسخ كلمات مرورها ولا حذفها، وسجل الأنشطة إضافة فقط
+# (الأرشفة تحذف منه محلياً).
+TABLES = {
+    'units': {
+        'key': 'name',
+        'events': ('INSERT', 'UPDATE', 'DELETE'),
+        'columns': ('name', 'code', 'is_active'),
+    },
+    'dispense_types': {
+        'key': 'name',
+        'events': ('INSERT', 'UPDATE', 'DELETE'),
+        'columns': ('name', 'description'),
+    },
+    'receipt_statuses': {
+        'key': 'name',
+        'events': ('INSERT', 'UPDATE', 'DELETE'),
+        'columns': ('name', 'color_code'),
+    },
+    'users': {
+        'key': 'username',
+        'events': ('INSERT', 'UPDATE'),
+        'columns': ('username', 'name', 'role', 'unit_id'),
+    },
+    'fuel_operations': {
+        'key': None,
+        'events': ('INSERT', 'UPDATE', 'DELETE'),
+        'columns': (
+            'operation_date', 'unit_id', 'driver_name', 'vehicle_type', 'petrol_quantity',
+            'diesel_quantity', 'operation_officer', 'receipt_status_id', 'receipt_number',
+            'dispense_type_id', 'purpose', 'month', 'notes', 'user_id', 'created_at', 'updated_at'
+        ),
+    },
+    'activity_logs': {
+        'key': None,
+        'events': ('INSERT',),
+        'columns': ('user_id', 'action', 'table_name', 'record_id', 'details', 'ip_address', 'created_at'),
+    },
+}
+
+# اسم إصدار البيانات الذي يزداد مع كل استيراد يغير العمليات (القيم المستوردة تحمل updated_at موقعها الأصل)
+IMPORTS_VERSION = 'replication_imports'
+
+# الأعمدة التي يتغير بتغيرها أثر العملية المنصرفة على المخزون وإحصائيات الشذوذ
+DISPENSE_COLUMNS = ('receipt_status_id', 'petrol_quantity', 'diesel_quantity', 'unit_id', 'driver_name', 'vehicle_type')
+
+# أعمدة المعرفات المحلية تُنسخ بالمفتاح الطبيعي للصف المشار إليه: (اسم الحقل، الجدول، العمود)
+REFERENCES = {
+    'unit_id': ('unit', 'units', 'name'),
+    'user_id': ('user', 'users', 'username'),
+    'dispense_type_id': ('dispense_type', 'dispense_types', 'name'),
+    'receipt_status_id': ('receipt_status', 'receipt_statuses', 'name'),
+}
+
+
+class ReplicationError(Exception):
+    """حزمة تغييرات لا يمكن استيرادها (صيغة غير معروفة، أو من الموقع نفسه، أو فجوة في التسلسل)"""
+
+
+# ============================================
+# توليد المشغلات
+# ============================================
+
+def _origin_site_sql(table, local_id):
+    return (f"COALESCE((SELECT replication_rows.origin_site FROM replication_rows "
+            f"WHERE replication_rows.table_name = '{table}' AND replication_rows.local_id = {local_id}), "
+            f"(SELECT site_id FROM replication_site))")
+
+
+def _origin_id_sql(table, local_id):
+    return (f"COALESCE((SELECT replication_rows.origin_id FROM replication_rows "
+            f"WHERE replication_rows.table_name = '{table}' AND replication_rows.local_id = {local_id}), "
+            f"{local_id})")
+
+
+def _key_sql(table, row):
+    """مفتاح الصف عبر المواقع كمصفوفة JSON"""
+    key = TABLES[table]['key']
+    if key:
+        return f'json_array({row}.{key})'
+    return f"json_array({_origin_site_sql(table, f'{row}.id')}, {_origin_id_sql(table, f'{row}.id')})"
+
+
+def _fields_sql(table, row):
+    """أزواج (الحقل، التعبير) لمحتوى الصف بصيغة لا تعتمد على المعرفات المحلية"""
+    for column in TABLES[table]['columns']:
+        if column in REFERENCES:
+            field, ref_table, ref_column = REFERENCES[column]
+            yield field, f'(SELECT {ref_column} FROM {ref_table} WHERE id = {row}.{column})'
+        elif table == 'activity_logs' and column == 'record_id':
+            is_operation = f"{row}.table_name = 'fuel_operations'"
+            yield 'record_site', f"CASE WHEN {is_operation} THEN {_origin_site_sql('fuel_operations', f'{row}.record_id')} END"
+            yield 'record_id', (f"CASE WHEN {is_operation} THEN {_origin_id_sql('fuel_operations', f'{row}.record_id')} "
+                                f"ELSE {row}.record_id END")
+        else:
+            yield column, f'{row}.{column}'
+
+
+def _row_sql(table, row, previous=None):
+    pairs = [f"'{field}', {expression}" for field, expression in _fields_sql(table, row)]
+    key = TABLES[table]['key']
+    if previous and key:
+        # إعادة تسمية المفتاح الطبيعي: يجد الموقع الآخر الصف باسمه السابق
+        pairs.append(f"'previous', CASE WHEN {previous}.{key} IS NOT {row}.{key} THEN {previous}.{key} END")
+    return f"json_object({', '.join(pairs)})"
+
+
+def _stamp_sql(table, key):
+    """وقت التغيير المحلي: الآن، أو بعد آخر تغيير معروف لنفس الصف بثانية (حتى لا يخسر أمام تغيير سبقه)"""
+    return (f"MAX(datetime('now', 'localtime'), COALESCE((SELECT datetime(MAX(changed_at), '+1 second') "
+            f"FROM change_log WHERE table_name = '{table}' AND row_key = {key}), ''))")
+
+
+def trigger_statements():
+    """مشغلات تسجيل التغييرات المحلية في change_log (معطلة أثناء تطبيق حزمة مستوردة)"""
+    statements = []
+    for table, spec in TABLES.items():
+        for event in spec['events']:
+            row = 'OLD' if event == 'DELETE' else 'NEW'
+            key = _key_sql(table, row)
+            if event == 'DELETE':
+                operation, data = 'delete', 'NULL'
+            else:
+                operation, data = 'upsert', _row_sql(table, row, 'OLD' if event == 'UPDATE' else None)
+            columns = f" OF {', '.join(spec['columns'])}" if event == 'UPDATE' else ''
+            cleanup = ''
+            if event == 'DELETE' and spec['key'] is None:
+                cleanup = f"\n                DELETE FROM replication_rows WHERE table_name = '{table}' AND local_id = OLD.id;"
+            statements.append(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_changes_{event.lower()}
+            AFTER {event}{columns} ON {table}
+            WHEN (SELECT applying FROM replication_site) = 0
+            BEGIN
+                INSERT INTO change_log (site_id, table_name, row_key, operation, row_data, changed_at)
+                VALUES ((SELECT site_id FROM replication_site), '{table}', {key}, '{operation}', {data}, {_stamp_sql(table, key)});{cleanup}
+            END
+            ''')
+    return statements
+
+
+def backfill_statements():
+    """تسجيل الصفوف الموجودة قبل تفعيل السجل كتغييرات أساس (أول تصدير يحمل البيانات كاملة)"""
+    return [
+        f'''
+        INSERT INTO change_log (site_id, table_name, row_key, operation, row_data, changed_at)
+        SELECT (SELECT site_id FROM replication_site), '{table}', {_key_sql(table, table)}, 'upsert',
+               {_row_sql(table, table)}, '{BASELINE_STAMP}'
+        FROM {table}
+        ORDER BY id
+        '''
+        for table in TABLES
+    ]
+
+
+# ============================================
+# الموقع وأرقام السندات
+# ============================================
+
+def site(conn):
+    """(معرف الموقع، بداية نطاق أرقام سنداته)"""
+    return tuple(conn.execute('SELECT site_id, receipt_base FROM replication_site').fetchone())
+
+
+def set_site_id(conn, new_site_id):
+    """تغيير معرف الموقع (لقاعدة منسوخة من موقع آخر): الصفوف الموجودة تبقى منسوبة إلى معرفها السابق"""
+    old_site_id, _ = site(conn)
+    if new_site_id == old_site_id:
+        return
+    for table, spec in TABLES.items():
+        if spec['key'] is None:
+            conn.execute(f'''
+                INSERT INTO replication_rows (table_name, origin_site, origin_id, local_id)
+                SELECT ?, ?, id, id FROM {table}
+                WHERE id NOT IN (SELECT local_id FROM replication_rows WHERE table_name = ?)
+            ''', (table, old_site_id, table))
+    # تغييرات المعرف السابق موجودة هنا: نسخها العائدة من المواقع الأخرى مكررة
+    conn.execute('''
+        INSERT OR REPLACE INTO replication_vector (site_id, version)
+        SELECT ?, COALESCE(MAX(COALESCE(site_version, version)), 0) FROM change_log WHERE site_id = ?
+    ''', (old_site_id, old_site_id))
+    conn.execute('UPDATE replication_site SET site_id = ?', (new_site_id,))
+    conn.commit()
+
+
+def next_receipt_number(conn):
+    """رقم السند التالي داخل نطاق هذا الموقع (لا يتصادم مع سندات المواقع الأخرى المنسوخة)"""
+    _, base = site(conn)
+    return conn.execute(
+        'SELECT COALESCE(MAX(receipt_number), ?) + 1 FROM fuel_operations WHERE receipt_number > ? AND receipt_number < ?',
+        (base + 1000, base, base + RECEIPT_BLOCK)
+    ).fetchone()[0]
+
+
+def status(conn):
+    """حالة النسخ: الموقع، آخر إصدار محلي، ما صُدِّر لكل نظير واستُورد منه، والتعارضات المعلقة"""
+    site_id, receipt_base = site(conn)
+    return {
+        'site_id': site_id,
+        'receipt_base': receipt_base,
+        'version': conn.execute('SELECT COALESCE(MAX(version), 0) FROM change_log').fetchone()[0],
+        'peers': [dict(zip(('peer', 'exported_version', 'received_version', 'updated_at'), row))
+                  for row in conn.execute('SELECT peer, exported_version, received_version, updated_at FROM replication_peers ORDER BY peer')],
+        'conflicts': conn.execute('SELECT COUNT(*) FROM replication_conflicts').fetchone()[0],
+    }
+
+
+# ============================================
+# التصدير
+# ============================================
+
+def export_changeset(conn, peer, path, since=None):
+    """كتابة التغييرات التي لم تُرسل إلى peer في حزمة مضغوطة: عدد التغييرات
+
+    since يعيد الإرسال من إصدار محلي معين (بعد ضياع حزمة). تغييرات peer نفسه لا تُعاد إليه.
+    """
+    site_id, _ = site(conn)
+    if peer == site_id:
+        raise ReplicationError('لا يمكن التصدير إلى الموقع نفسه')
+    if since is None:
+        row = conn.execute('SELECT exported_version FROM replication_peers WHERE peer = ?', (peer,)).fetchone()
+        since = row[0] if row else 0
+    to_version = conn.execute('SELECT COALESCE(MAX(version), 0) FROM change_log').fetchone()[0]
+
+    rows = conn.execute('''
+        SELECT site_id, COALESCE(site_version, version), table_name, row_key, operation, row_data, changed_at
+        FROM change_log
+        WHERE version > ? AND version <= ? AND site_id != ?
+        ORDER BY version
+    ''', (since, to_version, peer))
+
+    count = 0
+    temp_path = f'{path}.tmp'
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+        header = {'format': CHANGESET_FORMAT, 'site': site_id, 'peer': peer,
+                  'from_version': since, 'to_version': to_version}
+        f.write(json.dumps(header, ensure_ascii=False) + '\n')
+        for origin, version, table, key, operation, data, changed_at in rows:
+            change = {'site': origin, 'version': version, 'table': table, 'key': json.loads(key),
+                      'op': operation, 'at': changed_at, 'row': json.loads(data) if data else None}
+            f.write(json.dumps(change, ensure_ascii=False) + '\n')
+            count += 1
+    os.replace(temp_path, path)
+
+    conn.execute('''
+        INSERT INTO replication_peers (peer, exported_version, updated_at)
+        VALUES (?, ?, datetime('now', 'localtime'))
+        ON CONFLICT(peer) DO UPDATE SET exported_version = excluded.exported_version, updated_at = excluded.updated_at
+    ''', (peer, to_version))
+    conn.commit()
+    return count
+
+
+# ============================================
+# الاستيراد
+# ============================================
+
+def _key_text(key):
+    """المفتاح بنفس نص json_array في SQLite (للمقارنة مع change_log.row_key)"""
+    return json.dumps(key, ensure_ascii=False, separators=(',', ':'))
+
+
+def _read_changeset(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('format') != CHANGESET_FORMAT:
+            raise ReplicationError(f'صيغة حزمة غير معروفة: {header.get("format")}')
+        return header, [json.loads(line) for line in f if line.strip()]
+
+
+def _local_ref(conn, table, column, value):
+    if value is None:
+        return None
+    row = conn.execute(f'SELECT id FROM {table} WHERE {column} = ?', (value,)).fetchone()
+    return row[0] if row else None
+
+
+def _local_id(conn, table, key, site_id):
+    """المعرف المحلي لصف بمفتاحه عبر المواقع (أو None إن لم يكن موجوداً)"""
+    spec = TABLES[table]
+    if spec['key']:
+        return _local_ref(conn, table, spec['key'], key[0])
+    origin_site, origin_id = key
+    if origin_site == site_id:
+        row = conn.execute(f'SELECT id FROM {table} WHERE id = ?', (origin_id,)).fetchone()
+    else:
+        row = conn.execute('''
+            SELECT local_id FROM replication_rows
+            WHERE table_name = ? AND origin_site = ? AND origin_id = ?
+        ''', (table, origin_site, origin_id)).fetchone()
+    return row[0] if row else None
+
+
+def _local_values(conn, table, row, site_id):
+    """أعمدة الصف المحلية من محتوى التغيير (المراجع بالمفتاح الطبيعي تتحول إلى معرفات محلية)"""
+    values = {}
+    for column in TABLES[table]['columns']:
+        if column in REFERENCES:
+            field, ref_table, ref_column = REFERENCES[column]
+            values[column] = _local_ref(conn, ref_table, ref_column, row.get(field))
+        elif table == 'activity_logs' and column == 'record_id' and row.get('record_site'):
+            values[column] = _local_id(conn, 'fuel_operations', (row['record_site'], row['record_id']), site_id)
+        else:
+            values[column] = row.get(column)
+    if table == 'fuel_operations':
+        # ربط العملية بسجل السائق والمركبة المحلي (الاسم يبقى كما ورد من موقعه)
+        for kind, (_, name_column, id_column) in master_data.KINDS.items():
+            values[id_column] = master_data.resolve(conn, kind, values[name_column])[0]
+    return values
+
+
+def _post_operation(conn, old, new, detector):
+    """آثار تغيير عملية مستوردة كما يكتبها التطبيق محلياً: رصيد الحصة، مخزون الخزانات، إحصائيات الشذوذ وعلامتها
+
+    old/new: الصف قبل التغيير وبعده (None للإضافة والحذف).
+    """
+    dispensed_before = old is not None and old['receipt_status_id'] == quota.DISPENSED_STATUS
+    dispensed_after = new is not None and new['receipt_status_id'] == quota.DISPENSED_STATUS
+    unchanged = dispensed_before and dispensed_after and all(old[c] == new[c] for c in DISPENSE_COLUMNS)
+
+    if old is not None:
+        quota.post(conn, old, -1)
+        if dispensed_before and not unchanged:
+            detector.forget(conn, old)
+            inventory.reverse_operation(conn, old['id'])
+
+    if new is None:
+        detector.flag(conn, old['id'], 0, [])
+        conn.execute('DELETE FROM receipt_redemptions WHERE operation_id = ?', (old['id'],))
+        return
+
+    # التقييم مقابل ما سبق العملية، ثم إضافتها إلى الإحصائيات والخصم من الخزانات
+    detector.check(conn, new)
+    if dispensed_after and not unchanged:
+        detector.observe(conn, new)
+        inventory.record_dispense(conn, new)
+    quota.post(conn, new)
+
+
+def _operation(conn, local_id):
+    return conn.execute('SELECT * FROM fuel_operations WHERE id = ?', (local_id,)).fetchone()
+
+
+def _apply(conn, change, site_id, detector):
+    table, key, row = change['table'], change['key'], change['row']
+    spec = TABLES[table]
+    local_id = _local_id(conn, table, key, site_id)
+    if local_id is None and row and row.get('previous'):
+        local_id = _local_ref(conn, table, spec['key'], row['previous'])
+    operations = table == 'fuel_operations'
+    old = _operation(conn, local_id) if operations and local_id is not None else None
+
+    if change['op'] == 'delete':
+        if local_id is not None:
+            conn.execute(f'DELETE FROM {table} WHERE id = ?', (local_id,))
+            if spec['key'] is None:
+                conn.execute('DELETE FROM replication_rows WHERE table_name = ? AND local_id = ?', (table, local_id))
+            if old is not None:
+                _post_operation(conn, old, None, detector)
+        return
+
+    values = _local_values(conn, table, row, site_id)
+    if local_id is not None:
+        assignments = ', '.join(f'{column} = ?' for column in values)
+        conn.execute(f'UPDATE {table} SET {assignments} WHERE id = ?', (*values.values(), local_id))
+        if operations:
+            _post_operation(conn, old, _operation(conn, local_id), detector)
+        return
+
+    if table == 'users':
+        # حساب من موقع آخر: للإسناد فقط، غير مفعل وبلا كلمة مرور صالحة هنا
+        values.update(password='!', is_active=0)
+    if spec['key'] is None and key[0] == site_id:
+        # صف أصله هذا الموقع حُذف هنا ثم عُدِّل في موقع آخر: يعود بمعرفه الأصلي
+        values['id'] = key[1]
+    columns = ', '.join(values)
+    placeholders = ', '.join('?' for _ in values)
+    cursor = conn.execute(f'INSERT INTO {table} ({columns}) VALUES ({placeholders})', tuple(values.values()))
+    if spec['key'] is None and key[0] != site_id:
+        conn.execute('''
+            INSERT OR REPLACE INTO replication_rows (table_name, origin_site, origin_id, local_id)
+            VALUES (?, ?, ?, ?)
+        ''', (table, key[0], key[1], cursor.lastrowid))
+    if operations:
+        _post_operation(conn, None, _operation(conn, cursor.lastrowid), detector)
+
+
+def import_changeset(conn, path, detector=None):
+    """تطبيق حزمة تغييرات من موقع آخر في معاملة واحدة: إحصائيات التطبيق
+
+    التطبيق تدريجي: يُتجاوز كل تغيير سبق تطبيقه (متجه آخر إصدار لكل موقع أصل). التعارض على
+    نفس الصف يُحسم بآخر كاتب: الأكبر (وقت التغيير، معرف الموقع) يفوز في كل المواقع بنفس النتيجة.
+    التغيير الذي يخالف قيداً محلياً (رقم سند مكرر مثلاً) يُحفظ في replication_conflicts.
+    تغييرات العمليات تُحدِّث رصيد الحصة والمخزون وإحصائيات الشذوذ (detector) كما في التطبيق.
+    """
+    header, changes = _read_changeset(path)
+    site_id, _ = site(conn)
+    source = header['site']
+    if source == site_id:
+        raise ReplicationError('الحزمة صادرة من هذا الموقع')
+    if header.get('peer') not in (None, site_id):
+        raise ReplicationError(f'الحزمة موجهة إلى الموقع {header["peer"]}')
+
+    row = conn.execute('SELECT received_version FROM replication_peers WHERE peer = ?', (source,)).fetchone()
+    received = row[0] if row else 0
+    if header['from_version'] > received:
+        raise ReplicationError(
+            f'فجوة في التسلسل: آخر ما استُورد من {source} هو الإصدار {received} والحزمة تبدأ بعد {header["from_version"]} '
+            f'(أعد التصدير من هناك بـ --since {received})'
+        )
+
+    stats = {'applied': 0, 'duplicate': 0, 'superseded': 0, 'conflicts': 0}
+    vector = dict(conn.execute('SELECT site_id, version FROM replication_vector'))
+    detector = detector or AnomalyDetector()
+    operations_changed = False
+
+    # دوال الحصة والمخزون والشذوذ تقرأ الأعمدة بالاسم
+    row_factory, conn.row_factory = conn.row_factory, sqlite3.Row
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('UPDATE replication_site SET applying = 1')
+        for change in changes:
+            origin, version = change['site'], change['version']
+            if origin == site_id or version <= vector.get(origin, 0):
+                stats['duplicate'] += 1
+                continue
+            vector[origin] = version
+
+            key = _key_text(change['key'])
+            current = conn.execute('''
+                SELECT changed_at, site_id FROM change_log
+                WHERE table_name = ? AND row_key = ?
+                ORDER BY changed_at DESC, site_id DESC
+                LIMIT 1
+            ''', (change['table'], key)).fetchone()
+            if current and (change['at'], origin) <= tuple(current):
+                stats['superseded'] += 1
+                continue
+
+            conn.execute('SAVEPOINT replication_change')
+            try:
+                _apply(conn, change, site_id, detector)
+            except sqlite3.IntegrityError as e:
+                conn.execute('ROLLBACK TO replication_change')
+                conn.execute('''
+                    INSERT INTO replication_conflicts (site_id, site_version, table_name, row_key, change, reason, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, datetime('now', 'localtime'))
+                ''', (origin, version, change['table'], key, json.dumps(change, ensure_ascii=False), str(e)))
+                stats['conflicts'] += 1
+                continue
+            finally:
+                conn.execute('RELEASE replication_change')
+
+            conn.execute('''
+                INSERT INTO change_log (site_id, site_version, table_name, row_key, operation, row_data, changed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (origin, version, change['table'], key, change['op'],
+                  json.dumps(change['row'], ensure_ascii=False) if change['row'] else None, change['at']))
+            stats['applied'] += 1
+            operations_changed = operations_changed or change['table'] == 'fuel_operations'
+
+        if operations_changed:
+            conn.execute('UPDATE data_versions SET version = version + 1 WHERE name = ?', (IMPORTS_VERSION,))
+
+        conn.executemany('''
+            INSERT INTO replication_vector (site_id, version) VALUES (?, ?)
+            ON CONFLICT(site_id) DO UPDATE SET version = MAX(version, excluded.version)
+        ''', vector.items())
+        conn.execute('''
+            INSERT INTO replication_peers (peer, received_version, updated_at)
+            VALUES (?, ?, datetime('now', 'localtime'))
+            ON CONFLICT(peer) DO UPDATE SET
+                received_version = MAX(received_version, excluded.received_version),
+                updated_at = excluded.updated_at
+        ''', (source, header['to_version']))
+        conn.execute('UPDATE replication_site SET applying = 0')
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.row_factory = row_factory
+    return stats
+
+
+# ============================================
+# سطر الأوامر
+# ============================================
+
+def connect(database):
+    """اتصال للنسخ بعد تطبيق ترحيلات المخطط (المعاملات تُدار صراحةً)"""
+    from database import upgrade_database
+    upgrade_database(database)
+    conn = sqlite3.connect(database, timeout=30, isolation_level=None)
+    return conn
+
+
+def _demo():
+    """موقعان من نسخة واحدة: عمليات في كل منهما وتعديل متزامن لنفس العملية، ثم تبادل الحزم"""
+    work_dir = tempfile.mkdtemp(prefix='replication-')
+    a_path, b_path = os.path.join(work_dir, 'site_a.db'), os.path.join(work_dir, 'site_b.db')
+    shutil.copy('database.db', a_path)
+    a = connect(a_path)
+    set_site_id(a, 'site-a')
+    a.close()
+    shutil.copy(a_path, b_path)
+    a, b = connect(a_path), connect(b_path)
+    set_site_id(b, 'site-b')
+    b.execute('UPDATE replication_site SET receipt_base = ?', (RECEIPT_BLOCK,))
+
+    def add(conn, driver):
+        conn.execute('''
+            INSERT INTO fuel_operations (operation_date, unit_id, driver_name, vehicle_type, petrol_quantity,
+                                         receipt_status_id, receipt_number, dispense_type_id, month, user_id,
+                                         created_at, updated_at)
+            VALUES (date('now', 'localtime'), 1, ?, 'تجربة', 20, 2, ?, 1, strftime('%Y-%m', 'now', 'localtime'), 1,
+                    datetime('now', 'localtime'), datetime('now', 'localtime'))
+        ''', (driver, next_receipt_number(conn)))
+
+    add(a, 'سائق أ')
+    changes = os.path.join(work_dir, 'a_to_b.changeset.gz')
+    print(f'📤 من site-a إلى site-b: {export_changeset(a, "site-b", changes)} تغيير، {os.path.getsize(changes)} بايت')
+    print(f'📥 site-b: {import_changeset(b, changes)}')
+
+    add(b, 'سائق ب')
+    shared = a.execute("SELECT receipt_number FROM fuel_operations WHERE driver_name = 'سائق أ'").fetchone()[0]
+    a.execute("UPDATE fuel_operations SET notes = 'تعديل أ' WHERE receipt_number = ?", (shared,))
+    b.execute("UPDATE fuel_operations SET notes = 'تعديل ب' WHERE receipt_number = ?", (shared,))
+
+    for source, target, source_name, target_name in ((a, b, 'site-a', 'site-b'), (b, a, 'site-b', 'site-a')):
+        changes = os.path.join(work_dir, f'{source_name}_to_{target_name}.changeset.gz')
+        print(f'📤 من {source_name} إلى {target_name}: {export_changeset(source, target_name, changes)} تغيير')
+        print(f'📥 {target_name}: {import_changeset(target, changes)}')
+
+    query = 'SELECT receipt_number, driver_name, notes FROM fuel_operations ORDER BY receipt_number'
+    rows_a, rows_b = a.execute(query).fetchall(), b.execute(query).fetchall()
+    print(f"{'✅ متطابقان' if rows_a == rows_b else '❌ مختلفان'}: {rows_a[-2:]}")
+    shutil.rmtree(work_dir)
+    return rows_a == rows_b
+
+
+if __name__ == '__main__':
+    usage = '''الاستخدام:
+  python replication.py status
+  python replication.py site [--id معرف] [--receipt-base رقم]
+  python replication.py export <معرف النظير> <ملف> [--since إصدار]
+  python replication.py import <ملف>
+  python replication.py demo'''
+    args = sys.argv[1:]
+    command = args[0] if args else 'status'
+
+    def option(name, default=None):
+        return args[args.index(name) + 1] if name in args else default
+
+    if command == 'demo':
+        sys.exit(0 if _demo() else 1)
+
+    conn = connect(option('--database', 'database.db'))
+    try:
+        if command == 'status':
+            print(json.dumps(status(conn), ensure_ascii=False, indent=2))
+        elif command == 'site':
+            # موقع جديد منسوخ من قاعدة موقع آخر يحتاج معرفاً ونطاق سندات خاصين به
+            if option('--id'):
+                set_site_id(conn, option('--id'))
+            if option('--receipt-base'):
+                conn.execute('UPDATE replication_site SET receipt_base = ?', (int(option('--receipt-base')),))
+            site_id, receipt_base = site(conn)
+            print(f'🏷️ الموقع {site_id}، أرقام السندات من {receipt_base + 1001}')
+        elif command == 'export' and len(args) >= 3:
+            since = option('--since')
+            count = export_changeset(conn, args[1], args[2], int(since) if since is not None else None)
+            print(f'📤 {count} تغيير إلى {args[2]} ({os.path.getsize(args[2])} بايت)')
+        elif command == 'import' and len(args) >= 2:
+            stats = import_changeset(conn, args[1])
+            print(f"📥 طُبِّق {stats['applied']}، مكرر {stats['duplicate']}، "
+                  f"متجاوز بتعديل أحدث {stats['superseded']}، تعارضات {stats['conflicts']}")
+        else:
+            print(usage)
+            sys.exit(1)
+    except ReplicationError as e:
+        print(f'❌ {e}')
+        sys.exit(1)
+    finally:
+        conn.close()
@@ -0,0 +1,392 @@
+"""
+repository.py - طبقة الوصول لبيانات العمليات: استعلامات ثابتة معدّة مسبقاً وسجلات مدمجة (__slots__)
+"""
+import itertools
+import sys
+import time
+import tracemalloc
+
+# ============================================
+# أجزاء الاستعلامات
+# ============================================
+
+OPERATION_COLUMNS = '''
+        f.*,
+        u.name as unit_name,
+        r.name as status_name,
+        r.color_code,
+        r.color_code as status_color,
+        d.name as dispense_name,
+        us.name as user_name,
+        us.role as user_role'''
+
+OPERATION_JOINS = '''
+    FROM fuel_operations f
+    LEFT JOIN units u ON f.unit_id = u.id
+    JOIN receipt_statuses r ON f.receipt_status_id = r.id
+    JOIN dispense_types d ON f.dispense_type_id = d.id
+    JOIN users us ON f.user_id = us.id'''
+
+# آخر صرف للعملية (من operation_audit: يبقى بعد أرشفة سجل الأنشطة)
+DISPENSE_COLUMNS = '''
+        da.dispensed_at,
+        dus.name as dispensed_by,
+        da.dispense_notes'''
+
+DISPENSE_JOINS = '''
+    LEFT JOIN operation_audit da ON da.operation_id = f.id
+    LEFT JOIN users dus ON da.dispensed_by = dus.id'''
+
+# آخر تعديل للعملية
+EDIT_COLUMNS = '''
+        ea.last_updated_at,
+        eus.name as last_updater'''
+
+EDIT_JOINS = '''
+    LEFT JOIN operation_audit ea ON ea.operation_id = f.id
+    LEFT JOIN users eus ON ea.last_updated_by = eus.id'''
+
+ANOMALY_COLUMNS = '''
+        an.score as anomaly_score,
+        an.reasons as anomaly_reasons'''
+
+ANOMALY_JOINS = '''
+    LEFT JOIN operation_anomalies an ON an.operation_id = f.id'''
+
+EXTRAS = {
+    'dispense': (DISPENSE_COLUMNS, DISPENSE_JOINS),
+    'edit': (EDIT_COLUMNS, EDIT_JOINS),
+    'anomaly': (ANOMALY_COLUMNS, ANOMALY_JOINS),
+}
+
+
+def _select(*extras, where='', order='', limit=False):
+    """تركيب نص استعلام ثابت (يُستدعى عند التحميل فقط)"""
+    columns = [OPERATION_COLUMNS] + [EXTRAS[name][0] for name in extras]
+    joins = [OPERATION_JOINS] + [EXTRAS[name][1] for name in extras]
+    sql = 'SELECT' + ','.join(columns) + ''.join(joins)
+    if where:
+        sql += f'\n    WHERE {where}'
+    if order:
+        sql += f'\n    ORDER BY {order}'
+    if limit:
+        sql += '\n    LIMIT ?'
+    return sql
+
+
+# ============================================
+# الاستعلامات المعدّة (نص ثابت لكل استعلام حتى تصيب ذاكرة الجمل في sqlite3)
+# ============================================
+
+GET_OPERATION = _select('dispense', 'edit', where='f.id = ?')
+
+GET_RECEIPT = _select(where='f.id = ?')
+
+RECEIPTS_BY_IDS = _select(
+    where='f.receipt_status_id = 1 AND f.id IN (SELECT value FROM json_each(?))',
+    order='f.receipt_number'
+)
+
+RECEIPTS_BY_DAY = _select(
+    where='f.receipt_status_id = 1 AND f.operation_day >= ? AND f.operation_day < ?',
+    order='f.receipt_number',
+    limit=True
+)
+
+PENDING_OPERATIONS = _select(
+    'anomaly',
+    where='f.receipt_status_id = 2',
+    order='f.operation_date DESC, f.created_at DESC'
+)
+
+DISPENSED_BY_DAY = _select(
+    'dispense',
+    where='f.receipt_status_id = 1 AND f.operation_day >= ? AND f.operation_day < ?',
+    order='f.operation_date DESC'
+)
+
+LATEST_OPERATIONS = _select(
+    'dispense', 'edit', 'anomaly',
+    order='f.operation_date DESC, f.created_at DESC',
+    limit=True
+)
+
+RECENT_OPERATIONS = _select(order='f.created_at DESC', limit=True)
+
+USER_PENDING = _select(
+    where='f.user_id = ? AND f.receipt_status_id = 2',
+    order='f.created_at DESC'
+)
+
+# صفحة من العمليات المنصرفة للمستخدم بترتيب وقت الصرف (updated_at لا يتغير بعد الصرف)،
+# بمؤشر (updated_at, id) عبر الفهرس idx_fuel_ops_user_status فلا تزيد التكلفة مع التاريخ
+USER_DISPENSED = _select(
+    'dispense',
+    where='f.user_id = ? AND f.receipt_status_id = 1 AND (f.updated_at < ? OR (f.updated_at = ? AND f.id < ?))',
+    order='f.updated_at DESC, f.id DESC',
+    limit=True
+)
+
+# تغييرات عمليات المستخدم منذ طابع زمني (شاملاً) لمزامنة العميل دون اتصال
+USER_CHANGES = _select(
+    where='f.user_id = ? AND (f.updated_at > ? OR (f.updated_at = ? AND f.id > ?))',
+    order='f.updated_at, f.id',
+    limit=True
+)
+
+# المحذوفات بلا صاحب معروف (قبل جدول deleted_operations) تُرسل لكل المناوبين
+DELETED_OPERATIONS = '''
+    SELECT operation_id FROM deleted_operations
+    WHERE deleted_at >= ? AND (user_id = ? OR user_id IS NULL)
+'''
+
+# مؤشر الصفحة الأولى: طابع زمني نصي أكبر من أي تاريخ
+# (عمود TIMESTAMP رقمي الألفة، فالنص القابل للتحويل لرقم مثل '9999' يصبح رقماً أصغر من كل النصوص)
+FIRST_PAGE = ('9999-12-31 23:59:59', 0)
+
+# شروط البحث الاختيارية: استعلام معدّ لكل تركيبة (16 نصاً ثابتاً بدلاً من التركيب عند الطلب)
+SEARCH_FILTERS = (
+    ('search', '(f.driver_name LIKE ? OR f.vehicle_type LIKE ? OR f.receipt_number LIKE ? OR f.purpose LIKE ?)'),
+    ('unit_id', 'f.unit_id = ?'),
+    ('status_id', 'f.receipt_status_id = ?'),
+    ('month', 'f.month = ?'),
+)
+
+SEARCH_OPERATIONS = {
+    mask: _select(
+        'dispense',
+        where=' AND '.join(
+            clause for enabled, (_, clause) in zip(mask, SEARCH_FILTERS) if enabled
+        ) or '1',
+        order='f.operation_date DESC, f.created_at DESC'
+    )
+    for mask in itertools.product((False, True), repeat=len(SEARCH_FILTERS))
+}
+
+
+# ============================================
+# السجلات
+# ============================================
+
+class Record:
+    """أساس السجلات: وصول بالخاصية أو بالمفتاح، وتحويل إلى dict عند الحاجة فقط"""
+
+    __slots__ = ()
+    _fields = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def keys(self):
+        return self._fields
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def _asdict(self):
+        return {field: getattr(self, field) for field in self._fields}
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self._asdict()!r})'
+
+
+_record_types = {}
+
+
+def record_type(fields):
+    """صنف سجل بخانات ثابتة لمجموعة أعمدة (يُنشأ مرة لكل شكل استعلام)"""
+    fields = tuple(fields)
+    cls = _record_types.get(fields)
+    if cls is None:
+        arguments = ', '.join(f'_{i}' for i in range(len(fields)))
+        body = '\n'.join(f'    self.{field} = _{i}' for i, field in enumerate(fields)) or '    pass'
+        namespace = {}
+        exec(f'def __init__(self, {arguments}):\n{body}', namespace)
+        cls = type('OperationRecord', (Record,), {
+            '__slots__': fields,
+            '_fields': fields,
+            '__init__': namespace['__init__'],
+        })
+        _record_types[fields] = cls
+    return cls
+
+
+def _fetch(conn, sql, params=()):
+    """تنفيذ استعلام وإرجاع قائمة سجلات (صفوف tuple خام دون sqlite3.Row)"""
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(sql, params)
+    cls = record_type(column[0] for column in cursor.description)
+    return [cls(*row) for row in cursor]
+
+
+def _fetch_one(conn, sql, params=()):
+    rows = _fetch(conn, sql, params)
+    return rows[0] if rows else None
+
+
+# ============================================
+# واجهة المستودع
+# ============================================
+
+def get_operation(conn, operation_id):
+    """عملية واحدة مع آخر صرف وآخر تعديل"""
+    operation = _fetch_one(conn, GET_OPERATION, (operation_id,))
+    if operation is not None:
+        # آخر من عدّل العملية أو صرفها (أيهما أحدث)
+        if (operation.dispensed_at or '') > (operation.last_updated_at or ''):
+            operation.last_updater = operation.dispensed_by
+    return operation
+
+
+def get_receipt(conn, operation_id):
+    """بيانات سند واحد للطباعة"""
+    return _fetch_one(conn, GET_RECEIPT, (operation_id,))
+
+
+def receipts_by_ids(conn, ids):
+    """سندات منصرفة بأرقام العمليات (قائمة JSON كمعامل واحد)"""
+    return _fetch(conn, RECEIPTS_BY_IDS, (f'[{",".join(str(int(i)) for i in ids)}]',))
+
+
+def receipts_by_window(conn, window, limit):
+    """سندات منصرفة في نافذة زمنية"""
+    _, params = window.day_predicate()
+    return _fetch(conn, RECEIPTS_BY_DAY, (*params, limit))
+
+
+def pending_operations(conn):
+    """العمليات غير المنصرفة مع علامات الشذوذ"""
+    return _fetch(conn, PENDING_OPERATIONS)
+
+
+def dispensed_in_window(conn, window):
+    """العمليات المنصرفة في نافذة زمنية مع بيانات الصرف"""
+    _, params = window.day_predicate()
+    return _fetch(conn, DISPENSED_BY_DAY, params)
+
+
+def latest_operations(conn, limit=500):
+    """أحدث العمليات مع بيانات الصرف والتعديل والشذوذ"""
+    return _fetch(conn, LATEST_OPERATIONS, (limit,))
+
+
+def recent_operations(conn, limit=10):
+    """آخر العمليات المدخلة"""
+    return _fetch(conn, RECENT_OPERATIONS, (limit,))
+
+
+def user_pending_operations(conn, user_id):
+    """عمليات المستخدم قيد الانتظار"""
+    return _fetch(conn, USER_PENDING, (user_id,))
+
+
+def user_changes(conn, user_id, since, limit=1000):
+    """عمليات المستخدم المعدلة بعد المؤشر since = (updated_at, id) بترتيب التعديل"""
+    updated_at, operation_id = since
+    return _fetch(conn, USER_CHANGES, (user_id, updated_at, updated_at, operation_id, limit))
+
+
+def deleted_operations(conn, user_id, since):
+    """أرقام عمليات المستخدم المحذوفة منذ الطابع الزمني since"""
+    return [row[0] for row in conn.execute(DELETED_OPERATIONS, (since, user_id))]
+
+
+def format_cursor(operation):
+    """مؤشر صفحات "updated_at|id" لعملية"""
+    return f'{operation.updated_at}|{operation.id}'
+
+
+def parse_cursor(value):
+    """(updated_at, id) من مؤشر "updated_at|id"، أو ValueError إذا كان تالفاً"""
+    updated_at, separator, operation_id = value.rpartition('|')
+    if not separator or not updated_at or not operation_id.isdigit() or not operation_id.isascii():
+        raise ValueError('مؤشر الصفحة غير صالح')
+    return updated_at, int(operation_id)
+
+
+def parse_sync_token(value):
+    """مؤشر رمز المزامنة؛ الرموز القديمة (طابع زمني فقط) تعني كل ما عُدِّل منذ ذلك الوقت"""
+    if '|' not in value:
+        return value, 0
+    return parse_cursor(value)
+
+
+def user_dispensed_operations(conn, user_id, limit=50, before=None):
+    """صفحة من عمليات المستخدم المنصرفة (الأحدث أولاً) ومؤشر الصفحة التالية أو None
+
+    before: (updated_at, id) من parse_cursor لمؤشر الصفحة السابقة.
+    """
+    updated_at, operation_id = before or FIRST_PAGE
+    operations = _fetch(conn, USER_DISPENSED, (user_id, updated_at, updated_at, operation_id, limit + 1))
+    next_cursor = None
+    if len(operations) > limit:
+        operations = operations[:limit]
+        next_cursor = format_cursor(operations[-1])
+    return operations, next_cursor
+
+
+def search_operations(conn, search=None, unit_id=None, status_id=None, month=None):
+    """البحث في العمليات بشروط اختيارية (القيمة الفارغة أو 'all' تعني بلا شرط)"""
+    values = {'search': search, 'unit_id': unit_id, 'status_id': status_id, 'month': month}
+    mask = tuple(bool(values[name]) and values[name] != 'all' for name, _ in SEARCH_FILTERS)
+
+    params = []
+    if mask[0]:
+        params.extend([f'%{search}%'] * 4)
+    params.extend(values[name] for enabled, (name, _) in zip(mask[1:], SEARCH_FILTERS[1:]) if enabled)
+
+    return _fetch(conn, SEARCH_OPERATIONS[mask], params)
+
+
+# ============================================
+# قياس الأداء (صفحة 500 سجل)
+# ============================================
+
+def benchmark(conn, limit=500, rounds=50):
+    """مقارنة sqlite3.Row + dict(row) بالسجلات المدمجة: الزمن والذاكرة لصفحة واحدة"""
+    import sqlite3
+
+    def rows_as_dicts():
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        return [dict(row) for row in cursor.execute(LATEST_OPERATIONS, (limit,)).fetchall()]
+
+    def rows_as_records():
+        return latest_operations(conn, limit)
+
+    results = {}
+    for name, load in (('dict', rows_as_dicts), ('record', rows_as_records)):
+        load()
+        start = time.perf_counter()
+        for _ in range(rounds):
+            rows = load()
+        elapsed = (time.perf_counter() - start) / rounds
+
+        tracemalloc.start()
+        rows = load()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        results[name] = {'rows': len(rows), 'ms': elapsed * 1000, 'kib': memory / 1024}
+    return results
+
+
+if __name__ == '__main__':
+    import sqlite3
+
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    conn = sqlite3.connect('database.db')
+    for name, result in benchmark(conn, limit).items():
+        print(f"  {name:>6}: {result['rows']} صف، {result['ms']:.2f} مللي ثانية، {result['kib']:.0f} كيلوبايت")
+    conn.close()
@@ -0,0 +1,175 @@
+"""
+singleflight.py - دمج الاستعلامات المتطابقة المتزامنة: تنفيذ واحد ينتظره الباقون ويتشاركون نتيجته
+"""
+import fcntl
+import hashlib
+import os
+import pickle
+import sys
+import threading
+import time
+
+_MISSING = object()
+
+
+def query_key(sql, params=()):
+    """مفتاح الاستعلام: النص بعد توحيد المسافات + المعاملات"""
+    normalized = ' '.join(sql.split())
+    return hashlib.sha1(f'{normalized}\x00{params!r}'.encode('utf-8')).hexdigest()
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """تنفيذ واحد لكل مفتاح في وقت واحد داخل العامل، ومع lock_dir بين العمال أيضاً
+
+    بين العمال: من يحصل على قفل الملف ينفذ ويكتب النتيجة بجانبه، والمنتظر يقرؤها
+    إذا كُتبت بعد بدء انتظاره، وإلا ينفذ بنفسه. النتيجة مشتركة فلا تُعدَّل.
+    """
+
+    def __init__(self, lock_dir=None):
+        self.lock_dir = lock_dir
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executions = 0
+        self.coalesced = 0
+        self.shared = 0
+        self.errors = 0
+
+    def configure(self, lock_dir=None):
+        """تفعيل الدمج بين العمال عبر ملفات قفل في lock_dir"""
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+        self.lock_dir = lock_dir
+
+    def do(self, key, compute):
+        """نتيجة compute() لهذا المفتاح، بتنفيذ واحد للطلبات المتزامنة"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._execute(key, compute)
+            return call.result
+        except Exception as e:
+            call.error = e
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def _execute(self, key, compute):
+        if not self.lock_dir:
+            return self._compute(compute)
+
+        path = os.path.join(self.lock_dir, key)
+        started = time.time()
+        with open(f'{path}.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # عامل آخر ينفذ الاستعلام نفسه: انتظار انتهائه ثم قراءة نتيجته
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                result = self._read_shared(path, started)
+                if result is not _MISSING:
+                    with self._lock:
+                        self.shared += 1
+                    return result
+
+            result = self._compute(compute)
+            self._write_shared(path, result)
+            return result
+
+    def _compute(self, compute):
+        with self._lock:
+            self.executions += 1
+        return compute()
+
+    @staticmethod
+    def _read_shared(path, since):
+        """النتيجة المكتوبة بعد since (أو _MISSING)"""
+        try:
+            with open(f'{path}.result', 'rb') as f:
+                if os.fstat(f.fileno()).st_mtime < since:
+                    return _MISSING
+                return pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return _MISSING
+
+    @staticmethod
+    def _write_shared(path, result):
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, f'{path}.result')
+
+    def query(self, conn, sql, params=()):
+        """صفوف الاستعلام كقواميس (مشتركة بين الطلبات المتزامنة المتطابقة)"""
+        def compute():
+            cursor = conn.execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor]
+
+        return self.do(query_key(sql, params), compute)
+
+    def stats(self):
+        """عدد التنفيذات الفعلية والطلبات المدموجة (داخل العامل ومن عمال آخرين)"""
+        with self._lock:
+            requests = self.executions + self.coalesced + self.shared
+            return {
+                'in_flight': len(self._calls),
+                'executions': self.executions,
+                'coalesced': self.coalesced,
+                'shared': self.shared,
+                'errors': self.errors,
+                'coalesced_rate': ((self.coalesced + self.shared) / requests * 100) if requests > 0 else 0
+            }
+
+
+flight = SingleFlight()
+
+
+if __name__ == '__main__':
+    # محاكاة بداية الوردية: عدة طلبات متزامنة لنفس تجميعات لوحة مسؤول النظام
+    from app import get_db_connection
+    from dashboard_data import AGGREGATES_QUERY
+    import time_windows
+
+    threads_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    _, params = time_windows.rolling_days(7).day_predicate()
+
+    def request():
+        conn = get_db_connection()
+        flight.query(conn, AGGREGATES_QUERY, params)
+        conn.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=request) for _ in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = flight.stats()
+    print(f"✅ {threads_count} طلباً متزامناً في {(time.perf_counter() - start) * 1000:.0f} مللي ثانية: "
+          f"{stats['executions']} تنفيذ فعلي، {stats['coalesced']} مدموج")
@@ -0,0 +1,229 @@
+"""
+snapshot.py - نسخة قراءة فقط من قاعدة البيانات تُحدَّث دورياً للتقارير والتحليلات (بعيداً عن ملف الكتابة الحي)
+"""
+import fcntl
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+
+class SnapshotStore:
+    """نسخة من القاعدة عبر Online Backup API تُستبدل ذرياً عند تقادمها
+
+    القراء يفتحون الملف الحالي بوضع immutable (لا أقفال ولا قراءة WAL)، والتحديث
+    يكتب ملفاً جديداً ثم os.replace فتبقى الاتصالات المفتوحة على النسخة السابقة.
+    """
+
+    def __init__(self, database, path=None, max_age=300):
+        self.database = database
+        self.path = path or f'{database}.snapshot'
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self.refreshes = 0
+        self.last_duration = 0.0
+        self.failures = 0
+
+    def age(self):
+        """عمر النسخة بالثواني (أو None إذا لم تُنشأ بعد)"""
+        try:
+            return max(0.0, time.time() - os.path.getmtime(self.path))
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        """أخذ نسخة جديدة: False إذا كان عامل آخر يأخذها الآن"""
+        with open(f'{self.path}.lock', 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+
+            start = time.perf_counter()
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            source = sqlite3.connect(self.database)
+            target = sqlite3.connect(temp_path)
+            try:
+                # نسخ كامل في خطوة واحدة: معاملة قراءة واحدة (لا تحجب الكاتب في وضع WAL)
+                source.backup(target)
+                target.execute('PRAGMA journal_mode = DELETE')
+                target.close()
+                os.replace(temp_path, self.path)
+            except Exception:
+                target.close()
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            finally:
+                source.close()
+
+        with self._lock:
+            self.refreshes += 1
+            self.last_duration = time.perf_counter() - start
+        return True
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception:
+            with self._lock:
+                self.failures += 1
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def connect(self):
+        """اتصال قراءة بالنسخة؛ تُنشأ عند غيابها، وتُحدَّث في الخلفية عند تقادمها"""
+        age = self.age()
+        if age is None:
+            if not self.refresh():
+                # عامل آخر ينشئها الآن: انتظار انتهائه عبر القفل نفسه
+                with open(f'{self.path}.lock', 'w') as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+        elif age > self.max_age:
+            with self._lock:
+                start = not self._refreshing
+                self._refreshing = True
+            if start:
+                threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+        conn = sqlite3.connect(f'file:{self.path}?mode=ro&immutable=1', uri=True)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def stats(self):
+        """عمر النسخة وعدد مرات التحديث وزمن آخر تحديث"""
+        with self._lock:
+            return {
+                'age_seconds': self.age(),
+                'max_age_seconds': self.max_age,
+                'refreshes': self.refreshes,
+                'failures': self.failures,
+                'last_refresh_ms': self.last_duration * 1000
+            }
+
+
+# ============================================
+# قياس الأداء: تقارير ثقيلة متزامنة مع حمل كتابة
+# ============================================
+
+BENCHMARK_SCHEMA = '''
+    CREATE TABLE fuel_operations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        unit_id INTEGER,
+        month TEXT,
+        dispense_type_id INTEGER,
+        petrol_quantity REAL,
+        diesel_quantity REAL
+    )
+'''
+
+BENCHMARK_INSERT = '''
+    INSERT INTO fuel_operations (unit_id, month, dispense_type_id, petrol_quantity, diesel_quantity)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+# مثل تقارير مدير النظام: تجميع كامل للجدول
+BENCHMARK_REPORT = '''
+    SELECT month, unit_id, dispense_type_id, COUNT(*),
+           SUM(petrol_quantity), SUM(diesel_quantity)
+    FROM fuel_operations
+    GROUP BY month, unit_id, dispense_type_id
+    ORDER BY month DESC
+'''
+
+
+def _benchmark_row(number):
+    return (number % 40, f'20{20 + number % 6}-{number % 12 + 1:02d}', number % 4, number % 50, number % 30)
+
+
+def benchmark(rows=300000, readers=4, duration=10.0, write_interval=0.005, max_age=2.0):
+    """زمن الكتابة أثناء تشغيل readers تقريراً متواصلاً على القاعدة الحية ثم على النسخة
+
+    تُرجع لكل وضع: عدد الكتابات وزمنها (p50/p95/الأقصى)، عدد التقارير، وأكبر حجم لملف WAL.
+    """
+    from writer import WriteCoordinator
+
+    results = {}
+    for mode in ('none', 'live', 'snapshot'):
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, 'bench.db')
+            conn = sqlite3.connect(database)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute(BENCHMARK_SCHEMA)
+            conn.executemany(BENCHMARK_INSERT, (_benchmark_row(i) for i in range(rows)))
+            conn.commit()
+            conn.close()
+
+            coordinator = WriteCoordinator(database)
+            store = SnapshotStore(database, max_age=max_age)
+            stop = threading.Event()
+            reports = []
+            lock = threading.Lock()
+
+            def read():
+                while not stop.is_set():
+                    conn = store.connect() if mode == 'snapshot' else sqlite3.connect(database)
+                    conn.execute(BENCHMARK_REPORT).fetchall()
+                    conn.close()
+                    with lock:
+                        reports.append(1)
+
+            threads = [threading.Thread(target=read) for _ in range(readers if mode != 'none' else 0)]
+            for thread in threads:
+                thread.start()
+
+            latencies = []
+            wal_size = 0
+            number = rows
+            deadline = time.monotonic() + duration
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                coordinator.execute(lambda conn, row: conn.execute(BENCHMARK_INSERT, row), _benchmark_row(number))
+                latencies.append(time.perf_counter() - start)
+                number += 1
+                if os.path.exists(f'{database}-wal'):
+                    wal_size = max(wal_size, os.path.getsize(f'{database}-wal'))
+                time.sleep(write_interval)
+
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+            latencies.sort()
+            results[mode] = {
+                'writes': len(latencies),
+                'p50_ms': latencies[len(latencies) // 2] * 1000,
+                'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000,
+                'max_ms': latencies[-1] * 1000,
+                'reports': len(reports),
+                'wal_kb': wal_size / 1024,
+                'snapshot_refreshes': store.refreshes
+            }
+    return results
+
+
+if __name__ == '__main__':
+    if '--benchmark' in sys.argv:
+        args = [arg for arg in sys.argv[1:] if arg != '--benchmark']
+        rows = int(args[0]) if len(args) > 0 else 300000
+        readers = int(args[1]) if len(args) > 1 else 4
+        duration = float(args[2]) if len(args) > 2 else 10.0
+
+        print(f"⏳ {rows:,} عملية، {readers} قراء تقارير متواصلة، {duration:g} ثانية لكل وضع")
+        labels = {'none': 'بدون تقارير', 'live': 'تقارير على القاعدة', 'snapshot': 'تقارير على النسخة'}
+        for mode, result in benchmark(rows, readers, duration).items():
+            print(
+                f"  {labels[mode]:>18}: {result['writes']} كتابة، p50 {result['p50_ms']:.2f} / "
+                f"p95 {result['p95_ms']:.2f} / أقصى {result['max_ms']:.1f} مللي ثانية، "
+                f"{result['reports']} تقرير، WAL {result['wal_kb']:,.0f} ك.ب، تحديثات النسخة {result['snapshot_refreshes']}"
+            )
+        sys.exit(0)
+
+    # أخذ نسخة فورية (مثلاً من مهمة cron)
+    store = SnapshotStore('database.db')
+    store.refresh()
+    print(f"✅ تم إنشاء النسخة {store.path} في {store.last_duration * 1000:.0f} مللي ثانية")
@@ -0,0 +1,100 @@
+"""
+template_cache.py - التخزين المؤقت لقوالب Jinja (الشيفرة المترجمة + أجزاء القوالب)
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+
+
+class FragmentCache:
+    """مخزن LRU لأجزاء القوالب المصيّرة مع عدادات الإصابة"""
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """الحصول على جزء مخزن (أو None)"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """تخزين جزء مصيّر"""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """مسح جميع الأجزاء المخزنة"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """إحصائيات الإصابة للعامل الحالي"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / total * 100) if total > 0 else 0
+            }
+
+
+fragment_cache = FragmentCache()
+
+
+class FragmentCacheExtension(Extension):
+    """وسم {% cache 'اسم', إصدار... %} ... {% endcache %} لتخزين جزء من القالب"""
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        # مكونات المفتاح: اسم الجزء ثم أي قيم تحدد إصداره
+        key_parts = [nodes.Const(parser.name), parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key_parts.append(parser.parse_expression())
+
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+
+        return nodes.CallBlock(
+            self.call_method('_render_fragment', [nodes.List(key_parts)]),
+            [], [], body
+        ).set_lineno(lineno)
+
+    def _render_fragment(self, key_parts, caller):
+        key = tuple(key_parts)
+        value = fragment_cache.get(key)
+        if value is None:
+            value = caller()
+            fragment_cache.set(key, value)
+        return value
+
+
+def init_template_cache(app):
+    """تفعيل ذاكرة الشيفرة المترجمة ووسم تخزين الأجزاء في التطبيق"""
+    cache_dir = app.config.get('JINJA_CACHE_DIR') or os.path.join(app.instance_path, 'jinja_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # ذاكرة مشتركة على القرص تبقى بعد إعادة تشغيل العمال
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    app.jinja_env.add_extension(FragmentCacheExtension)
+
+    fragment_cache.max_entries = app.config.get('FRAGMENT_CACHE_SIZE', fragment_cache.max_entries)
@@ -0,0 +1,86 @@
+"""
+time_windows.py - نوافذ زمنية موحدة بالتوقيت المحلي وشروط استعلام تستخدم الفهارس
+"""
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+EPOCH = date(1970, 1, 1)
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def local_now():
+    """الوقت المحلي الحالي (المرجع الوحيد لكلمة "اليوم" في التطبيق)"""
+    return datetime.now()
+
+
+def local_timestamp(moment=None):
+    """طابع زمني محلي بصيغة قاعدة البيانات"""
+    return (moment or local_now()).strftime(TIMESTAMP_FORMAT)
+
+
+def day_number(value):
+    """رقم اليوم منذ 1970-01-01 لتاريخ أو نص بصيغة YYYY-MM-DD"""
+    if isinstance(value, datetime):
+        value = value.date()
+    elif isinstance(value, str):
+        value = date.fromisoformat(value[:10])
+    return value.toordinal() - EPOCH.toordinal()
+
+
+def day_to_date(number):
+    """تحويل رقم اليوم إلى نص YYYY-MM-DD"""
+    return date.fromordinal(EPOCH.toordinal() + number).isoformat()
+
+
+class TimeWindow(namedtuple('TimeWindow', 'start end')):
+    """نافذة زمنية نصف مفتوحة [start, end) من التواريخ المحلية"""
+
+    __slots__ = ()
+
+    def day_predicate(self, column='operation_day'):
+        """شرط على عمود رقم اليوم"""
+        return f'{column} >= ? AND {column} < ?', (day_number(self.start), day_number(self.end))
+
+    def date_predicate(self, column='operation_date'):
+        """شرط على عمود تاريخ نصي YYYY-MM-DD"""
+        return f'{column} >= ? AND {column} < ?', (self.start.isoformat(), self.end.isoformat())
+
+    def timestamp_predicate(self, column='created_at'):
+        """شرط على عمود طابع زمني نصي بالتوقيت المحلي"""
+        return f'{column} >= ? AND {column} < ?', (
+            self.start.strftime(TIMESTAMP_FORMAT),
+            self.end.strftime(TIMESTAMP_FORMAT)
+        )
+
+
+def _today(now=None):
+    return (now or local_now()).date()
+
+
+def today(now=None):
+    """نافذة اليوم الحالي"""
+    start = _today(now)
+    return TimeWindow(start, start + timedelta(days=1))
+
+
+def day(value):
+    """نافذة يوم محدد بصيغة YYYY-MM-DD"""
+    start = date.fromisoformat(value)
+    return TimeWindow(start, start + timedelta(days=1))
+
+
+def rolling_days(days, now=None):
+    """آخر N يوماً بالإضافة إلى اليوم الحالي"""
+    end = _today(now) + timedelta(days=1)
+    return TimeWindow(end - timedelta(days=days + 1), end)
+
+
+def month(value=None, now=None):
+    """نافذة شهر بصيغة YYYY-MM (الشهر الحالي افتراضياً)"""
+    if value:
+        start = date.fromisoformat(f'{value}-01')
+    else:
+        start = _today(now).replace(day=1)
+    end = (start + timedelta(days=32)).replace(day=1)
+    return TimeWindow(start, end)
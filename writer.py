@@ -0,0 +1,490 @@
+"""
+writer.py - منسق الكتابة: خيط كاتب واحد لكل عامل ينفذ أوامر الكتابة من طابور بإيداع جماعي، وقفل ملف يسلسل العمال
+"""
+import contextlib
+import fcntl
+import os
+import queue
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+
+class WriteBusy(Exception):
+    """قاعدة البيانات مشغولة بعد استنفاد ميزانية إعادة المحاولة (آمن لإعادة الطلب: لم يُنفذ شيء)"""
+
+
+BUSY_CODES = (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+
+def is_busy(error):
+    """هل الخطأ SQLITE_BUSY/SQLITE_LOCKED (بما فيها الرموز الممتدة)"""
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in BUSY_CODES
+    return 'locked' in str(error) or 'busy' in str(error)
+
+
+class BusyRetry:
+    """فتح معاملات الكتابة بـ BEGIN IMMEDIATE وإيداعها مع إعادة المحاولة عند SQLITE_BUSY
+
+    التأخير أسي بتشويش كامل (full jitter) حتى لا تتزامن المحاولات، ولا يتجاوز مجموع
+    الانتظار ميزانية budget ثانية، بعدها WriteBusy.
+    """
+
+    def __init__(self, budget=2.0, base_delay=0.005, max_delay=0.2):
+        self.budget = budget
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self.statements = 0
+        self.retried = 0
+        self.retries = 0
+        self.exhausted = 0
+        self.max_retries = 0
+
+    def execute(self, conn, statement):
+        """تنفيذ جملة تحتاج قفل الكتابة مع إعادة المحاولة: عدد المحاولات المعادة"""
+        deadline = time.monotonic() + self.budget
+        attempt = 0
+        while True:
+            try:
+                conn.execute(statement)
+                break
+            except sqlite3.OperationalError as e:
+                if not is_busy(e):
+                    raise
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    with self._lock:
+                        self.exhausted += 1
+                        self.retries += attempt
+                    raise WriteBusy(f'قاعدة البيانات مشغولة بعد {attempt} محاولة') from e
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                time.sleep(min(delay, remaining))
+                attempt += 1
+
+        with self._lock:
+            self.statements += 1
+            self.retries += attempt
+            self.retried += bool(attempt)
+            self.max_retries = max(self.max_retries, attempt)
+        return attempt
+
+    def begin(self, conn):
+        """BEGIN IMMEDIATE: حجز قفل الكتابة من البداية بدل ترقيته بعد القراءة"""
+        return self.execute(conn, 'BEGIN IMMEDIATE')
+
+    def commit(self, conn):
+        return self.execute(conn, 'COMMIT')
+
+    @contextlib.contextmanager
+    def transaction(self, conn):
+        """معاملة كتابة كاملة لمن يكتب خارج الكاتب (مهام سطر الأوامر)"""
+        self.begin(conn)
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self.commit(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'statements': self.statements,
+                'retried': self.retried,
+                'retries': self.retries,
+                'exhausted': self.exhausted,
+                'max_retries': self.max_retries
+            }
+
+
+@contextlib.contextmanager
+def locked_transaction(conn, lock_path, retry=None):
+    """معاملة كتابة لمهمة باتصالها الخاص (سطر الأوامر): قفل الملف المشترك مع كتّاب العمال ثم BEGIN IMMEDIATE
+
+    تُبقى المعاملة قصيرة (دفعات محدودة) لأن كتّاب العمال ينتظرون القفل طوالها.
+    """
+    retry = retry or BusyRetry()
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            with retry.transaction(conn):
+                yield conn
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def default_lock_path(conn):
+    """ملف قفل الكتابة لقاعدة الاتصال (نفس الافتراضي في WriteCoordinator)"""
+    database = next(row[2] for row in conn.execute('PRAGMA database_list') if row[1] == 'main')
+    return f'{database}.write-lock'
+
+
+class WriteCoordinator:
+    """الكاتب الوحيد في العامل: يملك اتصال الكتابة وينفذ الأوامر المتراكمة في معاملة واحدة
+
+    الأمر دالة command(conn, *args) تُنفذ داخل SAVEPOINT خاص بها: فشلها يلغي تغييراتها
+    وحدها دون بقية الدفعة، ولا تُسلَّم نتيجتها إلا بعد إيداع الدفعة.
+    """
+
+    def __init__(self, database, lock_path=None, batch_size=64, timeout=30, retry=None):
+        self.database = database
+        self.lock_path = lock_path or f'{database}.write-lock'
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.retry = retry or BusyRetry()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.commands = 0
+        self.failed = 0
+        self.batches = 0
+        self.largest_batch = 0
+
+    def _ensure_started(self):
+        # يبدأ الخيط عند أول كتابة، ومن جديد في كل عامل بعد التفرع (gunicorn --preload)
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._queue = queue.SimpleQueue()
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._queue,), name='db-writer', daemon=True
+                )
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _connect(self):
+        # بلا مهلة انشغال داخلية: الانتظار كله عبر سياسة إعادة المحاولة (قابل للقياس)
+        conn = sqlite3.connect(self.database, isolation_level=None, timeout=0)
+        conn.row_factory = sqlite3.Row
+        # WAL: القراء لا يحجبون الكاتب ولا يحجبهم
+        self.retry.execute(conn, 'PRAGMA journal_mode = WAL')
+        return conn
+
+    def submit(self, command, *args):
+        """إضافة أمر إلى الطابور وإرجاع Future بنتيجته"""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError('أمر الكتابة المتداخل يُنفذ مباشرة على اتصال الكاتب')
+        self._ensure_started()
+        future = Future()
+        self._queue.put((future, command, args))
+        return future
+
+    def execute(self, command, *args):
+        """تنفيذ أمر وانتظار نتيجته بعد الإيداع"""
+        future = self.submit(command, *args)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            # أمر لم يبدأ بعد يُلغى بأمان، أما الجاري فننتظر نتيجته حتى لا تبقى مجهولة
+            if future.cancel():
+                raise WriteBusy('انتهت مهلة انتظار الكاتب') from None
+            return future.result()
+
+    def post(self, command, *args):
+        """تنفيذ أمر دون انتظار (الأخطاء تُطبع فقط)"""
+        future = self.submit(command, *args)
+        future.add_done_callback(_report_error)
+        return future
+
+    def _run(self, commands):
+        conn = None
+        with open(self.lock_path, 'a') as lock_file:
+            while True:
+                batch = [commands.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(commands.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    if conn is None:
+                        conn = self._connect()
+                except Exception as e:
+                    self._finish([(future, None, e) for future, _, _ in batch if not future.cancelled()])
+                    continue
+                self._apply(conn, lock_file, batch)
+
+    def _apply(self, conn, lock_file, batch):
+        """تنفيذ دفعة في معاملة واحدة تحت قفل الملف المشترك بين العمال"""
+        results = []
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            self.retry.begin(conn)
+            for future, command, args in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute('SAVEPOINT command')
+                try:
+                    result = command(conn, *args)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO command')
+                    results.append((future, None, e))
+                else:
+                    results.append((future, result, None))
+                conn.execute('RELEASE command')
+            self.retry.commit(conn)
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            results = [(future, None, e) for future, _, _ in batch if not future.cancelled()]
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        self._finish(results)
+
+    def _finish(self, results):
+        with self._stats_lock:
+            self.batches += 1
+            self.commands += len(results)
+            self.failed += sum(1 for _, _, error in results if error is not None)
+            self.largest_batch = max(self.largest_batch, len(results))
+
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stats(self):
+        """إحصائيات الكاتب في العامل الحالي"""
+        with self._stats_lock:
+            return {
+                'commands': self.commands,
+                'failed': self.failed,
+                'batches': self.batches,
+                'largest_batch': self.largest_batch,
+                'average_batch': (self.commands / self.batches) if self.batches > 0 else 0,
+                'queued': self._queue.qsize() if self._queue is not None else 0,
+                'retry': self.retry.stats()
+            }
+
+
+def _report_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f"خطأ في أمر الكتابة: {future.exception()}")
+
+
+# ============================================
+# قياس الإنتاجية (كتّاب متزامنون)
+# ============================================
+
+BENCHMARK_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS activity_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        action TEXT NOT NULL,
+        table_name TEXT,
+        record_id INTEGER,
+        details TEXT,
+        ip_address TEXT,
+        created_at TIMESTAMP
+    )
+'''
+
+BENCHMARK_INSERT = '''
+    INSERT INTO activity_logs (user_id, action, table_name, record_id, details, ip_address, created_at)
+    VALUES (?, 'قياس', 'fuel_operations', ?, 'قياس إنتاجية الكتابة', '127.0.0.1', datetime('now', 'localtime'))
+'''
+
+
+def _insert(conn, writer_id, number):
+    conn.execute(BENCHMARK_INSERT, (writer_id, number))
+
+
+def benchmark(writers=50, per_writer=40):
+    """مقارنة اتصال مستقل لكل كاتب (الوضع السابق) بالكاتب المتسلسل: عمليات/ثانية وأخطاء القفل"""
+    results = {}
+    for mode in ('direct', 'coordinator'):
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, 'bench.db')
+            conn = sqlite3.connect(database)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute(BENCHMARK_SCHEMA)
+            conn.close()
+            coordinator = WriteCoordinator(database)
+
+            errors = []
+            latencies = []
+            lock = threading.Lock()
+
+            def work(writer_id):
+                if mode == 'direct':
+                    conn = sqlite3.connect(database)
+                for number in range(per_writer):
+                    start = time.perf_counter()
+                    try:
+                        if mode == 'direct':
+                            _insert(conn, writer_id, number)
+                            conn.commit()
+                        else:
+                            coordinator.execute(_insert, writer_id, number)
+                    except sqlite3.OperationalError as e:
+                        with lock:
+                            errors.append(e)
+                        continue
+                    with lock:
+                        latencies.append(time.perf_counter() - start)
+                if mode == 'direct':
+                    conn.close()
+
+            threads = [threading.Thread(target=work, args=(i,)) for i in range(writers)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+
+            latencies.sort()
+            results[mode] = {
+                'ops_per_second': len(latencies) / elapsed,
+                'errors': len(errors),
+                'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0,
+                'batches': coordinator.stats()['batches'],
+            }
+    return results
+
+
+
+# ============================================
+# محاكاة التزاحم (إضافة وصرف عبر مسارات التطبيق)
+# ============================================
+
+def _hold_write_lock(database, hold, stop):
+    """عملية خارجية تحجز قفل الكتابة دورياً (مثل مهمة أرشفة) دون المرور بقفل الملف"""
+    conn = sqlite3.connect(database, isolation_level=None, timeout=0)
+    retry = BusyRetry(budget=60)
+    while not stop.is_set():
+        retry.begin(conn)
+        time.sleep(random.uniform(0, hold))
+        conn.execute('COMMIT')
+        time.sleep(random.uniform(0, hold))
+    conn.close()
+
+
+def simulate(threads=20, per_thread=10, hold=0.3):
+    """خيوط تضيف عمليات وتصرفها عبر مسارات التطبيق على نسخة من القاعدة، مع حجز خارجي للقفل
+
+    تُرجع عدد الردود لكل مسار ورمز حالة، وتكرار أرقام السندات، وإحصائيات إعادة المحاولة.
+    """
+    import shutil
+
+    with tempfile.TemporaryDirectory() as directory:
+        shutil.copy('database.db', directory)
+        os.chdir(directory)
+        import app as application
+
+        conn = sqlite3.connect('database.db')
+        officer = conn.execute("SELECT id, unit_id FROM users WHERE role = 'المناوب بالعمليات' LIMIT 1").fetchone()
+        fueler = conn.execute("SELECT id FROM users WHERE role = 'المناوب بالمحروقات' LIMIT 1").fetchone()
+        conn.close()
+
+        def client(user_id, role):
+            test_client = application.app.test_client()
+            with test_client.session_transaction() as session:
+                session.update({'user_id': user_id, 'user_role': role, 'user_name': 'محاكاة', 'unit_id': None})
+            return test_client
+
+        responses = {}
+        latencies = []
+        lock = threading.Lock()
+
+        def record(route, response, start):
+            with lock:
+                key = (route, response.status_code)
+                responses[key] = responses.get(key, 0) + 1
+                latencies.append(time.perf_counter() - start)
+
+        def work(number):
+            operations = client(officer[0], 'المناوب بالعمليات')
+            fuel = client(fueler[0], 'المناوب بالمحروقات')
+            reader = application.get_db_connection()
+            for i in range(per_thread):
+                start = time.perf_counter()
+                response = operations.post('/api/add-operation', json={
+                    'operation_date': time.strftime('%Y-%m-%d'),
+                    'unit_id': officer[1],
+                    'driver_name': f'سائق {number}',
+                    'vehicle_type': 'محاكاة',
+                    'petrol_quantity': 10 + i,
+                    'diesel_quantity': 0,
+                    'receipt_status_id': 2,
+                })
+                record('add', response, start)
+                if response.status_code != 200:
+                    continue
+
+                operation_id = reader.execute(
+                    'SELECT id FROM fuel_operations WHERE receipt_number = ?',
+                    (response.get_json()['receipt_number'],)
+                ).fetchone()[0]
+                start = time.perf_counter()
+                record('dispense', fuel.post(f'/api/dispense-operation/{operation_id}', json={}), start)
+            reader.close()
+
+        stop = threading.Event()
+        holder = threading.Thread(target=_hold_write_lock, args=('database.db', hold, stop))
+        if hold:
+            holder.start()
+
+        workers = [threading.Thread(target=work, args=(i,)) for i in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        if hold:
+            holder.join()
+
+        conn = sqlite3.connect('database.db')
+        duplicates = conn.execute(
+            'SELECT COUNT(*) FROM (SELECT receipt_number FROM fuel_operations GROUP BY 1 HAVING COUNT(*) > 1)'
+        ).fetchone()[0]
+        conn.close()
+
+        latencies.sort()
+        return {
+            'elapsed': elapsed,
+            'responses': responses,
+            'duplicate_receipts': duplicates,
+            'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0,
+            'writer': application.db_writer.stats(),
+        }
+
+if __name__ == '__main__':
+    if '--simulate' in sys.argv:
+        args = [float(arg) for arg in sys.argv[1:] if arg != '--simulate']
+        threads = int(args[0]) if len(args) > 0 else 20
+        per_thread = int(args[1]) if len(args) > 1 else 10
+        hold = args[2] if len(args) > 2 else 0.3
+
+        print(f"⏳ محاكاة تزاحم: {threads} خيطاً × {per_thread} إضافة وصرف، مع حجز خارجي لقفل الكتابة حتى {hold} ثانية")
+        result = simulate(threads, per_thread, hold)
+        for (route, status), count in sorted(result['responses'].items()):
+            print(f"  {route:>8} {status}: {count}")
+        print(f"  الزمن {result['elapsed']:.1f} ثانية، p95 {result['p95_ms']:.0f} مللي ثانية، "
+              f"أرقام سندات مكررة {result['duplicate_receipts']}")
+        print(f"  إعادة المحاولة: {result['writer']['retry']}")
+        sys.exit(0)
+
+    writers = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    per_writer = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+
+    print(f"⏳ {writers} كاتباً متزامناً × {per_writer} عملية لكل كاتب")
+    for mode, result in benchmark(writers, per_writer).items():
+        print(
+            f"  {mode:>11}: {result['ops_per_second']:,.0f} عملية/ثانية، "
+            f"p95 {result['p95_ms']:.1f} مللي ثانية، أخطاء القفل {result['errors']}، دفعات {result['batches']}"
+        )